@@ -6,18 +6,23 @@ REPO_ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 # Define paths
 LIB_DIR="$REPO_ROOT/usr/lib/clicky"
 SCHEMA_DIR="$REPO_ROOT/usr/share/glib-2.0/schemas"
+SCHEMA_XML="$SCHEMA_DIR/org.x.clickyplus.gschema.xml"
+SCHEMA_COMPILED="$SCHEMA_DIR/gschemas.compiled"
 
 # Detect executables
-PYTHON_BIN=$(which python3)
-GLIB_COMPILE_SCHEMAS_BIN=$(which glib-compile-schemas)
+PYTHON_BIN=$(command -v python3)
 
-# Compile schemas locally if they aren't already valid or update is needed
-if [ -f "$SCHEMA_DIR/org.x.clickyplus.gschema.xml" ]; then
+# Messages go to stderr, stdout may carry an image (--stdout)
+
+# Compile schemas locally only when the XML changed since the last compile
+# (-nt is also true when the compiled file doesn't exist yet)
+if [ -f "$SCHEMA_XML" ] && [ "$SCHEMA_XML" -nt "$SCHEMA_COMPILED" ]; then
+    GLIB_COMPILE_SCHEMAS_BIN=$(command -v glib-compile-schemas)
     if [ -n "$GLIB_COMPILE_SCHEMAS_BIN" ]; then
-        echo "Compiling GSettings schemas locally..."
+        echo "Compiling GSettings schemas locally..." >&2
         "$GLIB_COMPILE_SCHEMAS_BIN" "$SCHEMA_DIR"
     else
-        echo "Warning: glib-compile-schemas not found. Schemas might be outdated."
+        echo "Warning: glib-compile-schemas not found. Schemas might be outdated." >&2
     fi
 fi
 
@@ -25,13 +30,13 @@ fi
 export PYTHONPATH="$LIB_DIR:$PYTHONPATH"
 export GSETTINGS_SCHEMA_DIR="$SCHEMA_DIR"
 
-echo "Starting Clicky from local source..."
-echo "PYTHONPATH: $PYTHONPATH"
-echo "GSETTINGS_SCHEMA_DIR: $GSETTINGS_SCHEMA_DIR"
+echo "Starting Clicky from local source..." >&2
+echo "PYTHONPATH: $PYTHONPATH" >&2
+echo "GSETTINGS_SCHEMA_DIR: $GSETTINGS_SCHEMA_DIR" >&2
 
 if [ -n "$PYTHON_BIN" ]; then
-    "$PYTHON_BIN" "$LIB_DIR/clicky.py" "$@"
+    exec "$PYTHON_BIN" "$LIB_DIR/clicky.py" "$@"
 else
-    echo "Error: python3 not found."
+    echo "Error: python3 not found." >&2
     exit 1
 fi
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+"""
+benchmark_masking.py – Compare monitor masking implementations.
+
+Masks the invisible part of an L-shaped 4K + 1080p desktop, first with the
+old per-pixel Python loop, then with utils.blank_region_in_pixbuf.
+
+Usage: python3 scripts/benchmark_masking.py [repeats]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../usr/lib/clicky")))
+
+import gi
+gi.require_version("Gtk", "3.0")
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import GdkPixbuf
+import cairo
+
+import utils
+
+# 3840x2160 monitor with a 1920x1080 one on its right, aligned to the top
+SCREEN_WIDTH = 3840 + 1920
+SCREEN_HEIGHT = 2160
+MONITORS = [(0, 0, 3840, 2160), (3840, 0, 1920, 1080)]
+
+
+def make_invisible_region():
+    region = cairo.Region(cairo.RectangleInt(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
+    for monitor in MONITORS:
+        region.subtract(cairo.RectangleInt(*monitor))
+    return region
+
+
+def legacy_blank_region(pixels, rowstride, n_channels, has_alpha, region):
+    """The per-pixel loop masking used to run, on a writable copy."""
+    for i in range(region.num_rectangles()):
+        rect = region.get_rectangle(i)
+        for y in range(rect.y, rect.y + rect.height):
+            for x in range(rect.x, rect.x + rect.width):
+                j = y * rowstride + x * n_channels
+                pixels[j + 0] = 0
+                pixels[j + 1] = 0
+                pixels[j + 2] = 0
+                if has_alpha:
+                    pixels[j + 3] = 255
+
+
+def measure(func, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, SCREEN_WIDTH, SCREEN_HEIGHT)
+    pixbuf.fill(0xffffffff)
+    region = make_invisible_region()
+
+    pixels = bytearray(pixbuf.get_pixels())
+    legacy = measure(lambda: legacy_blank_region(pixels, pixbuf.get_rowstride(), pixbuf.get_n_channels(),
+                                                 pixbuf.get_has_alpha(), region), repeats)
+    bulk = measure(lambda: utils.blank_region_in_pixbuf(pixbuf, region), repeats)
+
+    print("Masking %dx%d, best of %d" % (SCREEN_WIDTH, SCREEN_HEIGHT, repeats))
+    print("  per-pixel loop: %8.1f ms" % (legacy * 1000))
+    print("  row fill:       %8.1f ms" % (bulk * 1000))
+    print("  speedup:        %8.0fx" % (legacy / bulk))
+
+
+if __name__ == "__main__":
+    main()
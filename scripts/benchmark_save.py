@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""
+benchmark_save.py – Compare file size and encoding time of the save profiles.
+
+Encodes a corpus of captures with writer.encode() in every format and save
+profile. Without arguments the corpus is generated: a flat UI screenshot
+(few colours), the same with anti-aliased text, and a photo-like image.
+Image files given as arguments are used instead.
+
+Usage: python3 scripts/benchmark_save.py [-r repeats] [image...]
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../usr/lib/clicky")))
+
+import gi
+gi.require_version("Gtk", "3.0")
+gi.require_version("Gdk", "3.0")
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import Gdk, GdkPixbuf
+import cairo
+
+import writer
+
+WIDTH = 1920
+HEIGHT = 1080
+FORMATS = ["png", "jpeg", "webp"]
+
+
+def draw_flat_ui(cr):
+    # Window background, header bar, sidebar and a few buttons
+    cr.set_source_rgb(0.96, 0.96, 0.96)
+    cr.paint()
+    cr.set_source_rgb(0.85, 0.85, 0.85)
+    cr.rectangle(0, 0, WIDTH, 48)
+    cr.fill()
+    cr.set_source_rgb(0.2, 0.22, 0.25)
+    cr.rectangle(0, 48, 280, HEIGHT - 48)
+    cr.fill()
+    cr.set_source_rgb(0.21, 0.52, 0.89)
+    for i in range(8):
+        cr.rectangle(320 + i * 180, 80, 160, 36)
+        cr.fill()
+    cr.set_source_rgb(1, 1, 1)
+    for i in range(20):
+        cr.rectangle(320, 150 + i * 44, WIDTH - 360, 36)
+        cr.fill()
+
+
+def draw_text(cr):
+    cr.set_source_rgb(0.1, 0.1, 0.1)
+    cr.set_font_size(14)
+    for i in range(20):
+        cr.move_to(332, 174 + i * 44)
+        cr.show_text("Item %d – The quick brown fox jumps over the lazy dog" % i)
+    cr.set_source_rgb(0.9, 0.9, 0.9)
+    for i in range(20):
+        cr.move_to(16, 80 + i * 30)
+        cr.show_text("Folder %d" % i)
+
+
+def draw_photo(cr):
+    # Smooth gradients with noise, like a wallpaper or a photo
+    surface = cr.get_target()
+    surface.flush()
+    data = surface.get_data()
+    stride = surface.get_stride()
+    rng = random.Random(0)
+    for y in range(HEIGHT):
+        row = bytearray(WIDTH * 4)
+        for x in range(WIDTH):
+            noise = rng.randint(-12, 12)
+            row[x * 4] = max(0, min(255, int(128 + 100 * math.sin(x / 150)) + noise))
+            row[x * 4 + 1] = max(0, min(255, int(128 + 100 * math.cos(y / 90)) + noise))
+            row[x * 4 + 2] = max(0, min(255, (x + y) * 255 // (WIDTH + HEIGHT) + noise))
+            row[x * 4 + 3] = 255
+        data[y * stride:y * stride + WIDTH * 4] = bytes(row)
+    surface.mark_dirty()
+
+
+def make_capture(*painters):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
+    cr = cairo.Context(surface)
+    for paint in painters:
+        paint(cr)
+    surface.flush()
+    return Gdk.pixbuf_get_from_surface(surface, 0, 0, WIDTH, HEIGHT)
+
+
+def get_corpus(paths):
+    if paths:
+        return [(os.path.basename(path), GdkPixbuf.Pixbuf.new_from_file(path)) for path in paths]
+    return [("flat UI", make_capture(draw_flat_ui)),
+            ("UI with text", make_capture(draw_flat_ui, draw_text)),
+            ("photo", make_capture(draw_photo))]
+
+
+def measure(func, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the save profiles")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("images", nargs="*")
+    args = parser.parse_args()
+
+    for (name, pixbuf) in get_corpus(args.images):
+        print("%s, %dx%d, best of %d" % (name, pixbuf.get_width(), pixbuf.get_height(), args.repeats))
+        for fmt in FORMATS:
+            for profile in writer.SAVE_PROFILES:
+                try:
+                    (elapsed, data) = measure(lambda: writer.encode(pixbuf, fmt, profile), args.repeats)
+                except Exception as e:
+                    print("  %-5s %-9s unavailable (%s)" % (fmt, profile, e))
+                    break
+                print("  %-5s %-9s %8.1f ms %10.1f KiB" % (fmt, profile, elapsed * 1000, len(data) / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,7 +20,8 @@ try:
     if GI_AVAILABLE:
         # Add the library directory to sys.path to import modules
         sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../usr/lib/clicky')))
-        from utils import cairo_rect_to_gdk_rect, gdk_rect_to_cairo_rect
+        from gi.repository import GdkPixbuf
+        from utils import cairo_rect_to_gdk_rect, gdk_rect_to_cairo_rect, blank_region_in_pixbuf, copy_pixbuf_rectangle
         DEPS_AVAILABLE = True
 except Exception:
     DEPS_AVAILABLE = False
@@ -58,6 +59,42 @@ class TestUtils(unittest.TestCase):
         round_trip = gdk_rect_to_cairo_rect(gdk_rect)
         self.assertEqual((round_trip.x, round_trip.y, round_trip.width, round_trip.height), (1, 2, 3, 4))
 
+    @unittest.skipUnless(DEPS_AVAILABLE, "GTK/Cairo indisponível para testes de máscara")
+    def test_blank_region_in_pixbuf(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 8, 4)
+        pixbuf.fill(0xffffffff)
+        # Partly outside of the pixbuf, must be clipped
+        region = cairo.Region(cairo.RectangleInt(6, 2, 10, 10))
+        blank_region_in_pixbuf(pixbuf, region)
+
+        pixels = pixbuf.get_pixels()
+        rowstride = pixbuf.get_rowstride()
+        def pixel(x, y):
+            i = y * rowstride + x * 4
+            return tuple(pixels[i:i + 4])
+        self.assertEqual(pixel(6, 2), (0, 0, 0, 255))
+        self.assertEqual(pixel(7, 3), (0, 0, 0, 255))
+        self.assertEqual(pixel(5, 2), (255, 255, 255, 255))
+        self.assertEqual(pixel(6, 1), (255, 255, 255, 255))
+
+    @unittest.skipUnless(DEPS_AVAILABLE, "GTK/Cairo indisponível para testes de cópia")
+    def test_copy_pixbuf_rectangle(self):
+        src = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 8, 4)
+        src.fill(0x336699ff)
+        dest = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 8, 4)
+        dest.fill(0)
+        # Overflows the right edge, must be clipped
+        copy_pixbuf_rectangle(src, dest, 6, 1, 5, 2)
+
+        pixels = dest.get_pixels()
+        rowstride = dest.get_rowstride()
+        def pixel(x, y):
+            i = y * rowstride + x * 4
+            return tuple(pixels[i:i + 4])
+        self.assertEqual(pixel(7, 2), (0x33, 0x66, 0x99, 255))
+        self.assertEqual(pixel(5, 1), (0, 0, 0, 0))
+        self.assertEqual(pixel(6, 3), (0, 0, 0, 0))
+
     # We would test crop_geometry and conversions here.
     # Since utils.py relies heavily on X11/Gdk imports which might be hard to mock perfectly without a display,
     # we start with importability and basic logic.
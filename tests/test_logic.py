@@ -2,6 +2,9 @@ import unittest
 from unittest.mock import MagicMock, patch
 import sys
 import os
+import shutil
+import tempfile
+import threading
 
 # Create Dummy Base Classes to replace Gtk classes
 class MockDrawingArea:
@@ -10,6 +13,7 @@ class MockDrawingArea:
     def set_events(self, mask): pass
     def connect(self, signal, handler): pass
     def queue_draw(self): pass
+    def queue_draw_area(self, x, y, width, height): pass
     def get_window(self): 
         w = MagicMock()
         w.create_similar_surface.return_value = MagicMock()
@@ -24,6 +28,12 @@ class MockApplication:
     def get_windows(self): return []
     def add_window(self, win): pass
 
+try:
+    import PIL.Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
 # Setup paths
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../usr/lib/clicky')))
 
@@ -46,13 +56,45 @@ mock_gi.Gdk.EventMask.POINTER_MOTION_MASK = 0
 # Patch dbus as well
 mock_dbus = MagicMock()
 mock_gi.GLib.MainLoop = MagicMock
-with patch.dict('sys.modules', {'gi.repository': mock_gi, 'gi': MagicMock(), 'dbus': mock_dbus, 'cairo': MagicMock(), 'setproctitle': MagicMock()}):
+with patch.dict('sys.modules', {'gi.repository': mock_gi, 'gi': MagicMock(), 'dbus': mock_dbus,
+                                'dbus.mainloop': mock_dbus.mainloop, 'dbus.mainloop.glib': mock_dbus.mainloop.glib,
+                                'cairo': MagicMock(), 'setproctitle': MagicMock()}):
     import utils
     import canvas
     import clicky
+    import headless
+    import shortcuts
+    import history
+    import scene
+    import effects
+    import writer
+    import common
 
     pass
 
+class TestLocalSchema(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compiled = os.path.join(self.directory, "gschemas.compiled")
+        self.xml = os.path.join(self.directory, common.SETTINGS_SCHEMA_ID + ".gschema.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def touch(self, path, mtime):
+        open(path, "w").close()
+        os.utime(path, (mtime, mtime))
+
+    def test_stale_compiled_schema_ignored(self):
+        with patch.object(common, "SCHEMA_DIR", self.directory):
+            self.assertFalse(common.is_local_schema_current())
+            self.touch(self.xml, 1000)
+            self.touch(self.compiled, 2000)
+            self.assertTrue(common.is_local_schema_current())
+            # New keys were added to the XML since the last compile
+            self.touch(self.xml, 3000)
+            self.assertFalse(common.is_local_schema_current())
+
 class TestUtilsPortal(unittest.TestCase):
     def test_portal_capture_flow(self):
         """Test the logic flow of portal capture (request -> signal -> loops)."""
@@ -83,6 +125,717 @@ class TestUtilsPortal(unittest.TestCase):
         # Actually, let's just checking imports and basic structure for now.
         pass
 
+class TestBackendProber(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, "backends.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_prober(self, capabilities):
+        prober = utils.BackendProber(self.cache_path)
+        prober.probe = MagicMock(return_value=capabilities)
+        return prober
+
+    def test_fastest_backend_first(self):
+        prober = self.make_prober({
+            utils.BACKEND_GNOME_SHELL: ["screen", "window", "area"],
+            utils.BACKEND_PORTAL: ["screen", "area"],
+            utils.BACKEND_X11: ["screen", "window", "area"],
+        })
+        self.assertEqual(prober.get_backends("screen"),
+                         [utils.BACKEND_GNOME_SHELL, utils.BACKEND_X11, utils.BACKEND_PORTAL])
+        self.assertEqual(prober.get_backends("window", enable_dbus_method=False), [utils.BACKEND_X11])
+
+    def test_probe_runs_once_per_session(self):
+        prober = self.make_prober({utils.BACKEND_X11: ["screen"]})
+        prober.get_backends("screen")
+        prober.get_backends("area")
+        prober.probe.assert_called_once()
+
+        # A new process in the same session reuses the cached decision
+        second = self.make_prober({})
+        self.assertEqual(second.get_backends("screen"), [utils.BACKEND_X11])
+        second.probe.assert_not_called()
+
+    def test_cache_ignored_in_other_session(self):
+        self.make_prober({utils.BACKEND_X11: ["screen"]}).get_backends("screen")
+        other = self.make_prober({})
+        other.get_session_key = MagicMock(return_value="another-session")
+        self.assertEqual(other.get_backends("screen"), [])
+        other.probe.assert_called_once()
+
+    def test_invalidate(self):
+        prober = self.make_prober({utils.BACKEND_GNOME_SHELL: ["screen", "area"]})
+        prober.invalidate(utils.BACKEND_GNOME_SHELL, "screen")
+        self.assertEqual(prober.get_backends("screen"), [])
+        self.assertEqual(prober.get_backends("area"), [utils.BACKEND_GNOME_SHELL])
+        self.assertEqual(self.make_prober({}).get_backends("screen"), [])
+
+    def capture(self, prober, shell_result):
+        options = MagicMock(mode="screen", enable_dbus_method=True)
+        with patch.object(utils, "get_backend_prober", return_value=prober), \
+             patch.object(utils, "capture_via_gnome_dbus", side_effect=shell_result), \
+             patch.object(utils, "capture_via_x11", return_value="x11 image"):
+            return utils.capture_image(options)
+
+    def test_failed_capture_keeps_backend(self):
+        prober = self.make_prober({utils.BACKEND_GNOME_SHELL: ["screen"], utils.BACKEND_X11: ["screen"]})
+        self.assertEqual(self.capture(prober, [None]), "x11 image")
+        self.assertEqual(prober.get_backends("screen"), [utils.BACKEND_GNOME_SHELL, utils.BACKEND_X11])
+
+    def test_unavailable_backend_is_invalidated(self):
+        prober = self.make_prober({utils.BACKEND_GNOME_SHELL: ["screen"], utils.BACKEND_X11: ["screen"]})
+        self.assertEqual(self.capture(prober, utils.BackendUnavailable("UnknownMethod")), "x11 image")
+        self.assertEqual(prober.get_backends("screen"), [utils.BACKEND_X11])
+
+    def test_access_denied_invalidates(self):
+        # GNOME Shell 41+ refuses Screenshot calls from other applications
+        error = Exception("AccessDenied")
+        error.get_dbus_name = lambda: "org.freedesktop.DBus.Error.AccessDenied"
+        backend = MagicMock()
+        backend.shell_screenshot.side_effect = error
+        prober = self.make_prober({utils.BACKEND_GNOME_SHELL: ["screen"], utils.BACKEND_X11: ["screen"]})
+        options = MagicMock(mode="screen", enable_dbus_method=True, enable_sound=False)
+        with patch.object(utils, "get_backend_prober", return_value=prober), \
+             patch.object(utils, "get_dbus_backend", return_value=backend), \
+             patch.object(utils, "get_capture_tmp_dir", return_value=self.tmpdir), \
+             patch.object(utils, "capture_via_x11", return_value="x11 image"):
+            self.assertEqual(utils.capture_image(options), "x11 image")
+        self.assertEqual(prober.get_backends("screen"), [utils.BACKEND_X11])
+        # Remembered for the session
+        self.assertEqual(self.make_prober({}).get_backends("screen"), [utils.BACKEND_X11])
+
+    def test_unavailable_errors(self):
+        error = MagicMock()
+        error.get_dbus_name.return_value = "org.freedesktop.DBus.Error.UnknownMethod"
+        self.assertTrue(utils.is_unavailable_error(error))
+        error.get_dbus_name.return_value = "org.freedesktop.DBus.Error.NoReply"
+        self.assertFalse(utils.is_unavailable_error(error))
+        self.assertFalse(utils.is_unavailable_error(ValueError()))
+
+class TestShortcutReconciler(unittest.TestCase):
+    def get_state(self, plan):
+        # Every setting at its schema default, i.e. empty
+        state = {}
+        for (setting, wanted) in plan:
+            if callable(wanted) or isinstance(wanted, list):
+                state[setting] = []
+            else:
+                state[setting] = ""
+        return state
+
+    def apply(self, state, changes):
+        state = dict(state)
+        for (setting, old, new) in changes:
+            state[setting] = new
+        return state
+
+    def test_enable_is_idempotent(self):
+        plan = shortcuts.get_plan(True, cinnamon=True)
+        state = self.get_state(plan)
+        changes = shortcuts.compute_changes(plan, state)
+        self.assertGreater(len(changes), 0)
+        state = self.apply(state, changes)
+        self.assertEqual(shortcuts.compute_changes(plan, state), [])
+        self.assertEqual(shortcuts.format_changes([]), "Keyboard shortcuts are up to date.")
+
+    def test_other_gnome_bindings_preserved(self):
+        setting = (shortcuts.GNOME_MEDIA_KEYS_SCHEMA, None, "custom-keybindings")
+        other = "/org/gnome/settings-daemon/plugins/media-keys/custom-keybindings/custom0/"
+        plan = shortcuts.get_plan(True)
+        state = self.apply(self.get_state(plan), [(setting, [], [other])])
+        state = self.apply(state, shortcuts.compute_changes(plan, state))
+        self.assertEqual(state[setting][0], other)
+        self.assertEqual(len(state[setting]), 1 + len(shortcuts.SHORTCUTS))
+
+        plan = shortcuts.get_plan(False)
+        state = self.apply(state, shortcuts.compute_changes(plan, state))
+        self.assertEqual(state[setting], [other])
+
+    def test_only_differences_are_written(self):
+        plan = shortcuts.get_plan(True)
+        state = self.apply(self.get_state(plan), shortcuts.compute_changes(plan, self.get_state(plan)))
+        # Switching to the resident service only changes the commands
+        changes = shortcuts.compute_changes(shortcuts.get_plan(True, resident=True), state)
+        self.assertEqual(len(changes), len(shortcuts.SHORTCUTS))
+        for ((schema_id, path, key), old, new) in changes:
+            self.assertEqual(key, "command")
+            self.assertIn("org.x.clickyplus.Capture.Capture", new)
+
+    def test_missing_schema_skipped(self):
+        plan = shortcuts.get_plan(True, cinnamon=True)
+        state = {setting: value for (setting, value) in self.get_state(plan).items()
+                 if not setting[0].startswith("org.cinnamon")}
+        for (setting, old, new) in shortcuts.compute_changes(plan, state):
+            self.assertFalse(setting[0].startswith("org.cinnamon"))
+
+    def test_missing_keys_skipped(self):
+        # gnome-settings-daemon >= 41: no native screenshot keys
+        keys = {
+            shortcuts.GNOME_MEDIA_KEYS_SCHEMA: ["custom-keybindings"],
+            shortcuts.GNOME_CUSTOM_SCHEMA: ["name", "command", "binding"],
+        }
+        written = []
+
+        class FakeSchema():
+            def __init__(self, schema_id):
+                self.schema_id = schema_id
+            def has_key(self, key):
+                return key in keys[self.schema_id]
+
+        class FakeSettings():
+            def __init__(self, schema_id, path=None):
+                self.schema_id = schema_id
+            def get_value(self, key):
+                # Unknown keys abort the process with the real GSettings
+                if key not in keys[self.schema_id]:
+                    raise AssertionError("Unknown key %s" % key)
+                return MagicMock(unpack=MagicMock(return_value=[] if key != "name" else ""))
+            def set_value(self, key, value):
+                self.get_value(key)
+                written.append(key)
+            def delay(self): pass
+            def apply(self): pass
+
+        lookup = lambda schema_id: FakeSchema(schema_id) if schema_id in keys else None
+        with patch.object(shortcuts, "_lookup_schema", side_effect=lookup), \
+             patch.object(shortcuts.Gio.Settings, "new", side_effect=FakeSettings), \
+             patch.object(shortcuts.Gio.Settings, "new_with_path", side_effect=FakeSettings):
+            changes = shortcuts.reconcile(True)
+        self.assertGreater(len(changes), 0)
+        self.assertNotIn("screenshot", written)
+        self.assertIn("custom-keybindings", written)
+
+    def test_resident_command(self):
+        command = shortcuts._get_resident_command("--area")
+        self.assertIn("--dest org.x.clicky", command)
+        self.assertIn("Capture area", command)
+
+class FakeBase():
+    def get_stride(self): return 4
+    def get_height(self): return 1
+
+
+class FakeScene():
+    # A scene whose state is the list of commands applied to it
+    def __init__(self):
+        self.base = FakeBase()
+        self.annotations = []
+    def snapshot(self):
+        return scene.SceneSnapshot(self.base, self.annotations)
+    def restore(self, snapshot):
+        self.base = snapshot.base
+        self.annotations = list(snapshot.annotations)
+
+
+class AppendCommand(history.Command):
+    def __init__(self, name, replayed=None):
+        self.name = name
+        self.replayed = replayed
+    def apply(self, scene):
+        if self.replayed is not None:
+            self.replayed.append(self.name)
+        scene.annotations.append(self.name)
+        # Each command creates a new base, e.g. a blur
+        scene.base = FakeBase()
+
+
+class CachingCommand(AppendCommand):
+    # Holds a precomputed surface, like a prepared blur
+    def __init__(self, name):
+        super().__init__(name)
+        self.cached = FakeBase()
+    def get_surfaces(self):
+        return [] if self.cached is None else [self.cached]
+    def release(self):
+        self.cached = None
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = history.History(snapshot_interval=3, memory_limit=1000)
+        self.scene = FakeScene()
+        self.history.reset(self.scene)
+
+    def do(self, *names, replayed=None):
+        for name in names:
+            command = AppendCommand(name, replayed)
+            command.apply(self.scene)
+            self.history.push(command, self.scene)
+
+    def test_undo_redo(self):
+        self.do("a", "b", "c", "d")
+        self.assertTrue(self.history.undo(self.scene))
+        self.assertEqual(self.scene.annotations, ["a", "b", "c"])
+        self.history.undo(self.scene)
+        self.assertEqual(self.scene.annotations, ["a", "b"])
+        self.history.redo(self.scene)
+        self.assertEqual(self.scene.annotations, ["a", "b", "c"])
+        self.assertTrue(self.history.can_redo())
+        # A new command drops what could be redone
+        self.do("e")
+        self.assertFalse(self.history.can_redo())
+        self.history.undo(self.scene)
+        self.assertEqual(self.scene.annotations, ["a", "b", "c"])
+
+    def test_undo_replays_from_nearest_snapshot(self):
+        replayed = []
+        self.do("a", "b", "c", "d", "e", replayed=replayed)
+        self.assertEqual(sorted(self.history.snapshots), [0, 3])
+        del replayed[:]
+        self.history.undo(self.scene)
+        self.assertEqual(self.scene.annotations, ["a", "b", "c", "d"])
+        self.assertEqual(replayed, ["d"])
+
+    def test_command_surfaces_counted(self):
+        self.history.memory_limit = 12
+        commands = [CachingCommand(name) for name in "abc"]
+        for command in commands[:2]:
+            command.apply(self.scene)
+            self.history.push(command, self.scene)
+        # The unedited base and two cached surfaces fit
+        self.assertEqual(self.history.get_memory(), 12)
+        commands[2].apply(self.scene)
+        self.history.push(commands[2], self.scene)
+        self.assertLessEqual(self.history.get_memory(), 12)
+        self.assertEqual([command.cached for command in commands], [None, None, None])
+
+    def test_old_snapshots_evicted(self):
+        # Each base "weighs" 4 bytes
+        self.history.memory_limit = 12
+        self.do(*"abcdefghijkl")
+        self.assertEqual(sorted(self.history.snapshots), [0, 9, 12])
+        # Still able to go all the way back
+        while self.history.can_undo():
+            self.history.undo(self.scene)
+        self.assertEqual(self.scene.annotations, [])
+
+    def test_shared_bases_counted_once(self):
+        self.history.memory_limit = 8
+        # Annotations don't replace the base
+        self.history.snapshots = {position: scene.SceneSnapshot(self.scene.base, []) for position in (0, 3, 6)}
+        self.history.evict()
+        self.assertEqual(sorted(self.history.snapshots), [0, 3, 6])
+
+
+class TestBlurCommand(unittest.TestCase):
+    def setUp(self):
+        self.blurred = []
+        def blur_surface(surface, x, y, w, h, radius):
+            self.blurred.append(surface)
+            return surface
+        self.patchers = [patch.object(history, 'copy_surface', lambda surface: ("copy", surface)),
+                         patch.object(history.effects, 'blur_surface', blur_surface)]
+        for patcher in self.patchers:
+            patcher.start()
+        self.scene = MagicMock()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def test_prepared_result_used(self):
+        command = history.BlurCommand(0, 0, 10, 10).prepare(self.scene.base)
+        command.apply(self.scene)
+        self.assertEqual(len(self.blurred), 1)
+        self.scene.set_base.assert_called_once_with(("copy", self.scene.base), (0, 0, 10, 10))
+
+    def test_prepared_from_another_base(self):
+        command = history.BlurCommand(0, 0, 10, 10).prepare("old base")
+        command.apply(self.scene)
+        # Blurred again, from the current base
+        self.assertEqual(self.blurred, [("copy", "old base"), ("copy", self.scene.base)])
+        self.assertIsNone(command.prepared)
+
+    def test_prepared_from_copy(self):
+        command = history.BlurCommand(0, 0, 10, 10).prepare(self.scene.base, "private copy")
+        # The worker only touches the copy it was given
+        self.assertEqual(self.blurred, ["private copy"])
+        self.assertEqual(command.prepared, (self.scene.base, "private copy"))
+
+
+class TestPendingBlurs(unittest.TestCase):
+    def setUp(self):
+        self.canvas = canvas.CanvasWidget()
+        self.applied = []
+        self.canvas.apply_command = lambda command: self.applied.append(command)
+        self.canvas.emit = MagicMock()
+        self.canvas.end_blur_preview = MagicMock()
+        self.pipelines = []
+        self.canvas.start_blur = self.start_blur
+
+    def start_blur(self, command):
+        pipeline = MagicMock()
+        pipeline.command = command
+        self.pipelines.append(pipeline)
+        return pipeline
+
+    def queue_blurs(self, count):
+        for i in range(count):
+            self.canvas.queue_edit("blur", lambda i=i: self.canvas.start_blur("blur %d" % i))
+
+    def test_edits_wait_for_blurs(self):
+        self.queue_blurs(2)
+        self.canvas.execute("crop")
+        # Nothing is waited for, the blurs are computed one after the other
+        self.assertEqual(self.applied, [])
+        self.assertEqual(len(self.pipelines), 1)
+        self.canvas.on_blur_done(self.pipelines[0].command)
+        self.assertEqual(self.applied, ["blur 0"])
+        self.assertEqual(len(self.pipelines), 2)
+        self.canvas.on_blur_done(self.pipelines[1].command)
+        self.assertEqual(self.applied, ["blur 0", "blur 1", "crop"])
+        self.assertEqual(self.canvas.pending_edits, [])
+        self.canvas.end_blur_preview.assert_called_once()
+
+    def test_edits_applied_right_away_without_blurs(self):
+        self.canvas.execute("crop")
+        self.assertEqual(self.applied, ["crop"])
+        self.assertEqual(self.canvas.pending_edits, [])
+
+    def test_only_blurs_started_meanwhile(self):
+        self.queue_blurs(1)
+        self.canvas.current_tool = 'blur'
+        self.assertTrue(self.canvas.can_start_edit())
+        self.canvas.current_tool = 'pen'
+        self.assertFalse(self.canvas.can_start_edit())
+        self.canvas.current_tool = 'blur'
+        self.canvas.undo()
+        self.assertFalse(self.canvas.can_start_edit())
+
+    def test_failure_is_reported(self):
+        self.queue_blurs(1)
+        self.canvas.execute("crop")
+        self.canvas.on_blur_error(ValueError("out of memory"))
+        self.assertEqual(self.applied, ["crop"])
+        self.canvas.emit.assert_called_once_with("edit-failed", "blur", "out of memory")
+
+    def test_new_image_cancels_blurs(self):
+        self.queue_blurs(1)
+        self.canvas.execute("crop")
+        self.canvas.scene = MagicMock()
+        self.canvas.history = MagicMock()
+        self.canvas.on_scene_changed = MagicMock()
+        self.canvas.set_base(MagicMock())
+        self.pipelines[0].cancel.assert_called_once()
+        self.assertEqual(self.canvas.pending_edits, [])
+        self.assertEqual(self.applied, [])
+
+
+class TestScene(unittest.TestCase):
+    def test_bounds(self):
+        style = scene.Style((1, 0, 0, 1), line_width=4)
+        arrow = scene.Shape('line', style, 10, 10, 50, 30)
+        self.assertEqual(arrow.get_bounds(), (7, 7, 46, 26))
+        stroke = scene.Stroke('pen', style, 0, 0)
+        stroke.add_point(20, 0)
+        self.assertEqual(scene.get_bounds_union(arrow.get_bounds(), stroke.get_bounds()), (-3, -3, 56, 36))
+
+    def test_hit_testing(self):
+        style = scene.Style((1, 0, 0, 1), line_width=2)
+        rectangle = scene.Shape('rectangle', style, 0, 0, 100, 100)
+        self.assertTrue(rectangle.contains(1, 50))
+        self.assertFalse(rectangle.contains(50, 50))
+        rectangle = rectangle.restyled(scene.Style((1, 0, 0, 1), line_width=2, fill=True))
+        self.assertTrue(rectangle.contains(50, 50))
+        line = scene.Shape('line', style, 0, 0, 100, 100)
+        self.assertTrue(line.contains(52, 50))
+        self.assertFalse(line.contains(80, 20))
+
+    def test_stroke_is_one_smoothed_path(self):
+        style = scene.Style((1, 0, 0, 1), line_width=2)
+        stroke = scene.Stroke('highlighter', style, 0, 0)
+        for point in [(10, 0), (20, 10), (30, 10)]:
+            stroke.add_point(*point)
+        cr = MagicMock()
+        stroke.draw(cr)
+        cr.stroke.assert_called_once_with()
+        self.assertEqual(cr.curve_to.call_count, 2)
+        # Ends on the last point
+        cr.line_to.assert_called_once_with(30, 10)
+        # Adding a point bends the previous curve too
+        self.assertEqual(stroke.get_tail_bounds(1), (8, -2, 24, 14))
+
+    def test_moved_is_a_copy(self):
+        style = scene.Style((1, 0, 0, 1))
+        stroke = scene.Stroke('pen', style, 0, 0)
+        stroke.add_point(10, 10)
+        moved = stroke.moved(5, 5)
+        self.assertEqual(stroke.points, [(0, 0), (10, 10)])
+        self.assertEqual(moved.points, [(5, 5), (15, 15)])
+
+    def test_find_topmost_selectable(self):
+        style = scene.Style((1, 0, 0, 1), line_width=2, fill=True)
+        the_scene = scene.Scene()
+        bottom = scene.Shape('rectangle', style, 0, 0, 100, 100)
+        top = scene.Shape('rectangle', style, 50, 50, 100, 100)
+        eraser = scene.Stroke('eraser', style, 60, 60)
+        eraser.add_point(70, 70)
+        the_scene.annotations = [bottom, top, eraser]
+        self.assertIs(the_scene.find(65, 65), top)
+        self.assertIs(the_scene.find(10, 10), bottom)
+        self.assertIsNone(the_scene.find(200, 200))
+
+
+class FakeImageSurface():
+    def __init__(self, width, height):
+        (self.width, self.height) = (width, height)
+        self.data = bytearray(width * height * 4)
+        self.dirty = None
+    def get_width(self): return self.width
+    def get_height(self): return self.height
+    def get_stride(self): return self.width * 4
+    def get_data(self): return self.data
+    def flush(self): pass
+    def mark_dirty_rectangle(self, *rectangle): self.dirty = rectangle
+
+
+class FakeImage():
+    def __init__(self, width, height, value):
+        self.size = (width, height)
+        self.pixels = bytes([value]) * (width * height * 4)
+    def tobytes(self): return self.pixels
+
+
+def make_pattern_surface(width, height):
+    # Every pixel different, opaque
+    surface = FakeImageSurface(width, height)
+    for i in range(width * height):
+        surface.data[i * 4:i * 4 + 4] = bytes([i % 251, (i * 7) % 253, (i * 13) % 255, 255])
+    return surface
+
+
+class RegionAssertions():
+    def assert_only_changed(self, before, surface, rectangle):
+        (x, y, w, h) = rectangle
+        stride = surface.get_stride()
+        for row in range(surface.get_height()):
+            start = row * stride
+            if y <= row < y + h:
+                self.assertEqual(surface.data[start:start + x * 4], before[start:start + x * 4])
+                self.assertEqual(surface.data[start + (x + w) * 4:start + stride],
+                                 before[start + (x + w) * 4:start + stride])
+                self.assertNotEqual(surface.data[start + x * 4:start + (x + w) * 4],
+                                    before[start + x * 4:start + (x + w) * 4])
+            else:
+                self.assertEqual(surface.data[start:start + stride], before[start:start + stride])
+
+
+class TestEffects(RegionAssertions, unittest.TestCase):
+    def test_clip_rectangle(self):
+        surface = FakeImageSurface(100, 50)
+        self.assertEqual(effects.clip_rectangle(surface, -10, 40, 30, 30), (0, 40, 20, 10))
+        self.assertEqual(effects.clip_rectangle(surface, 120, 0, 10, 10)[2], 0)
+
+    def test_block_rectangle(self):
+        surface = FakeImageSurface(100, 50)
+        # Grown to the 12px grid, clipped to the surface
+        self.assertEqual(effects.get_block_rectangle(surface, 13, 5, 20, 30, 12), (12, 0, 24, 36))
+        self.assertEqual(effects.get_block_rectangle(surface, 90, 40, 8, 5, 12), (84, 36, 16, 12))
+
+    def test_rows_view_is_not_a_copy(self):
+        surface = FakeImageSurface(10, 10)
+        data = memoryview(surface.get_data())
+        view = effects.get_rows_view(data, surface.get_stride(), 3, 2)
+        # Whole rows, as PIL reads h * stride bytes
+        self.assertEqual(len(view), 2 * surface.get_stride())
+        view[0] = 255
+        self.assertEqual(surface.data[3 * 40], 255)
+
+    @unittest.skipUnless(PIL_AVAILABLE, "PIL indisponível")
+    def test_blur_sub_rectangle(self):
+        surface = make_pattern_surface(64, 48)
+        before = bytes(surface.data)
+        effects.blur_region(surface, 10, 10, 20, 20, 3)
+        self.assertEqual(surface.dirty, (10, 10, 20, 20))
+        self.assert_only_changed(before, surface, (10, 10, 20, 20))
+
+    @unittest.skipUnless(PIL_AVAILABLE, "PIL indisponível")
+    def test_pixelate_sub_rectangle(self):
+        surface = make_pattern_surface(64, 48)
+        before = bytes(surface.data)
+        effects.pixelate_region(surface, 12, 8, 24, 16, 8)
+        self.assert_only_changed(before, surface, (12, 8, 24, 16))
+        # Every 8x8 block is a single colour
+        stride = surface.get_stride()
+        for (bx, by) in [(12, 8), (20, 8), (28, 16)]:
+            block = [bytes(surface.data[(by + row) * stride + (bx + col) * 4:(by + row) * stride + (bx + col + 1) * 4])
+                     for row in range(8) for col in range(8)]
+            self.assertEqual(len(set(block)), 1)
+
+    def test_write_region_rows(self):
+        surface = FakeImageSurface(10, 10)
+        # Write the middle of a 6x6 image, like a blur with a margin
+        effects.write_region(surface, FakeImage(6, 6, 7), 3, 4, 1, 1, 4, 2)
+        self.assertEqual(surface.dirty, (3, 4, 4, 2))
+        rows = [bytes(surface.data[row * 40:(row + 1) * 40]) for row in range(10)]
+        expected = bytes(12) + bytes([7]) * 16 + bytes(12)
+        self.assertEqual(rows[4], expected)
+        self.assertEqual(rows[5], expected)
+        self.assertEqual(rows[6], bytes(40))
+        self.assertEqual(sum(surface.data), 7 * 4 * 2 * 4)
+
+
+class RasterScene():
+    def __init__(self, base):
+        self.base = base
+    def set_base(self, base, damage=None):
+        self.base = base
+        return damage
+
+
+def copy_fake_surface(surface):
+    copy = FakeImageSurface(surface.get_width(), surface.get_height())
+    copy.data[:] = surface.data
+    return copy
+
+
+class TestPixelateCommand(RegionAssertions, unittest.TestCase):
+    @unittest.skipUnless(PIL_AVAILABLE, "PIL indisponível")
+    def test_pixelate_sub_rectangle(self):
+        base = make_pattern_surface(64, 48)
+        before = bytes(base.data)
+        scene = RasterScene(base)
+        with patch.object(history, "copy_surface", side_effect=copy_fake_surface), \
+             patch.object(effects.cairo, "ImageSurface", FakeImageSurface):
+            damage = history.PixelateCommand(12, 8, 24, 16, 8).apply(scene)
+        self.assertEqual(damage, (12, 8, 24, 16))
+        # The base is shared with the history, only the copy is pixelated
+        self.assertEqual(bytes(base.data), before)
+        self.assert_only_changed(before, scene.base, (12, 8, 24, 16))
+
+    def test_failure_is_reported(self):
+        widget = canvas.CanvasWidget()
+        (widget.start_x, widget.start_y, widget.last_x, widget.last_y) = (0, 0, 40, 40)
+        widget.get_pixelate_rectangle = MagicMock(return_value=(0, 0, 48, 48))
+        widget.apply_command = MagicMock(side_effect=ValueError("buffer is not large enough"))
+        widget.emit = MagicMock()
+        widget.apply_pixelate()
+        widget.emit.assert_called_once_with("edit-failed", "pixelate", "buffer is not large enough")
+
+
+class FakePixbuf():
+
+    def __init__(self, formats=("png", "jpeg")):
+        self.formats = formats
+        self.saved = []
+
+    def save_to_bufferv(self, fmt, keys, values):
+        if fmt not in self.formats:
+            raise Exception("Unsupported format %s" % fmt)
+        self.saved.append((fmt, keys, values))
+        return (True, fmt.encode())
+
+class FlatPixbuf(FakePixbuf):
+    # Opaque RGBA pixels, in a few colours, with padded rows
+    def __init__(self, width, height, colors):
+        super().__init__()
+        (self.width, self.height) = (width, height)
+        self.rowstride = width * 4 + 8
+        self.pixels = bytearray(self.rowstride * height)
+        for y in range(height):
+            for x in range(width):
+                offset = y * self.rowstride + x * 4
+                self.pixels[offset:offset + 4] = bytes(colors[(x // 4 + y) % len(colors)]) + b"\xff"
+    def get_has_alpha(self): return True
+    def get_width(self): return self.width
+    def get_height(self): return self.height
+    def get_rowstride(self): return self.rowstride
+    def read_pixel_bytes(self):
+        return MagicMock(get_data=MagicMock(return_value=bytes(self.pixels)))
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_atomically(self):
+        path = os.path.join(self.directory, "shot.png")
+        with open(path, "wb") as f:
+            f.write(b"old")
+        writer.write_atomically(path, b"new")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertEqual(os.listdir(self.directory), ["shot.png"])
+
+    def test_failed_write_leaves_no_temp_file(self):
+        path = os.path.join(self.directory, "missing", "shot.png")
+        with self.assertRaises(OSError):
+            writer.write_atomically(path, b"data")
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_write_job(self):
+        pixbuf = FakePixbuf()
+        path = os.path.join(self.directory, "shot.jpg")
+        self.assertEqual(writer.Writer().write(writer.SaveJob(pixbuf, path, "jpeg")), path)
+        self.assertEqual(pixbuf.saved, [("jpeg", ["quality"], ["90"])])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"jpeg")
+
+    def test_webp_falls_back_to_png(self):
+        path = os.path.join(self.directory, "shot.webp")
+        saved_path = writer.Writer().write(writer.SaveJob(FakePixbuf(), path, "webp"))
+        self.assertEqual(saved_path, os.path.join(self.directory, "shot.png"))
+        self.assertEqual(os.listdir(self.directory), ["shot.png"])
+
+    def test_save_profiles(self):
+        self.assertEqual(writer.get_save_options("png", "fastest"), (["compression"], ["1"]))
+        self.assertEqual(writer.get_save_options("png", "smallest"), (["compression"], ["9"]))
+        self.assertEqual(writer.get_save_options("webp", "smallest"), (["quality"], ["80"]))
+        # Unknown profiles are balanced
+        self.assertEqual(writer.get_save_options("jpeg", "unknown"), (["quality"], ["90"]))
+
+    def test_palette_only_for_smallest_png(self):
+        pixbuf = FakePixbuf()
+        with patch.object(writer, "encode_palette_png", return_value=b"palette") as encode_palette:
+            self.assertEqual(writer.encode(pixbuf, "png", "balanced"), b"png")
+            self.assertEqual(writer.encode(pixbuf, "jpeg", "smallest"), b"jpeg")
+            encode_palette.assert_not_called()
+            self.assertEqual(writer.encode(pixbuf, "png", "smallest"), b"palette")
+        # Too many colours for a palette
+        with patch.object(writer, "encode_palette_png", return_value=None):
+            self.assertEqual(writer.encode(pixbuf, "png", "smallest"), b"png")
+        self.assertEqual(pixbuf.saved[-1], ("png", ["compression"], ["9"]))
+
+    @unittest.skipUnless(PIL_AVAILABLE, "PIL indisponível")
+    def test_palette_png(self):
+        import io
+        import PIL.Image
+        colors = [(255, 255, 255), (30, 30, 30), (53, 132, 228)]
+        pixbuf = FlatPixbuf(20, 10, colors)
+        data = writer.encode(pixbuf, "png", "smallest")
+        # Not the GdkPixbuf path
+        self.assertEqual(pixbuf.saved, [])
+        image = PIL.Image.open(io.BytesIO(data))
+        self.assertEqual(image.mode, "P")
+        self.assertEqual(image.convert("RGBA").tobytes(),
+                         PIL.Image.frombuffer("RGBA", (20, 10), bytes(pixbuf.pixels), "raw", "RGBA",
+                                              pixbuf.rowstride, 1).tobytes())
+
+    def test_headless_webp_falls_back_like_the_editor(self):
+        path = os.path.join(self.directory, "shot.webp")
+        self.assertEqual(headless.save(FakePixbuf(), path, "webp"), os.path.join(self.directory, "shot.png"))
+        self.assertEqual(os.listdir(self.directory), ["shot.png"])
+
+    def test_palette_failure_falls_back(self):
+        pixbuf = FakePixbuf()
+        with patch.object(writer, "encode_palette_png", side_effect=AttributeError("Dither")):
+            self.assertEqual(writer.encode(pixbuf, "png", "smallest"), b"png")
+
+    def test_queue_is_processed_in_order(self):
+        queued = writer.Writer()
+        written = []
+        with patch.object(writer.Writer, "write", side_effect=lambda job: written.append(job.path)):
+            for name in ["a.png", "b.png", "c.png"]:
+                queued.save(FakePixbuf(), os.path.join(self.directory, name), "png")
+            queued.wait()
+        self.assertEqual([os.path.basename(path) for path in written], ["a.png", "b.png", "c.png"])
+
 class TestCanvasLogic(unittest.TestCase):
     def setUp(self):
         # canvas.CanvasWidget inherits from what canvas.Gtk.DrawingArea resolved to
@@ -99,6 +852,29 @@ class TestCanvasLogic(unittest.TestCase):
         self.canvas.current_tool = 'highlighter'
         self.assertEqual(self.canvas.current_tool, 'highlighter')
 
+    def test_damage_in_view_coordinates(self):
+        self.canvas.queue_draw_area = MagicMock()
+        self.canvas.view_scale = 0.5
+        self.canvas.queue_image_area((11, 20.5, 30, 10))
+        # Rounded outwards
+        self.canvas.queue_draw_area.assert_called_once_with(5, 10, 16, 6)
+        self.canvas.queue_draw_area.reset_mock()
+        self.canvas.queue_image_area((10, 10, 0, 5))
+        self.canvas.queue_draw_area.assert_not_called()
+
+    def test_draw_skips_undamaged_selection(self):
+        self.canvas.view_scale = 1
+        self.canvas.selection = MagicMock()
+        self.canvas.selection.get_bounds.return_value = (500, 500, 10, 10)
+        self.canvas.draw_selection = MagicMock()
+        cr = MagicMock()
+        cr.clip_extents.return_value = (0, 0, 100, 100)
+        self.canvas.on_draw(self.canvas, cr)
+        self.canvas.draw_selection.assert_not_called()
+        cr.clip_extents.return_value = (450, 450, 550, 550)
+        self.canvas.on_draw(self.canvas, cr)
+        self.canvas.draw_selection.assert_called_once_with(cr)
+
 class TestClickyCLI(unittest.TestCase):
     def test_cli_parsing_area(self):
         """Test that command line options set the correct internal mode."""
@@ -134,5 +910,50 @@ class TestClickyCLI(unittest.TestCase):
         
         self.assertEqual(app.cli_mode, "screen")
 
+    def test_cli_headless_capture(self):
+        """An output flag captures without activating (no main window)."""
+        app = clicky.MyApplication("org.x.clicky", 0)
+        cmd_line = MagicMock()
+        options = MagicMock()
+        options.contains.side_effect = lambda x: x in ("screen", "clipboard")
+        cmd_line.get_options_dict.return_value = options
+        app.activate = MagicMock()
+
+        # clicky imports headless lazily, and the module mocks above are gone by now
+        with patch.dict('sys.modules', {'headless': headless}), \
+             patch.object(headless, "run", return_value=0) as run:
+            self.assertEqual(app.do_command_line(cmd_line), 0)
+
+        app.activate.assert_not_called()
+        (settings, mode, path, clipboard, stdout) = run.call_args[0]
+        self.assertEqual((mode, path, clipboard, stdout), ("screen", None, True, None))
+
+    def test_resident_capture_does_not_block(self):
+        app = clicky.MyApplication("org.x.clicky", 0)
+        app.get_settings = MagicMock()
+        done = threading.Event()
+        app.return_capture_result = MagicMock(side_effect=lambda *args: done.set())
+        invocation = MagicMock()
+        parameters = MagicMock()
+        parameters.unpack.return_value = ("screen", {"file": "/tmp/shot.png"})
+        release = threading.Event()
+        def run(*args):
+            # The D-Bus handler has returned while the capture runs
+            self.assertTrue(release.wait(5))
+            return 0
+        with patch.dict('sys.modules', {'headless': headless}), \
+             patch.object(headless, "run", side_effect=run):
+            app.on_capture_method_call(None, None, None, None, "Capture", parameters, invocation)
+            invocation.return_value.assert_not_called()
+            release.set()
+            self.assertTrue(done.wait(5))
+        app.return_capture_result.assert_called_once_with(invocation, True, "/tmp/shot.png")
+
+    def test_headless_save_format(self):
+        self.assertEqual(headless.get_save_format("/tmp/shot.JPG"), "jpeg")
+        self.assertEqual(headless.get_save_format("/tmp/shot.webp"), "webp")
+        self.assertEqual(headless.get_save_format("/tmp/shot", "jpg"), "jpeg")
+        self.assertEqual(headless.get_save_format("/tmp/shot.bmp"), "png")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import unittest
+
+LIB_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../usr/lib/clicky"))
+
+# Cumulative time allowed for `import clicky`, in microseconds
+IMPORT_BUDGET_US = 1500000
+
+# Modules which must only be loaded on first use
+LAZY_MODULES = ["shortcuts", "recorder", "canvas", "PIL", "Xlib", "dbus", "gi.repository.GSound", "gi.repository.GdkX11"]
+
+DEPS_AVAILABLE = False
+try:
+    import gi
+    gi.require_version("Gtk", "3.0")
+    gi.require_version("XApp", "1.0")
+    import setproctitle
+    DEPS_AVAILABLE = True
+except Exception:
+    DEPS_AVAILABLE = False
+
+
+def import_times(module):
+    """Return {module: cumulative import time in us} from python -X importtime."""
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                            capture_output=True, text=True, env=env, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        (self_us, cumulative_us, name) = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+
+class TestStartup(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if DEPS_AVAILABLE:
+            cls.times = import_times("clicky")
+
+    @unittest.skipUnless(DEPS_AVAILABLE, "GTK/XApp indisponível")
+    def test_heavy_modules_are_lazy(self):
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, self.times, "%s is imported at startup" % name)
+
+    @unittest.skipUnless(DEPS_AVAILABLE, "GTK/XApp indisponível")
+    def test_import_budget(self):
+        self.assertLess(self.times["clicky"], IMPORT_BUDGET_US,
+                        "import clicky took %.0f ms" % (self.times["clicky"] / 1000))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,29 @@
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk, GdkPixbuf
+from gi.repository import Gtk, Gdk, GdkPixbuf, GObject
 import cairo
 import math
-from gi.repository import Pango, PangoCairo
-from PIL import Image, ImageFilter
-import sys
-import ctypes
+import traceback
+import effects
+from history import History, AddCommand, ReplaceCommand, BlurCommand, PixelateCommand, CropCommand, copy_surface
+from scene import Scene, Style, Stroke, Shape, Text, get_bounds_union, bounds_intersect, bounds_contain
+from pipeline import Pipeline
+
+# While dragging, the blur is previewed at this fraction of the image
+# resolution. The preview covers the selection plus a margin, so it can be
+# reused while the selection changes within it.
+BLUR_PREVIEW_SCALE = 0.25
+BLUR_PREVIEW_MARGIN = 64
 
 class CanvasWidget(Gtk.DrawingArea):
+
+    __gsignals__ = {
+        # Emitted when undo/redo availability may have changed
+        "history-changed": (GObject.SignalFlags.RUN_LAST, None, ()),
+        # Emitted with the tool and the error when an edit couldn't be done
+        "edit-failed": (GObject.SignalFlags.RUN_LAST, None, (str, str)),
+    }
+
     def __init__(self):
         super().__init__()
         self.set_events(Gdk.EventMask.BUTTON_PRESS_MASK |
@@ -20,35 +35,116 @@ class CanvasWidget(Gtk.DrawingArea):
         self.connect("button-release-event", self.on_button_release)
         self.connect("size-allocate", self.on_size_allocate)
 
-        self.surface = None
-        self.image_surface = None
+        # The capture and the annotations drawn over it
+        self.scene = Scene()
         self.original_pixbuf = None
+
+        # The surface holds the image at full resolution; it is shown scaled
+        # by view_scale. Event coordinates are converted to image pixels.
+        self.view_scale = 1.0
+
+        # Every edit is a command, recorded for undo/redo
+        self.history = History()
+        self.current_stroke = None
+        # Points received since the stroke was last drawn, which happens
+        # once per frame, from a frame clock tick callback
+        self.pending_points = 0
+        self.tick_id = None
+
+        # Annotation picked with the select tool, and where it was grabbed
+        self.selection = None
+        self.selection_origin = None
         
-        # Tools: 'pen', 'highlighter', 'rectangle', 'circle', 'line', 'arrow', 'crop'
+        # Tools: 'select', 'pen', 'highlighter', 'rectangle', 'circle', 'line', 'arrow', 'crop'
         self.current_tool = 'pen' 
         self.is_drawing = False
         self.start_x = 0
         self.start_y = 0
         self.last_x = 0
         self.last_y = 0
+        # Image area covered by the overlay last time it was drawn
+        self.overlay_bounds = None
+        # Pixelated (x, y, width, height) area and its pixels, shown while dragging
+        self.pixelate_preview = None
+        # (base, area, reduced resolution blurred tile) and the part of the
+        # area shown, while dragging and until the final blur is done
+        self.blur_preview = None
+        self.blur_selection = None
+        # Edits asked for while a final blur is computed in a worker thread,
+        # as (tool, function) in order, the first one being that blur
+        self.pending_edits = []
+        self.blur_pipeline = None
 
         # Styles
         self.stroke_color = Gdk.RGBA(1, 0, 0, 1) # Default Red
         self.line_width = 3
         self.fill_active = False
         self.opacity = 1.0
+        self.blur_radius = effects.BLUR_RADIUS
+        self.pixelate_size = effects.PIXELATE_SIZE
+
+    # The composite image, as shown and saved
+    @property
+    def surface(self):
+        return self.scene.surface
 
     def set_stroke_color(self, rgba):
         self.stroke_color = rgba
+        self.restyle_selection()
         
     def set_line_width(self, width):
         self.line_width = width
+        self.restyle_selection()
         
     def set_fill_active(self, active):
         self.fill_active = active
+        self.restyle_selection()
         
     def set_opacity(self, opacity):
         self.opacity = opacity
+        self.restyle_selection()
+
+    def set_blur_radius(self, radius):
+        self.blur_radius = radius
+
+    def set_tool(self, tool):
+        self.current_tool = tool
+        if tool != 'select':
+            self.select(None)
+
+    def get_style(self):
+        return Style(self.stroke_color, self.opacity, self.get_image_line_width(), self.fill_active)
+
+    def to_image_coords(self, x, y):
+        return (x / self.view_scale, y / self.view_scale)
+
+    # Line widths are picked on screen, keep them visually the same whatever
+    # the preview scale is.
+    def get_image_line_width(self):
+        return self.line_width / self.view_scale
+
+    def set_view_size_request(self, width, height):
+        self.set_size_request(int(width * self.view_scale), int(height * self.view_scale))
+
+    def queue_image_area(self, bounds):
+        """Redraw an (x, y, width, height) area given in image pixels, or
+        everything if bounds is None."""
+        if bounds is None:
+            self.queue_draw()
+            return
+        (x, y, w, h) = bounds
+        left = math.floor(x * self.view_scale)
+        top = math.floor(y * self.view_scale)
+        right = math.ceil((x + w) * self.view_scale)
+        bottom = math.ceil((y + h) * self.view_scale)
+        if right > left and bottom > top:
+            self.queue_draw_area(left, top, right - left, bottom - top)
+
+    def get_outline_bounds(self, bounds):
+        # Room for the 1px outlines drawn around selections
+        (x, y, w, h) = bounds
+        padding = 2 / self.view_scale
+        return (x - padding, y - padding, w + 2 * padding, h + 2 * padding)
 
     def set_text_entry(self, entry, overlay):
         self.text_entry = entry
@@ -70,120 +166,191 @@ class CanvasWidget(Gtk.DrawingArea):
         return False
         
     def commit_text(self, text):
-        cr = cairo.Context(self.surface)
-        self.apply_style(cr)
-        
-        # Adjust position to baseline (approx)
-        # Entry widget has height, text baseline is usually middle-ish.
-        # Let's verify start_x, start_y
-        
-        layout = PangoCairo.create_layout(cr)
-        layout.set_text(text, -1)
-        
-        desc = Pango.FontDescription("Sans Bold 20")
-        desc.set_size(int(self.line_width * 10 * Pango.SCALE)) # Scale font with line width?
-        # Or fixed size? Or separate font size control?
-        # For now, let's use line_width as a proxy or fixed.
-        # let's use a reasonable size.
-        desc.set_absolute_size(20 * Pango.SCALE + self.line_width * Pango.SCALE)
-        layout.set_font_description(desc)
-        
-        cr.move_to(self.start_x, self.start_y)
-        PangoCairo.show_layout(cr, layout)
-        
-        self.queue_draw()
+        # Scale the font with the line width
+        font_size = (20 + self.line_width) / self.view_scale
+        self.execute(AddCommand(Text(text, self.get_style(), self.start_x, self.start_y, font_size)))
 
-    def set_pixbuf(self, pixbuf):
-        self.original_pixbuf = pixbuf
-        if pixbuf is None:
+    def execute(self, command, tool=None):
+        """Apply an edit to the scene and record it in the history, once the
+        blurs asked for before it are done."""
+        self.queue_edit(tool, lambda: self.apply_command(command))
+
+    def apply_command(self, command):
+        damage = command.apply(self.scene)
+        self.history.push(command, self.scene)
+        self.on_scene_changed(damage)
+
+    def apply_checked(self, command, tool):
+        try:
+            self.apply_command(command)
+        except Exception as e:
+            print(traceback.format_exc())
+            # The content is still there, the user must know
+            self.emit("edit-failed", tool, str(e))
+
+    def queue_edit(self, tool, edit):
+        """Call edit() after the edits asked for before it, right away if
+        there are none. An edit which returns a Pipeline holds the next ones
+        back until finish_edit() is called, the main loop is never blocked."""
+        self.pending_edits.append((tool, edit))
+        if len(self.pending_edits) == 1:
+            self.run_edits()
+
+    def run_edits(self):
+        while len(self.pending_edits) > 0:
+            (tool, edit) = self.pending_edits[0]
+            try:
+                self.blur_pipeline = edit()
+            except Exception:
+                print(traceback.format_exc())
+                self.blur_pipeline = None
+            if self.blur_pipeline is not None:
+                return
+            self.pending_edits.pop(0)
+        self.end_blur_preview()
+
+    def finish_edit(self):
+        self.blur_pipeline = None
+        self.pending_edits.pop(0)
+        self.run_edits()
+
+    def can_start_edit(self):
+        # Queued edits are done on the scene as it will be by then, which
+        # only blurs and pixelations don't care about
+        tools = ['blur', 'pixelate']
+        if len(self.pending_edits) == 0:
+            return True
+        return self.current_tool in tools and all(tool in tools for (tool, edit) in self.pending_edits)
+
+    def on_scene_changed(self, damage=None):
+        # Crops and their undoing change the size
+        (width, height) = (self.scene.get_width(), self.scene.get_height())
+        if self.get_size_request() != (int(width * self.view_scale), int(height * self.view_scale)):
+            self.set_view_size_request(width, height)
+            damage = None
+        self.queue_image_area(damage)
+        self.emit("history-changed")
+
+    def undo(self):
+        if self.is_drawing:
             return
+        self.queue_edit("undo", self.apply_undo)
 
-        width = pixbuf.get_width()
-        height = pixbuf.get_height()
-        self.set_size_request(width, height)
+    def apply_undo(self):
+        self.select(None)
+        if self.history.undo(self.scene):
+            self.on_scene_changed()
 
-        if self.surface is None or self.surface.get_width() != width or self.surface.get_height() != height:
-            self.create_surface(width, height)
+    def redo(self):
+        if self.is_drawing:
+            return
+        self.queue_edit("redo", self.apply_redo)
+
+    def apply_redo(self):
+        self.select(None)
+        damage = self.history.redo(self.scene)
+        if damage is not False:
+            self.on_scene_changed(damage)
+
+    def select(self, annotation):
+        for selection in (self.selection, annotation):
+            if selection is not None:
+                self.queue_image_area(self.get_outline_bounds(selection.get_bounds()))
+        self.selection = annotation
+
+    def restyle_selection(self):
+        if self.selection is None:
+            return
+        restyled = self.selection.restyled(self.get_style())
+        self.execute(ReplaceCommand(self.selection, restyled))
+        self.select(restyled)
+
+    def set_pixbuf(self, pixbuf, view_scale=1.0):
+        self.original_pixbuf = pixbuf
+        self.view_scale = view_scale
+        if pixbuf is None:
+            return
 
-        self.redraw_canvas()
-        self.queue_draw()
+        self.set_base(self.create_base(pixbuf.get_width(), pixbuf.get_height(), pixbuf))
 
     def on_size_allocate(self, widget, allocation):
-        if self.surface is None:
-             self.create_surface(allocation.width, allocation.height)
-             self.redraw_canvas()
-        elif self.surface.get_width() < allocation.width or self.surface.get_height() < allocation.height:
-             # Expand surface without wiping
-             old_surface = self.surface
-             width = max(allocation.width, old_surface.get_width())
-             height = max(allocation.height, old_surface.get_height())
-             
-             self.create_surface(width, height)
-             cr = cairo.Context(self.surface)
-             cr.set_source_surface(old_surface, 0, 0)
-             cr.paint()
-
-    def create_surface(self, width, height):
-        window = self.get_window()
-        if window is not None:
-            self.surface = window.create_similar_surface(
-                cairo.CONTENT_COLOR_ALPHA, width, height)
-        else:
-            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        
-        # Clear surface
-        cr = cairo.Context(self.surface)
+        if self.scene.base is None:
+            # Something to draw on until an image is set
+            alloc_width = int(allocation.width / self.view_scale)
+            alloc_height = int(allocation.height / self.view_scale)
+            self.scene.set_base(self.create_base(max(alloc_width, 1), max(alloc_height, 1)))
+            self.history.reset(self.scene)
+
+    def create_base(self, width, height, pixbuf=None):
+        base = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        cr = cairo.Context(base)
         cr.set_source_rgba(0.2, 0.2, 0.2, 1) # Dark gray background
         cr.paint()
-
-    def redraw_canvas(self):
-        if self.surface is None: 
-            return
-            
-        cr = cairo.Context(self.surface)
-        
-        # 1. Clear text/drawings
-        cr.set_source_rgba(0.2, 0.2, 0.2, 1)
-        cr.paint()
-        
-        # 2. Draw Image
-        if self.original_pixbuf:
-            Gdk.cairo_set_source_pixbuf(cr, self.original_pixbuf, 0, 0)
+        if pixbuf is not None:
+            Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
             cr.paint()
-            
-        # If we had a history of paths, we would redraw them here.
-        # For this simple "paint on surface" implementation, we just clear and paste image.
-        # A more complex one would keep strokes in a list. 
-        # For MVP: drawings are destructive on the surface? 
-        # No, let's keep a separate "drawing layer" if possible, or just paint fast.
-        # Decision: "Paint on top" architecture. Resetting pixbuf clears drawings.
-        pass
+        return base
+
+    def set_base(self, base):
+        # A new image starts a new scene and a new history
+        if self.blur_pipeline is not None:
+            self.blur_pipeline.cancel()
+        self.blur_pipeline = None
+        self.pending_edits = []
+        self.blur_preview = None
+        self.blur_selection = None
+        self.select(None)
+        self.scene.annotations = []
+        self.scene.set_base(base)
+        self.history.reset(self.scene)
+        self.on_scene_changed()
 
     def on_draw(self, widget, cr):
+        cr.scale(self.view_scale, self.view_scale)
+
+        # GTK clipped cr to the damaged area, what lies outside is skipped
+        (x1, y1, x2, y2) = cr.clip_extents()
+        damage = (x1, y1, x2 - x1, y2 - y1)
+
         # 1. Draw the permanent surface (Image + Committed Drawings)
         if self.surface:
             cr.set_source_surface(self.surface, 0, 0)
             cr.paint()
+
+        if self.blur_selection is not None and bounds_intersect(self.blur_selection, damage):
+            self.draw_blur_preview(cr)
             
         # 2. Draw the transient overlay (Shape being dragged / Crop selection)
-        if self.is_drawing and self.current_tool in ['rectangle', 'circle', 'line', 'arrow', 'crop']:
-            self.draw_overlay(cr)
+        if self.is_drawing and self.current_tool in ['rectangle', 'circle', 'line', 'arrow', 'crop', 'pixelate', 'blur']:
+            # The crop overlay dims the whole image
+            bounds = self.get_overlay_bounds() if self.current_tool != 'crop' else damage
+            if bounds is not None and bounds_intersect(bounds, damage):
+                self.draw_overlay(cr)
+
+        if self.selection is not None and bounds_intersect(self.get_outline_bounds(self.selection.get_bounds()), damage):
+            self.draw_selection(cr)
             
         return False
 
     def on_button_press(self, widget, event):
         if event.button == 1 and self.surface:
+            if not self.can_start_edit():
+                return
             self.is_drawing = True
+            (x, y) = self.to_image_coords(event.x, event.y)
             
             # Start point
-            self.start_x = event.x
-            self.start_y = event.y
-            self.last_x = event.x
-            self.last_y = event.y
+            self.start_x = x
+            self.start_y = y
+            self.last_x = x
+            self.last_y = y
             
             # For Pen/Highlighter, we start drawing immediately
             if self.current_tool in ['pen', 'highlighter', 'eraser']:
-                pass # Handled in motion
+                self.start_stroke(x, y)
+            elif self.current_tool == 'select':
+                self.select(self.scene.find(x, y))
+                self.selection_origin = self.selection
             elif self.current_tool == 'text':
                 self.text_entry.set_halign(Gtk.Align.START)
                 self.text_entry.set_valign(Gtk.Align.START)
@@ -197,59 +364,79 @@ class CanvasWidget(Gtk.DrawingArea):
         return True
 
     def on_motion_notify(self, widget, event):
-        self.last_x = event.x
-        self.last_y = event.y
+        (x, y) = self.to_image_coords(event.x, event.y)
+        self.last_x = x
+        self.last_y = y
 
         if self.is_drawing:
-            if self.current_tool in ['pen', 'highlighter', 'eraser'] and self.surface:
-                self.draw_stroke(event.x, event.y)
-                # Update start for next segment
-                self.start_x = event.x
-                self.start_y = event.y
-            elif self.current_tool in ['rectangle', 'circle', 'line', 'arrow', 'crop']:
-                # Queue draw to update overlay
-                self.queue_draw()
+            if self.current_tool in ['pen', 'highlighter', 'eraser'] and self.current_stroke:
+                self.current_stroke.add_point(x, y)
+                self.pending_points += 1
+            elif self.current_tool == 'select' and self.selection is not None:
+                self.move_selection(x, y)
+            elif self.current_tool in ['rectangle', 'circle', 'line', 'arrow', 'crop', 'pixelate', 'blur']:
+                if self.current_tool == 'pixelate':
+                    self.update_pixelate_preview()
+                elif self.current_tool == 'blur':
+                    self.update_blur_preview()
+                # Redraw where the overlay was and where it is now
+                bounds = self.get_overlay_bounds()
+                if self.overlay_bounds is None and self.current_tool == 'crop':
+                    # The whole image gets dimmed
+                    self.queue_draw()
+                else:
+                    self.queue_image_area(get_bounds_union(self.overlay_bounds, bounds))
+                self.overlay_bounds = bounds
                 
         return True
 
     def on_button_release(self, widget, event):
         if event.button == 1 and self.is_drawing:
             self.is_drawing = False
+            (x, y) = self.to_image_coords(event.x, event.y)
+
+            # Remove the overlay
+            if self.overlay_bounds is not None:
+                self.queue_image_area(None if self.current_tool == 'crop' else self.overlay_bounds)
+                self.overlay_bounds = None
             
             if self.current_tool in ['rectangle', 'circle', 'line', 'arrow']:
-                self.commit_shape(event.x, event.y)
+                self.commit_shape(x, y)
             elif self.current_tool == 'crop':
-                self.apply_crop(event.x, event.y)
+                self.apply_crop(x, y)
             elif self.current_tool == 'blur':
-                self.apply_blur(event.x, event.y)
-            elif self.current_tool in ['pen', 'highlighter', 'eraser']:
-                self.draw_stroke(event.x, event.y) # Final segment
+                self.apply_blur(x, y)
+            elif self.current_tool == 'pixelate':
+                self.apply_pixelate()
+            elif self.current_tool in ['pen', 'highlighter', 'eraser'] and self.current_stroke:
+                self.finish_stroke(x, y)
+            elif self.current_tool == 'select' and self.selection is not self.selection_origin:
+                # Moved live, only record it
+                self.history.push(ReplaceCommand(self.selection_origin, self.selection), self.scene)
+                self.emit("history-changed")
         return True
 
-    def apply_style(self, cr):
-        color = self.stroke_color
-        cr.set_source_rgba(color.red, color.green, color.blue, color.alpha * self.opacity)
-        cr.set_line_width(self.line_width)
-        cr.set_line_cap(cairo.LINE_CAP_ROUND)
-        cr.set_line_join(cairo.LINE_JOIN_ROUND)
+    def get_shape_operation(self, end_x, end_y):
+        arrow_length = (10 + self.line_width * 2) / self.view_scale
+        return Shape(self.current_tool, self.get_style(),
+                              self.start_x, self.start_y, end_x, end_y, arrow_length)
 
-    def draw_arrow(self, cr, x1, y1, x2, y2):
-        cr.move_to(x1, y1)
-        cr.line_to(x2, y2)
-        cr.stroke()
-        
-        # Arrow head
-        angle = math.atan2(y2 - y1, x2 - x1)
-        arrow_len = 10 + self.line_width * 2
-        arrow_angle = math.pi / 6
-        
-        cr.move_to(x2, y2)
-        cr.line_to(x2 - arrow_len * math.cos(angle - arrow_angle),
-                   y2 - arrow_len * math.sin(angle - arrow_angle))
-        cr.move_to(x2, y2)
-        cr.line_to(x2 - arrow_len * math.cos(angle + arrow_angle),
-                   y2 - arrow_len * math.sin(angle + arrow_angle))
-        cr.stroke()
+    def get_overlay_bounds(self):
+        if self.current_tool == 'blur':
+            if self.blur_selection is None:
+                return None
+            return self.get_outline_bounds(self.blur_selection)
+        if self.current_tool == 'pixelate':
+            if self.pixelate_preview is None:
+                return None
+            return self.get_outline_bounds(self.pixelate_preview[0])
+        if self.current_tool == 'crop':
+            x = min(self.start_x, self.last_x)
+            y = min(self.start_y, self.last_y)
+            w = abs(self.start_x - self.last_x)
+            h = abs(self.start_y - self.last_y)
+            return self.get_outline_bounds((x, y, w, h))
+        return self.get_shape_operation(self.last_x, self.last_y).get_bounds()
 
     def draw_overlay(self, cr):
         # Draw the shape currently being defined by start_x,y -> last_x,y
@@ -259,99 +446,54 @@ class CanvasWidget(Gtk.DrawingArea):
         h = abs(self.start_y - self.last_y)
         
         if self.current_tool == 'crop':
-            # Dim everything
+            # Dim everything but the selection
             cr.set_source_rgba(0, 0, 0, 0.5)
-            cr.paint()
-            
-            # Clear the selection
-            cr.set_operator(cairo.OPERATOR_SOURCE)
-            cr.set_source_rgba(0, 0, 0, 0) # Transparent
+            cr.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+            cr.rectangle(0, 0, self.scene.get_width(), self.scene.get_height())
             cr.rectangle(x, y, w, h)
             cr.fill()
-            
-            # Restore operator
-            cr.set_operator(cairo.OPERATOR_OVER)
+            cr.set_fill_rule(cairo.FILL_RULE_WINDING)
             
             # White Border
             cr.set_source_rgba(1, 1, 1, 1)
-            cr.set_line_width(1)
-            cr.set_dash([4.0, 4.0], 0)
+            cr.set_line_width(1 / self.view_scale)
+            cr.set_dash([4.0 / self.view_scale, 4.0 / self.view_scale], 0)
             cr.rectangle(x, y, w, h)
             cr.stroke()
             cr.stroke()
             return
             
-        if self.current_tool == 'blur':
-            cr.set_source_rgba(0.5, 0.5, 0.5, 0.3)
+        if self.current_tool == 'pixelate':
+            if self.pixelate_preview is None:
+                return
+            ((x, y, w, h), tile) = self.pixelate_preview
+            cr.save()
             cr.rectangle(x, y, w, h)
-            cr.fill()
+            cr.clip()
+            cr.set_source_surface(tile, x, y)
+            cr.paint()
+            # What the final result will look like, annotations included
+            self.scene.draw_annotations(cr, (x, y, w, h))
+            cr.restore()
             cr.set_source_rgba(1, 1, 1, 0.5)
-            cr.set_line_width(1)
+            cr.set_line_width(1 / self.view_scale)
             cr.rectangle(x, y, w, h)
             cr.stroke()
             return
 
-        self.apply_style(cr)
-            
-        if self.current_tool == 'rectangle':
+        if self.current_tool == 'blur':
+            # The preview itself is drawn by draw_blur_preview()
+            cr.set_source_rgba(1, 1, 1, 0.5)
+            cr.set_line_width(1 / self.view_scale)
             cr.rectangle(x, y, w, h)
-            if self.fill_active:
-                cr.fill_preserve()
-            cr.stroke()
-            
-        elif self.current_tool == 'circle':
-            cr.save()
-            cr.translate(x + w/2, y + h/2)
-            cr.scale(w/2, h/2)
-            cr.arc(0, 0, 1, 0, 2 * math.pi)
-            cr.restore()
-            if self.fill_active:
-                cr.fill_preserve()
-            cr.stroke()
-
-        elif self.current_tool == 'line':
-            cr.move_to(self.start_x, self.start_y)
-            cr.line_to(self.last_x, self.last_y)
             cr.stroke()
+            return
 
-        elif self.current_tool == 'arrow':
-            self.draw_arrow(cr, self.start_x, self.start_y, self.last_x, self.last_y)
+        self.get_shape_operation(self.last_x, self.last_y).draw(cr)
 
     def commit_shape(self, end_x, end_y):
         # Commit the shape to the permanent surface
-        cr = cairo.Context(self.surface)
-        x = min(self.start_x, end_x)
-        y = min(self.start_y, end_y)
-        w = abs(self.start_x - end_x)
-        h = abs(self.start_y - end_y)
-        
-        self.apply_style(cr)
-        
-        if self.current_tool == 'rectangle':
-            cr.rectangle(x, y, w, h)
-            if self.fill_active:
-                cr.fill_preserve()
-            cr.stroke()
-            
-        elif self.current_tool == 'circle':
-            cr.save()
-            cr.translate(x + w/2, y + h/2)
-            cr.scale(w/2, h/2)
-            cr.arc(0, 0, 1, 0, 2 * math.pi)
-            cr.restore()
-            if self.fill_active:
-                cr.fill_preserve()
-            cr.stroke()
-
-        elif self.current_tool == 'line':
-            cr.move_to(self.start_x, self.start_y)
-            cr.line_to(end_x, end_y)
-            cr.stroke()
-
-        elif self.current_tool == 'arrow':
-            self.draw_arrow(cr, self.start_x, self.start_y, end_x, end_y)
-            
-        self.queue_draw()
+        self.execute(AddCommand(self.get_shape_operation(end_x, end_y)))
 
     def apply_crop(self, end_x, end_y):
         x = int(min(self.start_x, end_x))
@@ -360,105 +502,179 @@ class CanvasWidget(Gtk.DrawingArea):
         h = int(abs(self.start_y - end_y))
         
         if w < 10 or h < 10: return # Ignore tiny crops
-        
-        # Create new surface with cropped size
-        new_surface = self.get_window().create_similar_surface(
-            cairo.CONTENT_COLOR_ALPHA, w, h)
-            
-        cr = cairo.Context(new_surface)
-        cr.set_source_surface(self.surface, -x, -y)
-        cr.paint()
-        
-        self.surface = new_surface
-        self.set_size_request(w, h)
-        self.queue_draw()
-        
+
+        self.execute(CropCommand(x, y, w, h))
+
         # We should notify parent to resize window? 
         # For now, size request handles widget size, window might stay large.
 
+    def get_pixelate_rectangle(self):
+        x = min(self.start_x, self.last_x)
+        y = min(self.start_y, self.last_y)
+        w = abs(self.start_x - self.last_x)
+        h = abs(self.start_y - self.last_y)
+        return effects.get_block_rectangle(self.scene.base, x, y, w, h, self.pixelate_size)
+
+    def update_pixelate_preview(self):
+        # Only the selected blocks of the base are pixelated, fast enough
+        # to follow the pointer
+        (x, y, w, h) = self.get_pixelate_rectangle()
+        if w == 0 or h == 0:
+            self.pixelate_preview = None
+            return
+        tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        cr = cairo.Context(tile)
+        cr.set_source_surface(self.scene.base, -x, -y)
+        cr.paint()
+        effects.pixelate_region(tile, 0, 0, w, h, self.pixelate_size)
+        self.pixelate_preview = ((x, y, w, h), tile)
+
+    def apply_pixelate(self):
+        self.pixelate_preview = None
+        if abs(self.start_x - self.last_x) < 5 or abs(self.start_y - self.last_y) < 5: return
+
+        (x, y, w, h) = self.get_pixelate_rectangle()
+
+        command = PixelateCommand(x, y, w, h, self.pixelate_size)
+        self.queue_edit("pixelate", lambda: self.apply_checked(command, "pixelate"))
+
+    def update_blur_preview(self):
+        base = self.scene.base
+        x = min(self.start_x, self.last_x)
+        y = min(self.start_y, self.last_y)
+        w = abs(self.start_x - self.last_x)
+        h = abs(self.start_y - self.last_y)
+        selection = effects.clip_rectangle(base, x, y, w, h)
+        if selection[2] == 0 or selection[3] == 0:
+            self.blur_selection = None
+            return
+
+        # The blur reaches radius pixels around the selection
+        radius = self.blur_radius
+        (x, y, w, h) = selection
+        needed = effects.clip_rectangle(base, x - radius, y - radius, w + 2 * radius, h + 2 * radius)
+        if self.blur_preview is None or self.blur_preview[0] is not base or not bounds_contain(self.blur_preview[1], needed):
+            margin = BLUR_PREVIEW_MARGIN + radius
+            area = effects.clip_rectangle(base, x - margin, y - margin, w + 2 * margin, h + 2 * margin)
+            self.blur_preview = (base, area, self.render_blur_preview(base, area))
+        self.blur_selection = selection
+
+    def render_blur_preview(self, base, area):
+        (x, y, w, h) = area
+        tile_width = max(1, math.ceil(w * BLUR_PREVIEW_SCALE))
+        tile_height = max(1, math.ceil(h * BLUR_PREVIEW_SCALE))
+        tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, tile_width, tile_height)
+        cr = cairo.Context(tile)
+        cr.scale(tile_width / w, tile_height / h)
+        cr.set_source_surface(base, -x, -y)
+        cr.paint()
+        effects.blur_region(tile, 0, 0, tile_width, tile_height, self.blur_radius * BLUR_PREVIEW_SCALE)
+        return tile
+
+    def draw_blur_preview(self, cr):
+        (base, (ax, ay, aw, ah), tile) = self.blur_preview
+        (x, y, w, h) = self.blur_selection
+        cr.save()
+        cr.rectangle(x, y, w, h)
+        cr.clip()
+        cr.save()
+        cr.translate(ax, ay)
+        cr.scale(aw / tile.get_width(), ah / tile.get_height())
+        cr.set_source_surface(tile, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_BILINEAR)
+        cr.paint()
+        cr.restore()
+        # What the final result will look like, annotations included
+        self.scene.draw_annotations(cr, self.blur_selection)
+        cr.restore()
+
+    def clear_blur_preview(self):
+        if self.blur_selection is not None:
+            self.queue_image_area(self.get_outline_bounds(self.blur_selection))
+        self.blur_preview = None
+        self.blur_selection = None
+
     def apply_blur(self, end_x, end_y):
         if not self.surface: return
-        
-        x = int(min(self.start_x, end_x))
-        y = int(min(self.start_y, end_y))
-        w = int(abs(self.start_x - end_x))
-        h = int(abs(self.start_y - end_y))
-        
-        if w < 5 or h < 5: return
-        
-        if not isinstance(self.surface, cairo.ImageSurface):
-            # Fallback for non-image surfaces (e.g. X11)
-            temp_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-            cr = cairo.Context(temp_surface)
-            cr.set_source_surface(self.surface, 0, 0)
-            cr.paint()
-            self.surface = temp_surface
 
-        # Flush surface to ensure it's up to date
-        self.surface.flush()
-        
-        data = self.surface.get_data()
-        width = self.surface.get_width()
-        height = self.surface.get_height()
-        stride = self.surface.get_stride()
-        
-        try:
-            # Create PIL Image from surface data
-            # Cairo ARGB32 is BGRA (on little endian)
-            img = Image.frombuffer("RGBA", (width, height), data, "raw", "BGRA", stride, 1)
-            
-            # Crop
-            crop = img.crop((x, y, x+w, y+h))
-            
-            # Blur
-            blurred = crop.filter(ImageFilter.GaussianBlur(radius=10))
-            
-            # Convert back to BGRA for Cairo
-            r, g, b, a = blurred.split()
-            bgra = Image.merge("RGBA", (b, g, r, a))
-            
-            # Get bytes
-            buf = bytearray(bgra.tobytes())
-            
-            # Create temp surface
-            tmp_surface = cairo.ImageSurface.create_for_data(
-                buf, cairo.FORMAT_ARGB32, w, h, w*4)
-            
-            # Paint onto main surface
-            cr = cairo.Context(self.surface)
-            cr.set_source_surface(tmp_surface, x, y)
-            cr.paint()
-            
-            self.queue_draw()
-            
-        except Exception as e:
-            print("Blur error:", e)
+        if abs(self.start_x - end_x) < 5 or abs(self.start_y - end_y) < 5 or self.blur_selection is None:
+            self.clear_blur_preview()
+            return
 
-    def draw_stroke(self, x, y):
-        # Assuming start_x is set
-        cr = cairo.Context(self.surface)
-        
-        if self.current_tool == 'pen':
-            self.apply_style(cr)
-        elif self.current_tool == 'highlighter':
-            color = self.stroke_color
-            cr.set_source_rgba(color.red, color.green, color.blue, 0.4 * self.opacity)
-            cr.set_line_width(self.line_width)
-        elif self.current_tool == 'eraser':
-            cr.set_operator(cairo.OPERATOR_CLEAR)
-            cr.set_line_width(self.line_width)
-
-        cr.set_line_cap(cairo.LINE_CAP_ROUND)
-        cr.set_line_join(cairo.LINE_JOIN_ROUND)
-        
-        cr.move_to(self.start_x, self.start_y)
-        cr.line_to(x, y)
+        # The full resolution blur is done in a worker thread, on a copy of
+        # the base, the preview is shown in the meantime
+        (x, y, w, h) = self.blur_selection
+        command = BlurCommand(x, y, w, h, self.blur_radius)
+        self.queue_edit("blur", lambda: self.start_blur(command))
+
+    def start_blur(self, command):
+        # Started once the edits before it are done, on the base they leave
+        base = self.scene.base
+        pipeline = Pipeline("Blur", [("blur", lambda copy: command.prepare(base, copy))],
+                            lambda command: self.on_blur_done(command),
+                            lambda error: self.on_blur_error(error))
+        pipeline.start(copy_surface(base))
+        return pipeline
+
+    def on_blur_done(self, command):
+        self.apply_checked(command, "blur")
+        self.finish_edit()
+
+    def on_blur_error(self, error):
+        # The content is still there, the user must know
+        self.emit("edit-failed", "blur", str(error))
+        self.finish_edit()
+
+    def end_blur_preview(self):
+        # Unless it's the preview of a newer blur
+        if len(self.pending_edits) == 0 and not (self.is_drawing and self.current_tool == 'blur'):
+            self.clear_blur_preview()
+
+    def move_selection(self, x, y):
+        moved = self.selection_origin.moved(x - self.start_x, y - self.start_y)
+        damage = self.scene.replace(self.selection, moved)
+        self.queue_image_area(self.get_outline_bounds(damage))
+        self.selection = moved
+
+    def draw_selection(self, cr):
+        (x, y, w, h) = self.selection.get_bounds()
+        cr.set_source_rgba(1, 1, 1, 0.8)
+        cr.set_line_width(1 / self.view_scale)
+        cr.set_dash([4.0 / self.view_scale, 4.0 / self.view_scale], 0)
+        cr.rectangle(x, y, w, h)
         cr.stroke()
 
-        if self.current_tool == 'eraser':
-            cr.set_operator(cairo.OPERATOR_OVER)
-        
-        self.queue_draw()
+    def start_stroke(self, x, y):
+        # The stroke is in the scene while being drawn, so that recompositing
+        # its damaged area draws it as a single path
+        self.current_stroke = Stroke(self.current_tool, self.get_style(), x, y)
+        self.scene.annotations.append(self.current_stroke)
+        self.pending_points = 0
+        if self.tick_id is None:
+            self.tick_id = self.add_tick_callback(self.on_frame_tick)
+
+    def on_frame_tick(self, widget, frame_clock):
+        self.flush_stroke()
+        return True
+
+    def flush_stroke(self):
+        if self.pending_points == 0:
+            return
+        damage = self.scene.render(self.current_stroke.get_tail_bounds(self.pending_points))
+        self.queue_image_area(damage)
+        self.pending_points = 0
+
+    def finish_stroke(self, x, y):
+        self.current_stroke.add_point(x, y)
+        self.pending_points += 1
+        self.flush_stroke()
+        if self.tick_id is not None:
+            self.remove_tick_callback(self.tick_id)
+            self.tick_id = None
+        # Already in the scene, only record it
+        self.history.push(AddCommand(self.current_stroke), self.scene)
+        self.current_stroke = None
+        self.emit("history-changed")
 
     def get_result_pixbuf(self):
         # Convert surface to pixbuf
@@ -8,9 +8,7 @@ import subprocess
 import warnings
 import sys
 import traceback
-import shortcuts
 import datetime
-from recorder import ScreenRecorder
 
 # Suppress GTK deprecation warnings
 warnings.filterwarnings("ignore")
@@ -20,7 +18,13 @@ gi.require_version('XApp', '1.0')
 from gi.repository import Gtk, Gdk, Gio, XApp, GLib, GdkPixbuf
 
 import utils
+import writer
 from common import *
+from pipeline import Pipeline
+
+# Only needed when the user toggles "set as default" or records a video
+shortcuts = LazyModule("shortcuts")
+recorder = LazyModule("recorder")
 
 class StopWindow(Gtk.Window):
     def __init__(self, callback):
@@ -67,26 +71,138 @@ else:
      LOCALE_DIR = "/usr/share/locale"
      SHARE_DIR = "/usr/share/clicky"
 
+# Time given to the compositor to repaint what was under the window after
+# it was unmapped, in ms (a few frames at 60Hz)
+COMPOSITOR_FRAME_DELAY = 50
+# How long to wait for the unmap before capturing anyway, in ms
+HIDE_SAFETY_TIMEOUT = 300
+
 locale.bindtextdomain(APP, LOCALE_DIR)
 gettext.bindtextdomain(APP, LOCALE_DIR)
 gettext.textdomain(APP)
 _ = gettext.gettext
 
 
+# Exported on the application's object path, so hotkeys can ask a running
+# (or D-Bus activated) instance for a capture without starting Python.
+# Options: "file" (s) save there, "clipboard" (b) copy, "editor" (b) open the
+# capture in the editor. With neither a file nor the editor, the capture is
+# copied to the clipboard. Returns whether it succeeded and the saved path.
+CAPTURE_DBUS_INTERFACE = "org.x.clickyplus.Capture"
+CAPTURE_DBUS_XML = """
+<node>
+  <interface name="org.x.clickyplus.Capture">
+    <method name="Capture">
+      <arg type="s" name="mode" direction="in"/>
+      <arg type="a{sv}" name="options" direction="in"/>
+      <arg type="b" name="success" direction="out"/>
+      <arg type="s" name="path" direction="out"/>
+    </method>
+  </interface>
+</node>
+"""
+
 class MyApplication(Gtk.Application):
 
     def __init__(self, application_id, flags):
         Gtk.Application.__init__(self, application_id=application_id, flags=flags)
         self.connect("activate", self.activate)
+        self.main_window = None
+        self.cli_mode = None
+        self.resident = False
+        self.capture_registration_id = 0
         
         # Add command line parsing
         self.add_main_option("area", ord('a'), GLib.OptionFlags.NONE, GLib.OptionArg.NONE, "Capture area", None)
         self.add_main_option("screen", ord('s'), GLib.OptionFlags.NONE, GLib.OptionArg.NONE, "Capture screen", None)
         self.add_main_option("window", ord('w'), GLib.OptionFlags.NONE, GLib.OptionArg.NONE, "Capture window", None)
+        # Any of these makes a capture headless: no window, exit when done
+        self.add_main_option("file", ord('f'), GLib.OptionFlags.NONE, GLib.OptionArg.FILENAME, "Save the capture to FILE", "FILE")
+        self.add_main_option("clipboard", ord('c'), GLib.OptionFlags.NONE, GLib.OptionArg.NONE, "Copy the capture to the clipboard", None)
+        self.add_main_option("stdout", 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE, "Write the capture to stdout as PNG", None)
+        self.add_main_option("daemon", 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE, "Stay resident and serve captures over D-Bus", None)
+
+    def do_dbus_register(self, connection, object_path):
+        Gtk.Application.do_dbus_register(self, connection, object_path)
+        node = Gio.DBusNodeInfo.new_for_xml(CAPTURE_DBUS_XML)
+        self.capture_registration_id = connection.register_object(
+            object_path, node.lookup_interface(CAPTURE_DBUS_INTERFACE), self.on_capture_method_call, None, None)
+        return True
+
+    def do_dbus_unregister(self, connection, object_path):
+        if self.capture_registration_id > 0:
+            connection.unregister_object(self.capture_registration_id)
+            self.capture_registration_id = 0
+        Gtk.Application.do_dbus_unregister(self, connection, object_path)
+
+    def on_capture_method_call(self, connection, sender, object_path, interface_name, method_name, parameters, invocation):
+        (mode, options) = parameters.unpack()
+        if mode not in [CAPTURE_MODE_SCREEN, CAPTURE_MODE_WINDOW, CAPTURE_MODE_AREA]:
+            invocation.return_dbus_error("org.freedesktop.DBus.Error.InvalidArgs", "Unknown capture mode: %s" % mode)
+            return
+
+        if options.get("editor", False):
+            self.cli_mode = mode
+            self.activate()
+            invocation.return_value(GLib.Variant("(bs)", (True, "")))
+            return
+
+        import headless
+        path = options.get("file")
+        self.capture_headless_async(invocation, self.get_settings(), mode, path, options.get("clipboard", path is None))
+
+    # Captures in a worker thread, so the resident main loop keeps serving
+    # other hotkeys and the editor in the meantime. The method call is
+    # answered once the capture is delivered.
+    @async_function
+    def capture_headless_async(self, invocation, settings, mode, path, clipboard):
+        import headless
+        status = headless.run(settings, mode, path, clipboard)
+        self.return_capture_result(invocation, status == 0, path or "")
+
+    @idle_function
+    def return_capture_result(self, invocation, success, path):
+        invocation.return_value(GLib.Variant("(bs)", (success, path)))
+
+    def get_settings(self):
+        return new_settings()
+
+    def do_shutdown(self):
+        # Don't lose saves which are still queued
+        writer.get_writer().wait()
+        Gtk.Application.do_shutdown(self)
+
+    # Keep the process, the capture backends and the fonts around so that
+    # hotkey captures only pay for the capture itself.
+    def start_resident_service(self):
+        if self.resident:
+            return
+        self.resident = True
+        self.hold()
+        GLib.idle_add(self.warm_up)
+
+    def warm_up(self):
+        timer = StageTimer("Resident service warm-up")
+        if self.get_settings().get_boolean("enable-dbus-method"):
+            utils.get_dbus_backend().warm_up()
+            timer.mark("dbus")
+        utils.get_backend_prober().get_capabilities()
+        timer.mark("probe")
+        # Load the font used by the text tool
+        gi.require_version('PangoCairo', '1.0')
+        from gi.repository import Pango, PangoCairo
+        PangoCairo.FontMap.get_default().create_context().load_font(Pango.FontDescription("Sans Bold 20"))
+        timer.mark("fonts")
+        timer.report()
+        return False
 
     def do_command_line(self, command_line):
         options = command_line.get_options_dict()
         self.cli_mode = None
+
+        if options.contains("daemon"):
+            self.start_resident_service()
+            return 0
         
         if options.contains("area"):
             self.cli_mode = "area"
@@ -94,22 +210,43 @@ class MyApplication(Gtk.Application):
             self.cli_mode = "screen"
         elif options.contains("window"):
             self.cli_mode = "window"
+
+        if self.cli_mode and (options.contains("file") or options.contains("clipboard") or options.contains("stdout")):
+            return self.capture_headless(command_line, options)
             
         self.activate()
         return 0
 
+    def capture_headless(self, command_line, options):
+        import headless
+        path = None
+        if options.contains("file"):
+            arg = options.lookup_value("file", GLib.VariantType.new("ay")).get_bytestring()
+            path = command_line.create_file_for_arg(os.fsdecode(arg)).get_path()
+        stdout = None
+        if options.contains("stdout"):
+            if command_line.get_is_remote():
+                command_line.printerr("--stdout is not available while Clicky is already running\n")
+                return 1
+            stdout = sys.stdout.buffer
+        return headless.run(self.get_settings(), self.cli_mode, path, options.contains("clipboard"), stdout)
+
     def activate(self, application=None):
-        windows = self.get_windows()
-        if (len(windows) > 0):
-            window = windows[0]
-            window.present()
-            window.show()
+        # Check if we have a CLI mode set
+        cli_mode = self.cli_mode
+        self.cli_mode = None
+
+        if self.main_window is not None:
+            if cli_mode:
+                self.main_window.set_mode_and_capture(cli_mode)
+            else:
+                self.main_window.window.present()
+                self.main_window.window.show()
         else:
-            # Check if we have a CLI mode set
-            cli_mode = getattr(self, 'cli_mode', None)
-            
             window = MainWindow(self)
+            self.main_window = window
             self.add_window(window.window)
+            window.window.connect("destroy", self.on_main_window_destroyed)
             
             if cli_mode:
                 # Direct capture mode
@@ -117,12 +254,15 @@ class MyApplication(Gtk.Application):
             else:
                 window.window.show()
 
+    def on_main_window_destroyed(self, widget):
+        self.main_window = None
+
 class MainWindow():
 
     def __init__(self, application):
 
         self.application = application
-        self.settings = Gio.Settings(schema_id="org.x.clickyplus")
+        self.settings = new_settings()
 
         # Main UI
         gladefile = os.path.join(SHARE_DIR, "clicky.ui")
@@ -175,6 +315,7 @@ class MainWindow():
         self.settings.bind("delay", self.spin_delay, "value", Gio.SettingsBindFlags.DEFAULT)
         self.settings.bind("set-as-default", self.switch_set_default, "active", Gio.SettingsBindFlags.DEFAULT)
         self.switch_set_default.connect("notify::active", self.on_set_default_toggled)
+        self.settings.connect("changed::resident-service", self.on_resident_service_changed)
 
         # Storage settings bindings
         self.settings.bind("auto-copy-clipboard", self.switch_clipboard, "active", Gio.SettingsBindFlags.DEFAULT)
@@ -191,10 +332,16 @@ class MainWindow():
         # spin = xapp.SettingsWidgets.SpinButton(_("Delay"), units="seconds")
         # self.builder.get_object("box_options").pack_start(spin, False, False, 0)
         
-        self.recorder = ScreenRecorder()
+        self.recorder = None
         self.stop_window = None
+        self.capture_pipeline = None
 
-        self.window.show()
+        # Connect to the capture services while the user is still looking at
+        # the window, rather than on the first capture
+        if self.settings.get_boolean("enable-dbus-method"):
+            GLib.idle_add(utils.get_dbus_backend().warm_up)
+
+        # Shown by the application unless a capture was requested
         self.builder.get_object("button_take_screenshot").grab_focus()
 
         # Store initial window size to keep UI stable across captures
@@ -237,10 +384,15 @@ class MainWindow():
     def on_set_default_toggled(self, switch, _pspec):
         """Called when the 'set as default' toggle changes."""
         if switch.get_active():
-            shortcuts.enable()
+            shortcuts.enable(self.settings.get_boolean("resident-service"))
         else:
             shortcuts.disable()
 
+    def on_resident_service_changed(self, settings, key):
+        # The shortcut commands depend on it
+        if settings.get_boolean("set-as-default"):
+            shortcuts.enable(settings.get_boolean(key))
+
     def on_capture_mode_toggled(self, widget):
         self.settings.set_string("capture-mode", self.get_capture_mode())
         
@@ -284,15 +436,49 @@ class MainWindow():
             self.start_screenshot(widget)
 
     def start_screenshot(self, widget):
-        self.hide_window()
-        # Increased to 500ms to ensure compositor animations (fade-out) are complete
+        self.cancel_screenshot()
         delay_seconds = self.settings.get_int("delay")
         delay_ms = max(0, int(delay_seconds)) * 1000
-        GLib.timeout_add(500 + delay_ms, self.take_screenshot)
+        if not self.window.get_mapped():
+            # Nothing of ours on screen (e.g. hotkey capture), no need to wait
+            self.schedule_screenshot(delay_ms)
+        else:
+            self.hide_window(lambda: self.schedule_screenshot(delay_ms))
 
-    def hide_window(self):
-        self.window.hide()
+    def schedule_screenshot(self, delay_ms):
+        if delay_ms > 0:
+            GLib.timeout_add(delay_ms, self.take_screenshot)
+        else:
+            GLib.idle_add(self.take_screenshot)
+
+    # Hide the window and call on_hidden once it is off the screen: after its
+    # unmap, plus a few frames for the compositor to repaint what was under
+    # it. If the unmap never comes, on_hidden is called after a safety timeout.
+    def hide_window(self, on_hidden=None):
+        if on_hidden is not None:
+            state = {"done": False, "handler": 0, "timeout": 0}
+
+            def finish(*args):
+                if not state["done"]:
+                    state["done"] = True
+                    self.window.disconnect(state["handler"])
+                    GLib.source_remove(state["timeout"])
+                    on_hidden()
+                return False
+
+            def on_unmap(widget, event):
+                if self.window.get_screen().is_composited():
+                    GLib.timeout_add(COMPOSITOR_FRAME_DELAY, finish)
+                else:
+                    finish()
+                return False
+
+            state["handler"] = self.window.connect("unmap-event", on_unmap)
+            state["timeout"] = GLib.timeout_add(HIDE_SAFETY_TIMEOUT, finish)
+
+        # Fully transparent first, so the compositor has no fade-out to show
         self.window.set_opacity(0)
+        self.window.hide()
         self.window.set_skip_pager_hint(True)
         self.window.set_skip_taskbar_hint(True)
 
@@ -302,13 +488,13 @@ class MainWindow():
         self.window.set_skip_pager_hint(False)
         self.window.set_skip_taskbar_hint(False)
 
-    def show_error_dialog(self, message):
+    def show_error_dialog(self, message, title=None):
         dialog = Gtk.MessageDialog(
             transient_for=self.window,
             flags=0,
             message_type=Gtk.MessageType.ERROR,
             buttons=Gtk.ButtonsType.OK,
-            text=_("Screenshot Failed"),
+            text=title if title is not None else _("Screenshot Failed"),
         )
         dialog.format_secondary_text(message)
         dialog.run()
@@ -328,7 +514,19 @@ class MainWindow():
         self.start_screenshot(None)
 
     def set_canvas_mode(self, widget, mode):
-        self.canvas.current_tool = mode
+        self.canvas.set_tool(mode)
+
+    def on_canvas_history_changed(self, canvas):
+        self.undo_button.set_sensitive(canvas.history.can_undo())
+        self.redo_button.set_sensitive(canvas.history.can_redo())
+
+    def on_canvas_edit_failed(self, canvas, tool, message):
+        # Blur and pixelate hide secrets, say so when they didn't happen
+        titles = {
+            "pixelate": _("The area was not pixelated"),
+            "blur": _("The area was not blurred"),
+        }
+        self.show_error_dialog(message, titles.get(tool, _("The edit failed")))
 
     def setup_canvas_ui(self):
         if hasattr(self, 'canvas_toolbar'):
@@ -355,6 +553,7 @@ class MainWindow():
             toolbar1.insert(btn, -1)
             return btn
 
+        add_tool("input-mouse-symbolic", _("Select"), "select")
         add_tool("draw-freehand-symbolic", _("Pen"), "pen")
         add_tool("marker-symbolic", _("Highlighter"), "highlighter")
         toolbar1.insert(Gtk.SeparatorToolItem(), -1)
@@ -364,10 +563,25 @@ class MainWindow():
         add_tool("go-next-symbolic", _("Arrow"), "arrow")
         add_tool("format-text-bold-symbolic", _("Text"), "text")
         add_tool("weather-fog-symbolic", _("Blur"), "blur")
+        add_tool("view-grid-symbolic", _("Pixelate"), "pixelate")
         toolbar1.insert(Gtk.SeparatorToolItem(), -1)
         add_tool("edit-cut-symbolic", _("Crop Image"), "crop")
         add_tool("edit-clear-symbolic", _("Eraser"), "eraser")
         
+        toolbar1.insert(Gtk.SeparatorToolItem(), -1)
+        self.undo_button = Gtk.ToolButton()
+        self.undo_button.set_icon_name("edit-undo-symbolic")
+        self.undo_button.set_tooltip_text(_("Undo"))
+        self.undo_button.connect("clicked", lambda b: self.canvas.undo())
+        self.undo_button.set_sensitive(False)
+        toolbar1.insert(self.undo_button, -1)
+        self.redo_button = Gtk.ToolButton()
+        self.redo_button.set_icon_name("edit-redo-symbolic")
+        self.redo_button.set_tooltip_text(_("Redo"))
+        self.redo_button.connect("clicked", lambda b: self.canvas.redo())
+        self.redo_button.set_sensitive(False)
+        toolbar1.insert(self.redo_button, -1)
+
         toolbar1.insert(Gtk.SeparatorToolItem(), -1)
         btn_save = Gtk.ToolButton()
         btn_save.set_icon_name("document-save-symbolic")
@@ -420,6 +634,9 @@ class MainWindow():
         
         from canvas import CanvasWidget
         self.canvas = CanvasWidget()
+        self.canvas.set_blur_radius(self.settings.get_int("blur-radius"))
+        self.canvas.connect("history-changed", self.on_canvas_history_changed)
+        self.canvas.connect("edit-failed", self.on_canvas_edit_failed)
         self.canvas.show()
 
         # Center the canvas inside the container
@@ -512,6 +729,8 @@ class MainWindow():
             
         output_path = os.path.join(save_dir, filename)
         
+        if self.recorder is None:
+            self.recorder = recorder.ScreenRecorder()
         if self.recorder.start(x, y, w, h, output_path, fmt):
              self.stop_window = StopWindow(self.stop_recording)
              # Position stop window bottom right
@@ -524,7 +743,7 @@ class MainWindow():
              self.show_error_dialog(_("Failed to start recording"))
 
     def stop_recording(self):
-        saved_path = self.recorder.stop()
+        saved_path = self.recorder.stop() if self.recorder else None
         self.stop_window = None
         self.show_window()
         
@@ -537,7 +756,10 @@ class MainWindow():
 
     def save_canvas(self, widget):
         if not self.canvas: return
-        
+        # Once the blurs still being computed are done
+        self.canvas.queue_edit("save", self.write_canvas)
+
+    def write_canvas(self):
         pixbuf = self.canvas.get_result_pixbuf()
         if not pixbuf: return
 
@@ -568,31 +790,20 @@ class MainWindow():
                 self.show_error_dialog(_("Could not create directory") + ": " + save_dir)
                 return
         
-        try:
-            if fmt == "jpg":
-                pixbuf.savev(full_path, "jpeg", ["quality"], ["90"])
-            elif fmt == "webp":
-                 try:
-                     pixbuf.savev(full_path, "webp", [], [])
-                 except: # Fallback
-                     full_path = full_path.rsplit('.', 1)[0] + ".png"
-                     pixbuf.savev(full_path, "png", [], [])
-            else:
-                pixbuf.savev(full_path, "png", [], [])
-
-            notification = Gio.Notification.new(_("Screenshot Saved"))
-            notification.set_body(full_path)
-            notification.set_icon(Gio.ThemedIcon.new("image-x-generic"))
-            
-            if self.application:
-                self.application.send_notification("clicky-saved", notification)
-            
-            # Show saved state in UI or trigger open folder
-            # For now, just a visual cue could be helpful, but notification handles it.
-            
-        except Exception as e:
-            self.show_error_dialog(str(e))
+        # Encoding and writing happen on the writer thread, the editor stays usable
+        gdk_format = "jpeg" if fmt == "jpg" else fmt
+        profile = self.settings.get_string("save-profile")
+        writer.get_writer().save(pixbuf, full_path, gdk_format, self.on_canvas_saved, self.on_canvas_save_error, profile)
+
+    def on_canvas_saved(self, path):
+        notification = Gio.Notification.new(_("Screenshot Saved"))
+        notification.set_body(path)
+        notification.set_icon(Gio.ThemedIcon.new("image-x-generic"))
+        if self.application:
+            self.application.send_notification("clicky-saved", notification)
 
+    def on_canvas_save_error(self, error):
+        self.show_error_dialog(str(error))
 
     def go_back(self, widget):
         self.navigate_to("main_page")
@@ -605,13 +816,16 @@ class MainWindow():
         clipboard.set_image(pixbuf)
         clipboard.store()
 
-    def show_notification(self):
+    def show_notification(self, preview=None):
         notification = Gio.Notification.new(_("Screenshot Taken"))
         if self.settings.get_boolean("auto-copy-clipboard"):
             notification.set_body(_("Image copied to clipboard."))
         else:
             notification.set_body(_("Click to edit and save."))
-        notification.set_icon(Gio.ThemedIcon.new("clicky"))
+        if preview is not None:
+            notification.set_icon(preview)
+        else:
+            notification.set_icon(Gio.ThemedIcon.new("clicky"))
         
         if self.application:
             self.application.send_notification("screenshot-taken", notification)
@@ -675,38 +889,52 @@ class MainWindow():
             self.apply_fixed_layout()
             return
     def take_screenshot(self):
+        options = Options(self.settings)
+        self.capture_pipeline = Pipeline("Screenshot", [
+            ("capture", lambda data: utils.capture_image(options)),
+            ("decode", utils.decode_image),
+            ("post-process", self.prepare_screenshot),
+        ], self.present_screenshot, self.on_screenshot_error)
+        self.capture_pipeline.start()
+        return False
+
+    def cancel_screenshot(self):
+        if self.capture_pipeline is not None:
+            self.capture_pipeline.cancel()
+            self.capture_pipeline = None
+
+    # Runs in the capture worker thread
+    def prepare_screenshot(self, pixbuf):
+        screenshot = utils.ScreenshotBuffer(pixbuf)
+        # Scale the notification thumbnail here rather than in the main loop
+        screenshot.get_preview(max_height=utils.NOTIFICATION_PREVIEW_HEIGHT)
+        return screenshot
+
+    def present_screenshot(self, screenshot):
+        self.capture_pipeline = None
         try:
-            options = Options(self.settings)
-            pixbuf = utils.capture_pixbuf(options)
-            
             # Post-capture actions
-            if pixbuf:
+            if screenshot:
+                pixbuf = screenshot.pixbuf
                 if self.settings.get_boolean("auto-copy-clipboard"):
                     self.copy_to_clipboard(pixbuf)
-                self.show_notification()
+                self.show_notification(screenshot.get_preview(max_height=utils.NOTIFICATION_PREVIEW_HEIGHT))
                 
                 # Setup Canvas Logic
                 if not hasattr(self, 'canvas'):
                     self.setup_canvas_ui()
                 
-                # Scaling Threshold (1280px)
-                display_pixbuf = pixbuf
-                if pixbuf.get_width() >= 1920:
-                    # Strictly 50% for 1080p and above
-                    target_w = pixbuf.get_width() // 2
-                    target_h = pixbuf.get_height() // 2
-                    display_pixbuf = pixbuf.scale_simple(target_w, target_h, GdkPixbuf.InterpType.BILINEAR)
-                elif pixbuf.get_width() > 1280:
-                    # Proportional scaling for intermediate sizes
-                    target_w = pixbuf.get_width() // 2
-                    target_h = pixbuf.get_height() // 2
-                    display_pixbuf = pixbuf.scale_simple(target_w, target_h, GdkPixbuf.InterpType.BILINEAR)
+                # Above 1280px the preview is shown at 50%. The canvas keeps
+                # the full resolution image so the saved file is not degraded.
+                view_scale = 1.0
+                if pixbuf.get_width() > 1280:
+                    view_scale = 0.5
                 
-                self.canvas.set_pixbuf(display_pixbuf)
+                self.canvas.set_pixbuf(pixbuf, view_scale)
                 
                 # Set window size to match preview (with some buffer)
-                target_w = display_pixbuf.get_width()
-                target_h = display_pixbuf.get_height()
+                target_w = int(pixbuf.get_width() * view_scale)
+                target_h = int(pixbuf.get_height() * view_scale)
                 
                 self.apply_fixed_layout(target_w, target_h)
                 
@@ -718,8 +946,12 @@ class MainWindow():
                 self.show_window()
         except Exception as e:
             print(traceback.format_exc())
-            self.show_error_dialog(_("An error occurred during the screenshot:\n\n") + str(e))
-            self.show_window()
+            self.on_screenshot_error(e)
+
+    def on_screenshot_error(self, error):
+        self.capture_pipeline = None
+        self.show_error_dialog(_("An error occurred during the screenshot:\n\n") + str(error))
+        self.show_window()
 
     @idle_function
     def navigate_to(self, page, name=""):
@@ -785,6 +1017,16 @@ class MainWindow():
              pass
         elif self.stack.get_visible_child_name() == "screenshot_page":
             alt = modifier == Gdk.ModifierType.MOD1_MASK
+            ctrl_shift = modifier == Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.SHIFT_MASK
+            editing_text = hasattr(self, 'text_entry') and self.text_entry.has_focus()
+            if hasattr(self, 'canvas') and not editing_text and event.keyval in (Gdk.KEY_z, Gdk.KEY_Z):
+                # Ctrl + Z, Ctrl + Shift + Z
+                if ctrl:
+                    self.canvas.undo()
+                    return True
+                elif ctrl_shift:
+                    self.canvas.redo()
+                    return True
             if event.keyval == Gdk.KEY_BackSpace:
                 self.navigate_to("main_page")
             elif alt and event.keyval == Gdk.KEY_Left:
@@ -1,7 +1,31 @@
 #!/usr/bin/python3
 import gi
+import importlib
+import os
 import threading
-from gi.repository import GObject
+import time
+from gi.repository import GObject, Gio
+
+# Stand-in for a module which is only imported the first time one of its
+# attributes is used, to keep heavy dependencies out of the startup path.
+# on_load(module) is called once, right after the import.
+class LazyModule():
+
+    def __init__(self, name, on_load=None):
+        self.__dict__["name"] = name
+        self.__dict__["on_load"] = on_load
+        self.__dict__["module"] = None
+
+    def load(self):
+        if self.module is None:
+            module = importlib.import_module(self.name)
+            if self.on_load is not None:
+                self.on_load(module)
+            self.__dict__["module"] = module
+        return self.module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
 
 # Used as a decorator to run things in the background
 def async_function(func):
@@ -18,6 +42,82 @@ def idle_function(func):
         GObject.idle_add(func, *args)
     return wrapper
 
+# Run func in the main loop and wait for its result. Meant for worker threads
+# which need to touch GTK; called from the main thread it just runs func.
+def call_in_main_loop(func, *args):
+    if threading.current_thread() is threading.main_thread():
+        return func(*args)
+    done = threading.Event()
+    result = {}
+    def run():
+        try:
+            result["value"] = func(*args)
+        except BaseException as e:
+            result["error"] = e
+        done.set()
+        return False
+    GObject.idle_add(run)
+    done.wait()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+# Collects how long each named stage of an operation took, so slow captures
+# can be attributed to the right step (D-Bus call, disk, decode...)
+class StageTimer():
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.last = time.monotonic()
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def total(self):
+        return sum(duration for (stage, duration) in self.stages)
+
+    def report(self):
+        details = ", ".join("%s %.1f ms" % (stage, duration * 1000) for (stage, duration) in self.stages)
+        print("%s: %s (total %.1f ms)" % (self.name, details, self.total() * 1000))
+
+SETTINGS_SCHEMA_ID = "org.x.clickyplus"
+
+# Compiled schemas of a development tree (usr/lib/clicky -> usr/share/...).
+# When installed, this is the system directory and the default source has it.
+SCHEMA_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../share/glib-2.0/schemas"))
+
+settings_schema = None
+
+# Whether the compiled schema file next to the sources is up to date. A stale
+# one may lack newer keys, and reading a missing key aborts the process.
+# Same test as clicky_cli.sh, which recompiles when the XML is newer.
+def is_local_schema_current():
+    compiled = os.path.join(SCHEMA_DIR, "gschemas.compiled")
+    xml = os.path.join(SCHEMA_DIR, SETTINGS_SCHEMA_ID + ".gschema.xml")
+    if not os.path.exists(compiled):
+        return False
+    return not (os.path.exists(xml) and os.path.getmtime(xml) > os.path.getmtime(compiled))
+
+# Load our settings schema straight from the compiled schema file next to the
+# sources if it is up to date, so running from the source tree needs neither
+# GSETTINGS_SCHEMA_DIR nor a glib-compile-schemas run.
+def new_settings():
+    global settings_schema
+    if settings_schema is None:
+        default_source = Gio.SettingsSchemaSource.get_default()
+        if is_local_schema_current():
+            source = Gio.SettingsSchemaSource.new_from_directory(SCHEMA_DIR, default_source, False)
+            settings_schema = source.lookup(SETTINGS_SCHEMA_ID, False)
+        if settings_schema is None:
+            settings_schema = default_source.lookup(SETTINGS_SCHEMA_ID, True)
+    if settings_schema is None:
+        # Let GSettings report the missing schema
+        return Gio.Settings(schema_id=SETTINGS_SCHEMA_ID)
+    return Gio.Settings.new_full(settings_schema, None, None)
+
 CAPTURE_MODE_SCREEN = 'screen'
 CAPTURE_MODE_WINDOW = 'window'
 CAPTURE_MODE_AREA = 'area'
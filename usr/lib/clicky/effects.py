@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""
+effects.py – Raster effects applied to regions of the canvas surface.
+
+Effects work on the target rectangle only. The rows of the rectangle are
+read through a memoryview over the cairo buffer (no copy of the surface),
+the rectangle is cropped out of them, processed by PIL and the resulting
+rows are written back in place.
+
+Cairo ARGB32 pixels are premultiplied BGRA bytes on little endian machines.
+Blurring and pixelating treat every channel the same way, so the bytes are
+handed to PIL as if they were RGBA, without swapping channels, and the
+premultiplication is what makes averaging translucent pixels correct.
+"""
+
+import math
+
+import cairo
+
+from common import LazyModule
+
+# Only needed by the blur and pixelate tools
+Image = LazyModule("PIL.Image")
+ImageFilter = LazyModule("PIL.ImageFilter")
+
+BLUR_RADIUS = 10
+PIXELATE_SIZE = 12
+
+BYTES_PER_PIXEL = 4
+
+
+def to_image_surface(surface):
+    """Return surface as a cairo.ImageSurface, converting if needed (e.g. X11)."""
+    if isinstance(surface, cairo.ImageSurface):
+        return surface
+    image_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(), surface.get_height())
+    cr = cairo.Context(image_surface)
+    cr.set_source_surface(surface, 0, 0)
+    cr.paint()
+    return image_surface
+
+
+def clip_rectangle(surface, x, y, w, h):
+    """Clip an (x, y, width, height) rectangle to the surface."""
+    left = max(0, int(x))
+    top = max(0, int(y))
+    right = min(surface.get_width(), int(x + w))
+    bottom = min(surface.get_height(), int(y + h))
+    return (left, top, max(0, right - left), max(0, bottom - top))
+
+
+def get_block_rectangle(surface, x, y, w, h, size=PIXELATE_SIZE):
+    """Grow a rectangle to whole blocks of a grid starting at the surface
+    origin (clipped to the surface), so that pixelating it twice, or two
+    overlapping rectangles, gives the same blocks."""
+    left = int(x) // size * size
+    top = int(y) // size * size
+    right = -(-int(x + w) // size) * size
+    bottom = -(-int(y + h) // size) * size
+    return clip_rectangle(surface, left, top, right - left, bottom - top)
+
+
+def get_rows_view(data, stride, y, h):
+    """Return a memoryview covering whole rows y to y + h, for PIL to read
+    with the surface stride (it needs h * stride bytes)."""
+    return data[y * stride:(y + h) * stride]
+
+
+def read_region(surface, x, y, w, h):
+    data = memoryview(surface.get_data())
+    view = get_rows_view(data, surface.get_stride(), y, h)
+    # Rows from the left edge of the surface, the region is cropped out of them
+    rows = Image.frombuffer("RGBA", (x + w, h), view, "raw", "RGBA", surface.get_stride(), 1)
+    return rows.crop((x, 0, x + w, h))
+
+
+def write_region(surface, image, x, y, offset_x=0, offset_y=0, w=None, h=None):
+    """Write the (offset_x, offset_y, w, h) part of image to the surface at x, y."""
+    if w is None:
+        (w, h) = image.size
+    data = memoryview(surface.get_data())
+    stride = surface.get_stride()
+    pixels = image.tobytes()
+    row_length = w * BYTES_PER_PIXEL
+    image_stride = image.size[0] * BYTES_PER_PIXEL
+    for row in range(h):
+        source = (offset_y + row) * image_stride + offset_x * BYTES_PER_PIXEL
+        destination = (y + row) * stride + x * BYTES_PER_PIXEL
+        data[destination:destination + row_length] = pixels[source:source + row_length]
+    surface.mark_dirty_rectangle(x, y, w, h)
+
+
+def blur_region(surface, x, y, w, h, radius=BLUR_RADIUS):
+    """Blur the rectangle of an image surface in place.
+
+    The pixels around the rectangle, up to radius away, are read too so that
+    its edges are blurred with their real neighbours. GaussianBlur is done
+    by PIL as separable box blur passes.
+    """
+    (x, y, w, h) = clip_rectangle(surface, x, y, w, h)
+    if w == 0 or h == 0:
+        return
+    surface.flush()
+    radius = max(1, radius)
+    margin = math.ceil(radius)
+    (mx, my, mw, mh) = clip_rectangle(surface, x - margin, y - margin, w + 2 * margin, h + 2 * margin)
+    region = read_region(surface, mx, my, mw, mh)
+    blurred = region.filter(ImageFilter.GaussianBlur(radius=radius))
+    write_region(surface, blurred, x, y, x - mx, y - my, w, h)
+
+
+def pixelate_region(surface, x, y, w, h, size=PIXELATE_SIZE):
+    """Pixelate the rectangle of an image surface in place.
+
+    Every size x size block, starting from the top left corner of the
+    rectangle, is replaced by the average of its pixels (Image.reduce()).
+    Only that average is left of the original pixels, so unlike a blur
+    this can't be reversed.
+    """
+    (x, y, w, h) = clip_rectangle(surface, x, y, w, h)
+    if w == 0 or h == 0:
+        return
+    surface.flush()
+    size = max(1, int(size))
+    region = read_region(surface, x, y, w, h)
+    averages = region.reduce(size)
+    blocks = averages.resize((averages.size[0] * size, averages.size[1] * size), Image.NEAREST)
+    write_region(surface, blocks, x, y, 0, 0, w, h)
+
+
+def blur_surface(surface, x, y, w, h, radius=BLUR_RADIUS):
+    """Blur the given rectangle of the surface. Returns the surface, which is
+    a new one if the original one had to be converted to an image surface."""
+    surface = to_image_surface(surface)
+    blur_region(surface, x, y, w, h, radius)
+    return surface
+
+
+def pixelate_surface(surface, x, y, w, h, size=PIXELATE_SIZE):
+    """Same as blur_surface(), pixelating."""
+    surface = to_image_surface(surface)
+    pixelate_region(surface, x, y, w, h, size)
+    return surface
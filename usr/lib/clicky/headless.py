@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+headless.py – Capture from the command line without building the main window.
+
+Used for `clicky --screen --clipboard` and friends: only the capture
+backend is loaded, the image is saved, copied and/or written to stdout, and
+the process exits.
+"""
+
+import contextlib
+import os
+import sys
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk, Gdk, Gio
+
+import utils
+import writer
+from common import *
+
+# File extension -> GdkPixbuf format
+SAVE_FORMATS = {
+    "png": "png",
+    "jpg": "jpeg",
+    "jpeg": "jpeg",
+    "webp": "webp",
+}
+
+
+def get_save_format(path, default="png"):
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    return SAVE_FORMATS.get(extension, SAVE_FORMATS.get(default, "png"))
+
+
+def save(pixbuf, path, fmt, profile=writer.DEFAULT_SAVE_PROFILE):
+    """Save like the editor does, synchronously as we exit right after.
+    Returns the path, which ends in .png if WebP isn't available."""
+    (path, data) = writer.encode_with_fallback(pixbuf, path, fmt, profile)
+    writer.write_atomically(path, data)
+    return path
+
+
+def copy_to_clipboard(pixbuf):
+    # The resident service delivers captures from a worker thread
+    call_in_main_loop(set_clipboard_image, pixbuf)
+
+
+def set_clipboard_image(pixbuf):
+    clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+    clipboard.set_image(pixbuf)
+    # Hand the image over to the clipboard manager, as we are about to exit
+    clipboard.store()
+
+
+def run(settings, mode, path=None, clipboard=False, stdout=None, stderr=None):
+    """Capture in the given mode and deliver the image. Returns an exit status.
+
+    stdout is a binary stream to write a PNG to, or None. Errors are written
+    to stderr (a text stream, sys.stderr by default).
+    """
+    if stderr is None:
+        stderr = sys.stderr
+
+    # Our diagnostics go to stderr when the image itself goes to stdout
+    if stdout is not None:
+        with contextlib.redirect_stdout(sys.stderr):
+            return capture_and_deliver(settings, mode, path, clipboard, stdout, stderr)
+    return capture_and_deliver(settings, mode, path, clipboard, stdout, stderr)
+
+
+def capture_and_deliver(settings, mode, path, clipboard, stdout, stderr):
+    options = Options(settings)
+    options.mode = mode
+    pixbuf = utils.capture_pixbuf(options)
+    if pixbuf is None:
+        stderr.write("Screenshot canceled or failed.\n")
+        return 1
+
+    timer = StageTimer("Headless capture delivery")
+    try:
+        if path is not None:
+            saved_path = save(pixbuf, path, get_save_format(path, settings.get_string("file-format")),
+                              settings.get_string("save-profile"))
+            if saved_path != path:
+                stderr.write("Saved as %s\n" % saved_path)
+            timer.mark("save")
+        if clipboard:
+            copy_to_clipboard(pixbuf)
+            timer.mark("clipboard")
+        if stdout is not None:
+            (success, data) = pixbuf.save_to_bufferv("png", [], [])
+            stdout.write(data)
+            stdout.flush()
+            timer.mark("stdout")
+    except Exception as e:
+        stderr.write("%s\n" % e)
+        return 1
+    timer.report()
+    return 0
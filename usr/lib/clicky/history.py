@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+"""
+history.py – Undo/redo for the canvas.
+
+Every edit is recorded as a command which can be replayed onto the scene.
+A snapshot of the scene is kept every SNAPSHOT_INTERVAL commands, so undoing
+only replays the commands done since the nearest snapshot. Snapshots are
+evicted, oldest first, when the base images they hold, and the surfaces
+held by the commands, take more than MEMORY_LIMIT bytes.
+"""
+
+import cairo
+
+import effects
+
+SNAPSHOT_INTERVAL = 10
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+
+def copy_surface(surface):
+    copy = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(), surface.get_height())
+    cr = cairo.Context(copy)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.set_source_surface(surface, 0, 0)
+    cr.paint()
+    return copy
+
+
+def get_surface_memory(surface):
+    return surface.get_stride() * surface.get_height()
+
+
+class Command():
+    """Something done to the scene. apply() does it and returns the damaged
+    (x, y, width, height) rectangle, or None if the whole scene changed."""
+
+    def apply(self, scene):
+        pass
+
+    def get_surfaces(self):
+        """Surfaces held by the command, which count towards MEMORY_LIMIT."""
+        return []
+
+    def release(self):
+        """Drop the surfaces which apply() can compute again."""
+        pass
+
+
+class AddCommand(Command):
+
+    def __init__(self, annotation):
+        self.annotation = annotation
+
+    def apply(self, scene):
+        return scene.add(self.annotation)
+
+
+class ReplaceCommand(Command):
+    """Move or restyle an annotation, i.e. replace it with a modified copy."""
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def apply(self, scene):
+        return scene.replace(self.old, self.new)
+
+
+class BlurCommand(Command):
+    """Blur an area of the base. The blurred base can be computed beforehand
+    with prepare(), e.g. in a worker thread."""
+
+    def __init__(self, x, y, w, h, radius=effects.BLUR_RADIUS):
+        (self.x, self.y, self.w, self.h) = (x, y, w, h)
+        self.radius = radius
+        # (base, blurred copy of it) from prepare()
+        self.prepared = None
+
+    def blur(self, base):
+        # Bases are shared with the snapshots, blur a copy
+        return effects.blur_surface(copy_surface(base), self.x, self.y, self.w, self.h, self.radius)
+
+    def prepare(self, base, copy=None):
+        """Blur base ahead of apply(). copy is a copy of base to blur in
+        place, which a caller in another thread makes beforehand so that
+        the worker never reads the scene."""
+        if copy is None:
+            copy = copy_surface(base)
+        blurred = effects.blur_surface(copy, self.x, self.y, self.w, self.h, self.radius)
+        self.prepared = (base, blurred)
+        return self
+
+    def apply(self, scene):
+        if self.prepared is not None and self.prepared[0] is scene.base:
+            base = self.prepared[1]
+        else:
+            base = self.blur(scene.base)
+        # Replays (undo) start from other bases
+        self.prepared = None
+        return scene.set_base(base, (self.x, self.y, self.w, self.h))
+
+    def get_surfaces(self):
+        return [] if self.prepared is None else [self.prepared[1]]
+
+    def release(self):
+        self.prepared = None
+
+
+class PixelateCommand(Command):
+
+    def __init__(self, x, y, w, h, size=effects.PIXELATE_SIZE):
+        (self.x, self.y, self.w, self.h) = (x, y, w, h)
+        self.size = size
+
+    def apply(self, scene):
+        # Bases are shared with the snapshots, pixelate a copy
+        base = effects.pixelate_surface(copy_surface(scene.base), self.x, self.y, self.w, self.h, self.size)
+        return scene.set_base(base, (self.x, self.y, self.w, self.h))
+
+
+class CropCommand(Command):
+
+    def __init__(self, x, y, w, h):
+        (self.x, self.y, self.w, self.h) = (x, y, w, h)
+
+    def apply(self, scene):
+        base = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.w, self.h)
+        cr = cairo.Context(base)
+        cr.set_source_surface(scene.base, -self.x, -self.y)
+        cr.paint()
+        # Annotations keep their place on the image
+        scene.annotations = [annotation.moved(-self.x, -self.y) for annotation in scene.annotations]
+        scene.set_base(base)
+        return None
+
+
+class History():
+    """Command log with periodic snapshots.
+
+    position is the number of commands currently applied; commands after
+    it can be redone. snapshots maps a position to a snapshot of the scene
+    at that point. The snapshot at 0 (the unedited image) is never evicted,
+    so any position can be rebuilt.
+    """
+
+    def __init__(self, snapshot_interval=SNAPSHOT_INTERVAL, memory_limit=MEMORY_LIMIT):
+        self.snapshot_interval = snapshot_interval
+        self.memory_limit = memory_limit
+        self.commands = []
+        self.snapshots = {}
+        self.position = 0
+
+    def reset(self, scene):
+        self.commands = []
+        self.snapshots = {0: scene.snapshot()}
+        self.position = 0
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.commands)
+
+    def push(self, command, scene):
+        """Record a command, which has already been applied to scene."""
+        # Doing something new discards what could have been redone
+        del self.commands[self.position:]
+        for position in [p for p in self.snapshots if p > self.position]:
+            del self.snapshots[position]
+
+        self.commands.append(command)
+        self.position += 1
+        if self.position % self.snapshot_interval == 0:
+            self.snapshots[self.position] = scene.snapshot()
+        self.evict()
+
+    def get_memory(self):
+        # Snapshots share base images until a raster effect replaces them
+        surfaces = {id(snapshot.base): snapshot.base for snapshot in self.snapshots.values()}
+        for command in self.commands:
+            surfaces.update((id(surface), surface) for surface in command.get_surfaces())
+        return sum(get_surface_memory(surface) for surface in surfaces.values())
+
+    def evict(self):
+        # Surfaces which commands can compute again go first
+        if self.get_memory() > self.memory_limit:
+            for command in self.commands:
+                command.release()
+        while self.get_memory() > self.memory_limit:
+            evictable = sorted(p for p in self.snapshots if p > 0)
+            if len(evictable) == 0:
+                break
+            del self.snapshots[evictable[0]]
+
+    def undo(self, scene):
+        """Bring scene back to before the last command. Returns False if
+        there is nothing to undo."""
+        if not self.can_undo() or 0 not in self.snapshots:
+            return False
+        self.position -= 1
+        self.rebuild(scene)
+        return True
+
+    def redo(self, scene):
+        """Re-apply the next command. Returns the damaged rectangle (see
+        Command.apply()), or False if there is nothing to redo."""
+        if not self.can_redo():
+            return False
+        command = self.commands[self.position]
+        self.position += 1
+        return command.apply(scene)
+
+    def rebuild(self, scene):
+        start = max(p for p in self.snapshots if p <= self.position)
+        scene.restore(self.snapshots[start])
+        for command in self.commands[start:self.position]:
+            command.apply(scene)
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+"""
+pipeline.py – Run a staged job (e.g. capture → decode → post-process) on a
+worker thread and hand the result back to the GTK main loop.
+"""
+
+import threading
+import traceback
+
+from common import *
+
+
+class Pipeline():
+    """A list of (name, function) stages, run in order on a worker thread.
+
+    Each stage receives the previous stage's result. The final result is
+    passed to on_done in the main loop, unless the pipeline was cancelled in
+    the meantime. Exceptions are passed to on_error, in the main loop too.
+    A stage returning None ends the pipeline early (nothing to work on).
+    """
+
+    def __init__(self, name, stages, on_done, on_error=None):
+        self.name = name
+        self.stages = stages
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+        self.timer = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    @async_function
+    def start(self, data=None):
+        self.timer = StageTimer(self.name)
+        try:
+            for (name, func) in self.stages:
+                if self.is_cancelled():
+                    break
+                data = func(data)
+                self.timer.mark(name)
+                if data is None:
+                    break
+        except Exception as e:
+            print(traceback.format_exc())
+            if not self.is_cancelled():
+                self.finish_error(e)
+            return
+        self.timer.report()
+        if not self.is_cancelled():
+            self.finish(data)
+
+    @idle_function
+    def finish(self, data):
+        # Cancellation may happen while waiting for the main loop
+        if not self.is_cancelled():
+            self.on_done(data)
+
+    @idle_function
+    def finish_error(self, error):
+        if not self.is_cancelled() and self.on_error is not None:
+            self.on_error(error)
@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+"""
+scene.py – Retained annotations over a base image.
+
+The scene is the base image (the capture, with raster effects such as blur
+and crop applied) and an ordered list of annotation objects on top of it.
+The composite of both is cached in Scene.surface; changing an object only
+recomposites its bounding box.
+
+Annotation objects are never modified once added: moving or restyling one
+replaces it with a modified copy. The history can then keep references to
+them, and to base surfaces, which are replaced rather than drawn onto.
+"""
+
+import copy
+import math
+
+import cairo
+from gi.repository import Pango, PangoCairo
+
+# How close (in image pixels) a click must be to an object to select it
+HIT_TOLERANCE = 4
+
+
+def get_bounds_union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y)
+
+
+def bounds_intersect(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def bounds_contain(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            inner[0] + inner[2] <= outer[0] + outer[2] and inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+def get_points_bounds(points, padding):
+    xs = [x for (x, y) in points]
+    ys = [y for (x, y) in points]
+    return (min(xs) - padding, min(ys) - padding,
+            max(xs) - min(xs) + 2 * padding, max(ys) - min(ys) + 2 * padding)
+
+
+def get_segment_distance(px, py, x1, y1, x2, y2):
+    (dx, dy) = (x2 - x1, y2 - y1)
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else max(0, min(1, ((px - x1) * dx + (py - y1) * dy) / length))
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+class Style():
+    """Drawing style of an annotation, copied from the canvas settings."""
+
+    def __init__(self, color, opacity=1.0, line_width=3, fill=False):
+        # Gdk.RGBA or (red, green, blue, alpha)
+        if hasattr(color, "red"):
+            color = (color.red, color.green, color.blue, color.alpha)
+        self.color = tuple(color)
+        self.opacity = opacity
+        self.line_width = line_width
+        self.fill = fill
+
+    def apply(self, cr, alpha=1.0):
+        (red, green, blue, color_alpha) = self.color
+        cr.set_source_rgba(red, green, blue, color_alpha * self.opacity * alpha)
+        cr.set_line_width(self.line_width)
+        cr.set_line_cap(cairo.LINE_CAP_ROUND)
+        cr.set_line_join(cairo.LINE_JOIN_ROUND)
+
+
+class Annotation():
+    """An object drawn over the base image."""
+
+    # Whether it can be picked with the select tool
+    selectable = True
+
+    def __init__(self, style):
+        self.style = style
+
+    def draw(self, cr):
+        pass
+
+    def get_bounds(self):
+        """Return the (x, y, width, height) area the object paints in."""
+        return (0, 0, 0, 0)
+
+    def contains(self, x, y):
+        (bx, by, bw, bh) = self.get_bounds()
+        return bx <= x <= bx + bw and by <= y <= by + bh
+
+    def translate(self, dx, dy):
+        pass
+
+    def moved(self, dx, dy):
+        annotation = copy.copy(self)
+        annotation.translate(dx, dy)
+        return annotation
+
+    def restyled(self, style):
+        annotation = copy.copy(self)
+        annotation.style = style
+        return annotation
+
+    def get_padding(self):
+        # Half the line, plus a pixel for antialiasing
+        return self.style.line_width / 2 + 1
+
+
+class Stroke(Annotation):
+    """A freehand pen, highlighter or eraser stroke.
+
+    The points are drawn as a single smoothed path: quadratic curves through
+    the midpoints of consecutive points, with the points as control points.
+    Being one path, a translucent highlighter doesn't darken where segments
+    meet.
+    """
+
+    def __init__(self, tool, style, x, y):
+        super().__init__(style)
+        self.tool = tool
+        self.points = [(x, y)]
+        self.bounds = None
+        # Erasing isn't an object for the user
+        self.selectable = tool != 'eraser'
+
+    def add_point(self, x, y):
+        self.points.append((x, y))
+        self.bounds = None
+
+    def prepare(self, cr):
+        if self.tool == 'highlighter':
+            self.style.apply(cr, 0.4)
+        elif self.tool == 'eraser':
+            self.style.apply(cr)
+            cr.set_operator(cairo.OPERATOR_CLEAR)
+        else:
+            self.style.apply(cr)
+
+    def trace(self, cr):
+        points = self.points
+        cr.move_to(*points[0])
+        if len(points) < 3:
+            # A dot (thanks to the round caps) or a straight segment
+            cr.line_to(*points[-1])
+            return
+        (x0, y0) = points[0]
+        for index in range(1, len(points) - 1):
+            (cx, cy) = points[index]
+            (nx, ny) = points[index + 1]
+            (x1, y1) = ((cx + nx) / 2, (cy + ny) / 2)
+            # Quadratic curve (x0, y0) -> (x1, y1) controlled by (cx, cy), as a cubic one
+            cr.curve_to(x0 + 2 / 3 * (cx - x0), y0 + 2 / 3 * (cy - y0),
+                        x1 + 2 / 3 * (cx - x1), y1 + 2 / 3 * (cy - y1),
+                        x1, y1)
+            (x0, y0) = (x1, y1)
+        cr.line_to(*points[-1])
+
+    def draw(self, cr):
+        self.prepare(cr)
+        self.trace(cr)
+        cr.stroke()
+
+    def get_bounds(self):
+        if self.bounds is None:
+            self.bounds = get_points_bounds(self.points, self.get_padding())
+        return self.bounds
+
+    def get_tail_bounds(self, count):
+        """Bounds of the part of the path changed by adding the last count
+        points. Each curve lies within its control points, and adding a
+        point also bends the curve before it."""
+        return get_points_bounds(self.points[-(count + 2):], self.get_padding())
+
+    def contains(self, x, y):
+        reach = self.style.line_width / 2 + HIT_TOLERANCE
+        for index in range(1, len(self.points)):
+            if get_segment_distance(x, y, *self.points[index - 1], *self.points[index]) <= reach:
+                return True
+        return False
+
+    def translate(self, dx, dy):
+        self.points = [(x + dx, y + dy) for (x, y) in self.points]
+        self.bounds = None
+
+    def restyled(self, style):
+        annotation = super().restyled(style)
+        # The padding depends on the line width
+        annotation.bounds = None
+        return annotation
+
+
+class Shape(Annotation):
+    """A rectangle, circle, line or arrow from (x1, y1) to (x2, y2)."""
+
+    def __init__(self, tool, style, x1, y1, x2, y2, arrow_length=0):
+        super().__init__(style)
+        self.tool = tool
+        (self.x1, self.y1, self.x2, self.y2) = (x1, y1, x2, y2)
+        self.arrow_length = arrow_length
+
+    def draw(self, cr):
+        x = min(self.x1, self.x2)
+        y = min(self.y1, self.y2)
+        w = abs(self.x1 - self.x2)
+        h = abs(self.y1 - self.y2)
+
+        self.style.apply(cr)
+
+        if self.tool == 'rectangle':
+            cr.rectangle(x, y, w, h)
+            if self.style.fill:
+                cr.fill_preserve()
+            cr.stroke()
+
+        elif self.tool == 'circle':
+            cr.save()
+            cr.translate(x + w/2, y + h/2)
+            cr.scale(max(w, 1e-3)/2, max(h, 1e-3)/2)
+            cr.arc(0, 0, 1, 0, 2 * math.pi)
+            cr.restore()
+            if self.style.fill:
+                cr.fill_preserve()
+            cr.stroke()
+
+        elif self.tool == 'line':
+            cr.move_to(self.x1, self.y1)
+            cr.line_to(self.x2, self.y2)
+            cr.stroke()
+
+        elif self.tool == 'arrow':
+            self.draw_arrow(cr)
+
+    def get_arrow_head(self):
+        angle = math.atan2(self.y2 - self.y1, self.x2 - self.x1)
+        arrow_angle = math.pi / 6
+        return [(self.x2 - self.arrow_length * math.cos(angle - arrow_angle),
+                 self.y2 - self.arrow_length * math.sin(angle - arrow_angle)),
+                (self.x2 - self.arrow_length * math.cos(angle + arrow_angle),
+                 self.y2 - self.arrow_length * math.sin(angle + arrow_angle))]
+
+    def draw_arrow(self, cr):
+        cr.move_to(self.x1, self.y1)
+        cr.line_to(self.x2, self.y2)
+        cr.stroke()
+
+        # Arrow head
+        for point in self.get_arrow_head():
+            cr.move_to(self.x2, self.y2)
+            cr.line_to(*point)
+        cr.stroke()
+
+    def get_bounds(self):
+        points = [(self.x1, self.y1), (self.x2, self.y2)]
+        if self.tool == 'arrow':
+            points.extend(self.get_arrow_head())
+        return get_points_bounds(points, self.get_padding())
+
+    def contains(self, x, y):
+        reach = self.style.line_width / 2 + HIT_TOLERANCE
+        if self.tool in ['line', 'arrow']:
+            return get_segment_distance(x, y, self.x1, self.y1, self.x2, self.y2) <= reach
+        if self.style.fill:
+            return super().contains(x, y)
+        # Only the outline of unfilled shapes, not what they surround
+        (left, right) = sorted((self.x1, self.x2))
+        (top, bottom) = sorted((self.y1, self.y2))
+        if not (left - reach <= x <= right + reach and top - reach <= y <= bottom + reach):
+            return False
+        if self.tool == 'rectangle':
+            return min(x - left, right - x, y - top, bottom - y) <= reach
+        # Circle: distance to the ellipse, roughly
+        (rx, ry) = (max((right - left) / 2, 1), max((bottom - top) / 2, 1))
+        (cx, cy) = (left + rx, top + ry)
+        distance = math.hypot((x - cx) / rx, (y - cy) / ry)
+        return abs(distance - 1) * min(rx, ry) <= reach
+
+    def translate(self, dx, dy):
+        (self.x1, self.y1, self.x2, self.y2) = (self.x1 + dx, self.y1 + dy, self.x2 + dx, self.y2 + dy)
+
+
+class Text(Annotation):
+
+    def __init__(self, text, style, x, y, font_size):
+        super().__init__(style)
+        self.text = text
+        (self.x, self.y) = (x, y)
+        self.font_size = font_size
+        self.extents = None
+
+    def create_layout(self, cr):
+        layout = PangoCairo.create_layout(cr)
+        layout.set_text(self.text, -1)
+        desc = Pango.FontDescription("Sans Bold 20")
+        desc.set_absolute_size(self.font_size * Pango.SCALE)
+        layout.set_font_description(desc)
+        return layout
+
+    def draw(self, cr):
+        self.style.apply(cr)
+        layout = self.create_layout(cr)
+        cr.move_to(self.x, self.y)
+        PangoCairo.show_layout(cr, layout)
+
+    def get_bounds(self):
+        if self.extents is None:
+            cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+            (ink, logical) = self.create_layout(cr).get_pixel_extents()
+            self.extents = get_bounds_union((ink.x, ink.y, ink.width, ink.height),
+                                            (logical.x, logical.y, logical.width, logical.height))
+        (x, y, w, h) = self.extents
+        return (self.x + x - 1, self.y + y - 1, w + 2, h + 2)
+
+    def translate(self, dx, dy):
+        (self.x, self.y) = (self.x + dx, self.y + dy)
+
+
+class SceneSnapshot():
+    """The state of a scene, as kept by the history."""
+
+    def __init__(self, base, annotations):
+        self.base = base
+        self.annotations = tuple(annotations)
+
+
+class Scene():
+
+    def __init__(self):
+        self.base = None
+        self.annotations = []
+        # Composite of the base and the annotations
+        self.surface = None
+
+    def get_width(self):
+        return self.surface.get_width()
+
+    def get_height(self):
+        return self.surface.get_height()
+
+    def set_base(self, base, damage=None):
+        """Replace the base image. Only damage is recomposited, if given."""
+        self.base = base
+        if self.surface is None or (self.surface.get_width(), self.surface.get_height()) != (base.get_width(), base.get_height()):
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, base.get_width(), base.get_height())
+            damage = None
+        return self.render(damage)
+
+    def snapshot(self):
+        return SceneSnapshot(self.base, self.annotations)
+
+    def restore(self, snapshot):
+        self.annotations = list(snapshot.annotations)
+        return self.set_base(snapshot.base)
+
+    def add(self, annotation):
+        self.annotations.append(annotation)
+        return self.render(annotation.get_bounds())
+
+    def replace(self, old, new):
+        self.annotations[self.annotations.index(old)] = new
+        return self.render(get_bounds_union(old.get_bounds(), new.get_bounds()))
+
+    def remove(self, annotation):
+        self.annotations.remove(annotation)
+        return self.render(annotation.get_bounds())
+
+    def find(self, x, y):
+        """Return the topmost annotation at x, y or None."""
+        for annotation in reversed(self.annotations):
+            if annotation.selectable and annotation.contains(x, y):
+                return annotation
+        return None
+
+    def get_damage_rectangle(self, bounds):
+        """Round bounds out to whole pixels, clipped to the surface."""
+        x = max(0, math.floor(bounds[0]))
+        y = max(0, math.floor(bounds[1]))
+        right = min(self.surface.get_width(), math.ceil(bounds[0] + bounds[2]))
+        bottom = min(self.surface.get_height(), math.ceil(bounds[1] + bounds[3]))
+        return (x, y, max(0, right - x), max(0, bottom - y))
+
+    def render(self, damage=None):
+        """Recomposite the damaged (x, y, width, height) area, or everything.
+
+        Returns the recomposited rectangle, in whole pixels.
+        """
+        if damage is None:
+            damage = (0, 0, self.surface.get_width(), self.surface.get_height())
+        damage = self.get_damage_rectangle(damage)
+        if damage[2] == 0 or damage[3] == 0:
+            return damage
+
+        cr = cairo.Context(self.surface)
+        cr.rectangle(*damage)
+        cr.clip()
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_surface(self.base, 0, 0)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+        self.draw_annotations(cr, damage)
+        return damage
+
+    def draw_annotations(self, cr, area):
+        """Draw the annotations which intersect area, cr being clipped to it."""
+        for annotation in self.annotations:
+            if bounds_intersect(annotation.get_bounds(), area):
+                cr.save()
+                annotation.draw(cr)
+                cr.restore()
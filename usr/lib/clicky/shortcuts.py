@@ -3,12 +3,17 @@
 shortcuts.py – Manage system screenshot keybindings for Clicky Plus.
 
 Provides enable() / disable() functions to replace or restore
-the native screenshot shortcuts on Cinnamon and GNOME.
+the native screenshot shortcuts on Cinnamon and GNOME. Only the settings
+which differ from the wanted state are written; run this file directly
+for a dry run (`shortcuts.py [--disable] [--resident]`).
 """
 
-import ast
 import os
-import subprocess
+import threading
+
+from gi.repository import Gio, GLib
+
+from common import *
 
 # Shortcut definitions: (id, name, cli_flag, binding)
 SHORTCUTS = [
@@ -31,35 +36,108 @@ CINNAMON_NATIVE_KEYS = [
 
 # Cinnamon default bindings (to restore when disabling)
 CINNAMON_DEFAULTS = {
-    "screenshot": "['Print']",
-    "screenshot-clip": "['<Control>Print']",
-    "area-screenshot": "['<Shift>Print']",
-    "area-screenshot-clip": "['<Control><Shift>Print']",
-    "window-screenshot": "['<Alt>Print']",
-    "window-screenshot-clip": "['<Control><Alt>Print']",
+    "screenshot": ["Print"],
+    "screenshot-clip": ["<Control>Print"],
+    "area-screenshot": ["<Shift>Print"],
+    "area-screenshot-clip": ["<Control><Shift>Print"],
+    "window-screenshot": ["<Alt>Print"],
+    "window-screenshot-clip": ["<Control><Alt>Print"],
 }
 
 
-def _gsettings(*args):
-    """Run gsettings command, return stdout or empty string on failure."""
-    try:
-        result = subprocess.run(
-            ["gsettings"] + list(args),
-            capture_output=True, text=True, timeout=5,
-        )
-        return result.stdout.strip()
-    except Exception:
-        return ""
+CINNAMON_KEYBINDINGS_SCHEMA = "org.cinnamon.desktop.keybindings"
+CINNAMON_MEDIA_KEYS_SCHEMA = "org.cinnamon.desktop.keybindings.media-keys"
+CINNAMON_CUSTOM_SCHEMA = "org.cinnamon.desktop.keybindings.custom-keybinding"
+CINNAMON_CUSTOM_BASE = "/org/cinnamon/desktop/keybindings/custom-keybindings"
+
+GNOME_MEDIA_KEYS_SCHEMA = "org.gnome.settings-daemon.plugins.media-keys"
+GNOME_CUSTOM_SCHEMA = "org.gnome.settings-daemon.plugins.media-keys.custom-keybinding"
+GNOME_CUSTOM_BASE = "/org/gnome/settings-daemon/plugins/media-keys/custom-keybindings"
+
+# GNOME native screenshot keys and their default bindings
+GNOME_DEFAULTS = {
+    "screenshot": ["Print"],
+    "screenshot-clip": ["<Control>Print"],
+    "area-screenshot": ["<Shift>Print"],
+    "area-screenshot-clip": ["<Control><Shift>Print"],
+    "window-screenshot": ["<Alt>Print"],
+    "window-screenshot-clip": ["<Control><Alt>Print"],
+}
+
+# enable() and disable() run in a worker thread, one at a time
+_lock = threading.Lock()
+
+
+def _lookup_schema(schema_id):
+    """Return the installed schema, or None."""
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is None:
+        return None
+    return source.lookup(schema_id, True)
+
+
+class _SettingsCache():
+    """Gio.Settings objects by (schema_id, path), created on first use.
+
+    Creating a Gio.Settings for a schema which isn't installed, or using a
+    key which the schema doesn't have (e.g. the screenshot keys removed from
+    gnome-settings-daemon 41), aborts the process. So missing schemas give
+    None and missing keys are left alone, see has_key().
+    """
+
+    def __init__(self):
+        self.settings = {}
+        self.schemas = {}
+
+    def get_schema(self, schema_id):
+        if schema_id not in self.schemas:
+            self.schemas[schema_id] = _lookup_schema(schema_id)
+        return self.schemas[schema_id]
+
+    def has_key(self, schema_id, key):
+        schema = self.get_schema(schema_id)
+        return schema is not None and schema.has_key(key)
+
+    def get(self, schema_id, path=None):
+        if (schema_id, path) not in self.settings:
+            settings = None
+            if self.get_schema(schema_id) is not None:
+                if path is None:
+                    settings = Gio.Settings.new(schema_id)
+                else:
+                    # Relocatable schema, e.g. one custom keybinding
+                    settings = Gio.Settings.new_with_path(schema_id, path)
+            self.settings[(schema_id, path)] = settings
+        return self.settings[(schema_id, path)]
 
 
 def _is_cinnamon():
     """Detect if running under Cinnamon."""
-    output = _gsettings("list-keys", "org.cinnamon.desktop.keybindings")
-    return "custom-list" in output
+    schema = _lookup_schema(CINNAMON_KEYBINDINGS_SCHEMA)
+    return schema is not None and schema.has_key("custom-list")
+
+
+# D-Bus name and path of the application, see clicky.py
+APP_BUS_NAME = "org.x.clicky"
+APP_OBJECT_PATH = "/org/x/clicky"
+
 
+def _get_resident_command(cli_flag):
+    """Build a thin client command asking the resident service for a capture.
 
-def _get_clicky_command(cli_flag):
+    The capture opens in the editor, like the non-resident shortcuts
+    (clicky_cli.sh --screen etc.) do; the service's headless captures are for
+    other callers passing "file" or "clipboard".
+    """
+    mode = cli_flag.lstrip("-")
+    return (f"gdbus call --session --dest {APP_BUS_NAME} --object-path {APP_OBJECT_PATH} "
+            f"--method org.x.clickyplus.Capture.Capture {mode} \"{{'editor': <true>}}\"")
+
+
+def _get_clicky_command(cli_flag, resident=False):
     """Build the absolute command path for the given flag."""
+    if resident:
+        return _get_resident_command(cli_flag)
     # Determine base path: installed or development
     usr_bin = "/usr/bin/clicky_cli.sh"
     if os.path.exists(usr_bin):
@@ -74,113 +152,179 @@ def _get_clicky_command(cli_flag):
     return f"clicky_cli.sh {cli_flag}"
 
 
-def _cinnamon_get_custom_list():
-    """Get the current Cinnamon custom-list."""
-    raw = _gsettings("get", "org.cinnamon.desktop.keybindings", "custom-list")
-    if not raw or raw == "@as []":
-        return []
-    try:
-        return ast.literal_eval(raw)
-    except Exception:
-        return []
-
+# The reconciler works on settings identified by (schema_id, path, key),
+# path being None for non-relocatable schemas. A plan lists the wanted value
+# of each setting, either as a value or as a function of the current value
+# (for lists shared with other applications). Only the differences between
+# the plan and the current state are written.
 
-def _cinnamon_set_custom_list(lst):
-    """Set the Cinnamon custom-list."""
-    _gsettings("set", "org.cinnamon.desktop.keybindings", "custom-list", str(lst))
+def enable(resident=False):
+    """Make Clicky the default screenshot app.
 
-
-def enable():
-    """Make Clicky the default screenshot app."""
-    if _is_cinnamon():
-        _enable_cinnamon()
-    _enable_gnome()
+    With resident=True, the shortcuts call the resident D-Bus service
+    instead of launching the application. The settings are written in a
+    worker thread, the returned thread can be joined to wait for them.
+    """
+    return _run(True, resident)
 
 
 def disable():
-    """Restore the native screenshot app."""
-    if _is_cinnamon():
-        _disable_cinnamon()
-    _disable_gnome()
-
-
-def _enable_cinnamon():
-    """Disable native Cinnamon screenshot keys and add Clicky shortcuts."""
-    schema = "org.cinnamon.desktop.keybindings.media-keys"
-    for key in CINNAMON_NATIVE_KEYS:
-        _gsettings("set", schema, key, "[]")
-
-    # Update custom-list
-    current = _cinnamon_get_custom_list()
-    final = [x for x in current if x not in SHORTCUT_IDS]
-    final.extend(SHORTCUT_IDS)
-    _cinnamon_set_custom_list(final)
-
-    # Configure each shortcut
-    base = "/org/cinnamon/desktop/keybindings/custom-keybindings"
-    custom_schema = "org.cinnamon.desktop.keybindings.custom-keybinding"
-    for sid, name, flag, binding in SHORTCUTS:
-        path = f"{base}/{sid}/"
-        cmd = _get_clicky_command(flag)
-        _gsettings("set", f"{custom_schema}:{path}", "name", name)
-        _gsettings("set", f"{custom_schema}:{path}", "command", cmd)
-        _gsettings("set", f"{custom_schema}:{path}", "binding", f"['{binding}']")
-
-
-def _disable_cinnamon():
-    """Restore native Cinnamon screenshot keys and remove Clicky shortcuts."""
-    schema = "org.cinnamon.desktop.keybindings.media-keys"
+    """Restore the native screenshot app (in a worker thread, see enable())."""
+    return _run(False)
+
+
+@async_function
+def _run(enabled, resident=False):
+    with _lock:
+        try:
+            changes = reconcile(enabled, resident)
+        except GLib.Error as e:
+            print("Could not update the keyboard shortcuts: %s" % e.message)
+            return
+        if len(changes) > 0:
+            print("Keyboard shortcuts: %d setting(s) updated" % len(changes))
+
+
+def reconcile(enabled, resident=False, dry_run=False):
+    """Bring the keybinding settings to the enabled/disabled state.
+
+    Returns the list of changes as ((schema_id, path, key), old, new)
+    tuples. With dry_run=True nothing is written.
+    """
+    cache = _SettingsCache()
+    plan = get_plan(enabled, resident, _is_cinnamon())
+    current = _read_state(cache, [setting for (setting, wanted) in plan])
+    changes = compute_changes(plan, current)
+    if len(changes) > 0 and not dry_run:
+        _apply_changes(cache, changes)
+    return changes
+
+
+def get_plan(enabled, resident=False, cinnamon=False):
+    """Return the wanted state as a list of (setting, value or function)."""
+    plan = []
+    if cinnamon:
+        plan.extend(_get_cinnamon_plan(enabled, resident))
+    plan.extend(_get_gnome_plan(enabled, resident))
+    return plan
+
+
+def compute_changes(plan, current):
+    """Diff a plan against the current {setting: value} state.
+
+    Settings missing from the current state (schema not installed) are
+    skipped.
+    """
+    changes = []
+    for (setting, wanted) in plan:
+        if setting not in current:
+            continue
+        old = current[setting]
+        new = wanted(old) if callable(wanted) else wanted
+        if new != old:
+            changes.append((setting, old, new))
+    return changes
+
+
+def format_changes(changes):
+    """Describe changes for humans, one per line."""
+    if len(changes) == 0:
+        return "Keyboard shortcuts are up to date."
+    lines = []
+    for ((schema_id, path, key), old, new) in changes:
+        location = schema_id if path is None else f"{schema_id}:{path}"
+        lines.append(f"{location} {key}: {old!r} -> {new!r}")
+    return "\n".join(lines)
+
+
+def _read_state(cache, settings_list):
+    """Read the current value of each setting, once. Settings whose schema
+    or key isn't installed are left out, so they are never written."""
+    state = {}
+    for setting in settings_list:
+        (schema_id, path, key) = setting
+        if not cache.has_key(schema_id, key):
+            continue
+        settings = cache.get(schema_id, path)
+        if settings is not None:
+            state[setting] = settings.get_value(key).unpack()
+    return state
+
+
+def _apply_changes(cache, changes):
+    """Write the changes, in one delay()/apply() transaction per object."""
+    touched = []
+    for ((schema_id, path, key), old, new) in changes:
+        settings = cache.get(schema_id, path)
+        if settings is None or not cache.has_key(schema_id, key):
+            continue
+        if settings not in touched:
+            settings.delay()
+            touched.append(settings)
+        value_type = settings.get_value(key).get_type_string()
+        settings.set_value(key, GLib.Variant(value_type, new))
+    for settings in touched:
+        settings.apply()
+    # Make sure dconf got the writes before the thread goes away
+    Gio.Settings.sync()
+
+
+def _append_missing(items):
+    return lambda current: current + [x for x in items if x not in current]
+
+
+def _remove_all(items):
+    return lambda current: [x for x in current if x not in items]
+
+
+def _get_cinnamon_plan(enabled, resident=False):
+    """Native Cinnamon screenshot keys off and Clicky shortcuts on, or the reverse."""
+    plan = []
     for key in CINNAMON_NATIVE_KEYS:
-        default = CINNAMON_DEFAULTS.get(key, "[]")
-        _gsettings("set", schema, key, default)
-
-    # Remove from custom-list
-    current = _cinnamon_get_custom_list()
-    updated = [x for x in current if x not in SHORTCUT_IDS]
-    _cinnamon_set_custom_list(updated)
-
-    # Reset each shortcut by clearing its binding
-    base = "/org/cinnamon/desktop/keybindings/custom-keybindings"
-    custom_schema = "org.cinnamon.desktop.keybindings.custom-keybinding"
-    for sid, name, flag, binding in SHORTCUTS:
-        path = f"{base}/{sid}/"
-        _gsettings("set", f"{custom_schema}:{path}", "binding", "[]")
-
-
-def _enable_gnome():
-    """Register shortcuts in GNOME settings-daemon (for non-Cinnamon)."""
-    schema = "org.gnome.settings-daemon.plugins.media-keys"
-    custom_schema = f"{schema}.custom-keybinding"
-    base = f"/org/gnome/settings-daemon/plugins/media-keys/custom-keybindings"
-
-    # Disable native
-    for key in ["screenshot", "screenshot-clip", "area-screenshot",
-                "area-screenshot-clip", "window-screenshot", "window-screenshot-clip"]:
-        _gsettings("set", schema, key, "[]")
+        value = [] if enabled else CINNAMON_DEFAULTS.get(key, [])
+        plan.append(((CINNAMON_MEDIA_KEYS_SCHEMA, None, key), value))
 
-    # Build paths list
-    paths = [f"'{base}/{sid}/' " for sid, _, _, _ in SHORTCUTS]
-    paths_str = "[" + ", ".join(paths) + "]"
-    _gsettings("set", schema, "custom-keybindings", paths_str)
+    if enabled:
+        plan.append(((CINNAMON_KEYBINDINGS_SCHEMA, None, "custom-list"), _append_missing(SHORTCUT_IDS)))
+    else:
+        plan.append(((CINNAMON_KEYBINDINGS_SCHEMA, None, "custom-list"), _remove_all(SHORTCUT_IDS)))
 
     for sid, name, flag, binding in SHORTCUTS:
-        path = f"{base}/{sid}/"
-        cmd = _get_clicky_command(flag)
-        _gsettings("set", f"{custom_schema}:{path}", "name", name)
-        _gsettings("set", f"{custom_schema}:{path}", "command", cmd)
-        _gsettings("set", f"{custom_schema}:{path}", "binding", binding)
-
-
-def _disable_gnome():
-    """Remove Clicky shortcuts from GNOME settings-daemon."""
-    schema = "org.gnome.settings-daemon.plugins.media-keys"
-    # Re-enable native screenshot keys with defaults
-    _gsettings("set", schema, "screenshot", "['Print']")
-    _gsettings("set", schema, "screenshot-clip", "['<Control>Print']")
-    _gsettings("set", schema, "area-screenshot", "['<Shift>Print']")
-    _gsettings("set", schema, "area-screenshot-clip", "['<Control><Shift>Print']")
-    _gsettings("set", schema, "window-screenshot", "['<Alt>Print']")
-    _gsettings("set", schema, "window-screenshot-clip", "['<Control><Alt>Print']")
-
-    # Clear custom keybindings list
-    _gsettings("set", schema, "custom-keybindings", "[]")
+        path = f"{CINNAMON_CUSTOM_BASE}/{sid}/"
+        if enabled:
+            plan.append(((CINNAMON_CUSTOM_SCHEMA, path, "name"), name))
+            plan.append(((CINNAMON_CUSTOM_SCHEMA, path, "command"), _get_clicky_command(flag, resident)))
+            plan.append(((CINNAMON_CUSTOM_SCHEMA, path, "binding"), [binding]))
+        else:
+            # Clearing the binding is enough to deactivate the shortcut
+            plan.append(((CINNAMON_CUSTOM_SCHEMA, path, "binding"), []))
+    return plan
+
+
+def _get_gnome_plan(enabled, resident=False):
+    """Same as _get_cinnamon_plan(), for GNOME settings-daemon.
+
+    Other applications' entries in custom-keybindings are preserved.
+    """
+    plan = []
+    for key, default in GNOME_DEFAULTS.items():
+        plan.append(((GNOME_MEDIA_KEYS_SCHEMA, None, key), [] if enabled else default))
+
+    paths = [f"{GNOME_CUSTOM_BASE}/{sid}/" for sid, _, _, _ in SHORTCUTS]
+    if enabled:
+        plan.append(((GNOME_MEDIA_KEYS_SCHEMA, None, "custom-keybindings"), _append_missing(paths)))
+        for sid, name, flag, binding in SHORTCUTS:
+            path = f"{GNOME_CUSTOM_BASE}/{sid}/"
+            plan.append(((GNOME_CUSTOM_SCHEMA, path, "name"), name))
+            plan.append(((GNOME_CUSTOM_SCHEMA, path, "command"), _get_clicky_command(flag, resident)))
+            plan.append(((GNOME_CUSTOM_SCHEMA, path, "binding"), binding))
+    else:
+        plan.append(((GNOME_MEDIA_KEYS_SCHEMA, None, "custom-keybindings"), _remove_all(paths)))
+    return plan
+
+
+if __name__ == "__main__":
+    # Dry run: show what enabling (or, with --disable, disabling) would change
+    import sys
+    enabled = "--disable" not in sys.argv
+    print(format_changes(reconcile(enabled, "--resident" in sys.argv, dry_run=True)))
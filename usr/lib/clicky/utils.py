@@ -1,35 +1,63 @@
 #!/usr/bin/python3
 import cairo
-import dbus
-from dbus.mainloop.glib import DBusGMainLoop
+import json
 import os
 import sys
 import gi
 import traceback
 
-gi.require_version('GSound', '1.0')
 try:
     gi.require_version('Gtk', '3.0')
 except ValueError:
     pass # Already set?
 
-from gi.repository import Gtk, Gio, Gdk, GdkPixbuf, GLib, GSound
+from gi.repository import Gtk, Gio, Gdk, GdkPixbuf, GLib
 from common import *
 
-# Ensure DBus uses GLib main loop for async calls/signals
-DBusGMainLoop(set_as_default=True)
+# dbus, Xlib, GdkX11 and GSound are only loaded once a capture (or sound)
+# actually needs them, see LazyModule and is_x11_available().
 
-IS_X11_AVAILABLE = False
-try:
-    import Xlib.display
-    from gi.repository import GdkX11
-    IS_X11_AVAILABLE = True
-except (ImportError, ValueError):
-    # Running on Wayland or dependencies missing
-    print("X11 libraries not found or not applicable. X11 features disabled.")
+def setup_dbus(module):
+    import dbus.mainloop.glib
+    # Ensure DBus uses GLib main loop for async calls/signals
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    # Captures through GNOME Shell are made from worker threads
+    dbus.mainloop.glib.threads_init()
+
+dbus = LazyModule("dbus", setup_dbus)
 
-SCREENSHOT_WIDTH = -1
-SCREENSHOT_HEIGHT = 250
+Xlib = None
+GdkX11 = None
+x11_available = None
+
+def is_x11_available():
+    global x11_available, Xlib, GdkX11
+    if x11_available is None:
+        try:
+            import Xlib.X
+            import Xlib.display
+            import Xlib.ext.shape
+            gi.require_version('GdkX11', '3.0')
+            from gi.repository import GdkX11
+            x11_available = True
+        except (ImportError, ValueError):
+            # Running on Wayland or dependencies missing
+            print("X11 libraries not found or not applicable. X11 features disabled.")
+            x11_available = False
+    return x11_available
+
+# Height of the thumbnail used for notifications
+NOTIFICATION_PREVIEW_HEIGHT = 250
+
+# Raised by the capture backends when the user dismissed the capture (e.g.
+# pressed Escape during area selection), as opposed to the backend failing.
+class CaptureCancelled(Exception):
+    pass
+
+# Raised by the capture backends when they can't capture at all (e.g. the
+# D-Bus method doesn't exist), as opposed to failing this once.
+class BackendUnavailable(Exception):
+    pass
 
 ########### AREA SELECTION ###################
 
@@ -192,77 +220,233 @@ def select_area_interactive():
     rect.height = height
     return rect
 
+########### D-BUS #########################
+
+SHELL_SCREENSHOT_NAME = 'org.gnome.Shell.Screenshot'
+SHELL_SCREENSHOT_PATH = '/org/gnome/Shell/Screenshot'
+SHELL_SCREENSHOT_IFACE = 'org.gnome.Shell.Screenshot'
+
+PORTAL_NAME = 'org.freedesktop.portal.Desktop'
+PORTAL_PATH = '/org/freedesktop/portal/desktop'
+PORTAL_SCREENSHOT_IFACE = 'org.freedesktop.portal.Screenshot'
+PORTAL_REQUEST_IFACE = 'org.freedesktop.portal.Request'
+
+# Errors after which the connection and cached proxies are thrown away and
+# the call is retried once (bus restarted, remote service crashed...)
+DBUS_RECONNECT_ERRORS = [
+    'org.freedesktop.DBus.Error.Disconnected',
+    'org.freedesktop.DBus.Error.NoReply',
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+    'org.freedesktop.DBus.Error.NoServer',
+]
+
+# Errors which mean the service, or the method we call, isn't there at all
+# or isn't for us (GNOME Shell 41+ still lists its Screenshot methods but
+# denies them to other applications). Anything else (no focused window, a
+# timeout...) may work next time.
+DBUS_UNAVAILABLE_ERRORS = [
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+    'org.freedesktop.DBus.Error.UnknownMethod',
+    'org.freedesktop.DBus.Error.UnknownInterface',
+    'org.freedesktop.DBus.Error.UnknownObject',
+    'org.freedesktop.DBus.Error.NotSupported',
+    'org.freedesktop.DBus.Error.AccessDenied',
+]
+
+def is_unavailable_error(e):
+    # Duck typed, so that dbus isn't loaded just to check
+    return hasattr(e, "get_dbus_name") and e.get_dbus_name() in DBUS_UNAVAILABLE_ERRORS
+
+# Keeps the session bus connection and the introspected proxies of the
+# capture services alive between captures, so a hotkey capture only pays
+# for the actual method call.
+class DBusCaptureBackend():
+
+    def __init__(self):
+        self.bus = None
+        self.interfaces = {}
+
+    def get_bus(self):
+        if self.bus is None or not self.bus.get_is_connected():
+            self.interfaces = {}
+            self.bus = dbus.SessionBus(mainloop=dbus.mainloop.glib.DBusGMainLoop())
+        return self.bus
+
+    def get_interface(self, name, path, interface_name):
+        key = (name, path, interface_name)
+        interface = self.interfaces.get(key)
+        if interface is None:
+            # Follow owner changes so the proxy survives a shell restart
+            remote_object = self.get_bus().get_object(name, path, follow_name_owner_changes=True)
+            interface = dbus.Interface(remote_object, interface_name)
+            self.interfaces[key] = interface
+        return interface
+
+    def reset(self):
+        self.interfaces = {}
+        self.bus = None
+
+    def call(self, name, path, interface_name, method, *args):
+        try:
+            return getattr(self.get_interface(name, path, interface_name), method)(*args)
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() not in DBUS_RECONNECT_ERRORS:
+                raise
+            print("D-Bus call %s.%s failed (%s), reconnecting..." % (interface_name, method, e.get_dbus_name()))
+            self.reset()
+            return getattr(self.get_interface(name, path, interface_name), method)(*args)
+
+    def has_service(self, name):
+        try:
+            return bool(self.get_bus().name_has_owner(name))
+        except dbus.exceptions.DBusException:
+            self.reset()
+            return False
+
+    # Open the bus and introspect the available capture services ahead of
+    # the first capture. Meant to be called once at startup.
+    def warm_up(self):
+        timer = StageTimer("D-Bus warm-up")
+        try:
+            if self.has_service(SHELL_SCREENSHOT_NAME):
+                self.get_interface(SHELL_SCREENSHOT_NAME, SHELL_SCREENSHOT_PATH, SHELL_SCREENSHOT_IFACE)
+                timer.mark("shell")
+            if self.has_service(PORTAL_NAME):
+                self.get_interface(PORTAL_NAME, PORTAL_PATH, PORTAL_SCREENSHOT_IFACE)
+                timer.mark("portal")
+            timer.report()
+        except Exception:
+            print(traceback.format_exc())
+            self.reset()
+        return False
+
+    def shell_screenshot(self, method, *args):
+        return self.call(SHELL_SCREENSHOT_NAME, SHELL_SCREENSHOT_PATH, SHELL_SCREENSHOT_IFACE, method, *args)
+
+    # The portal replies on a Request object whose path is derived from our
+    # unique name and the handle token, so we can subscribe before calling
+    # and never miss a fast response.
+    def get_portal_request_path(self, token):
+        sender = self.get_bus().get_unique_name()[1:].replace(".", "_")
+        return "%s/request/%s/%s" % (PORTAL_PATH, sender, token)
+
+dbus_backend = None
+
+def get_dbus_backend():
+    global dbus_backend
+    if dbus_backend is None:
+        dbus_backend = DBusCaptureBackend()
+    return dbus_backend
+
 ########### SHELL #########################
 
+# The shell can only hand us a PNG file, so make sure that file lives in the
+# per-user runtime directory (tmpfs on systemd systems) rather than in
+# ~/.cache, which may sit on a slow or network-mounted home directory.
+def get_capture_tmp_dir():
+    path = os.path.join(GLib.get_user_runtime_dir(), "clicky")
+    GLib.mkdir_with_parents(path, 0o0700)
+    return path
+
+# Read the shell's PNG back in a single read, so the file can be unlinked
+# right away and is never looked up twice. Decoding happens from memory.
+def read_tmp_file(filename):
+    try:
+        with open(filename, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(filename)
+
+# Backends return either a GdkPixbuf or the encoded image as bytes, so the
+# decoding can be done separately, off the main thread.
+def decode_image(image):
+    if not isinstance(image, bytes):
+        return image
+    stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(image))
+    return GdkPixbuf.Pixbuf.new_from_stream(stream, None)
+
 def capture_via_gnome_dbus(options):
-    pixbuf = None
+    image = None
+    timer = StageTimer("GNOME Shell capture")
     try:
-        path = os.path.join(GLib.get_user_cache_dir(), "clicky")
-        GLib.mkdir_with_parents(path, 0o0700)
         tmpname = "scr-%d.png" % GLib.random_int()
-        filename = os.path.join(path, tmpname)
+        filename = os.path.join(get_capture_tmp_dir(), tmpname)
 
-        bus = dbus.SessionBus(mainloop=DBusGMainLoop())
-        interface = bus.get_object('org.gnome.Shell.Screenshot', '/org/gnome/Shell/Screenshot')
-        manager = dbus.Interface(interface, 'org.gnome.Shell.Screenshot')
+        backend = get_dbus_backend()
 
         if options.enable_sound and options.mode != CAPTURE_MODE_AREA:
             play_sound_effect()
 
         if options.mode == CAPTURE_MODE_SCREEN:
-            (success, filename_used) = manager.Screenshot(options.include_pointer, options.enable_flash, filename)
+            (success, filename_used) = backend.shell_screenshot('Screenshot', options.include_pointer, options.enable_flash, filename)
         elif options.mode == CAPTURE_MODE_WINDOW:
-            (success, filename_used) = manager.ScreenshotWindow(options.include_borders, options.include_pointer, options.enable_flash, filename)
+            (success, filename_used) = backend.shell_screenshot('ScreenshotWindow', options.include_borders, options.include_pointer, options.enable_flash, filename)
         else:
-            rect = select_area_interactive()
+            rect = call_in_main_loop(select_area_interactive)
             if rect is None:
-                return None
+                raise CaptureCancelled()
+            timer.mark("select")
             if options.enable_sound:
                 play_sound_effect()
-            (success, filename_used) = manager.ScreenshotArea(rect.x, rect.y, rect.width, rect.height, options.enable_flash, filename)
+            (success, filename_used) = backend.shell_screenshot('ScreenshotArea', rect.x, rect.y, rect.width, rect.height, options.enable_flash, filename)
+        timer.mark("shell")
 
         if success:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT)
-            os.unlink(filename)
+            image = read_tmp_file(str(filename_used))
+            timer.mark("read")
+            timer.report()
+    except CaptureCancelled:
+        raise
     except Exception as e:
         print(traceback.format_exc())
+        if is_unavailable_error(e):
+            raise BackendUnavailable(str(e))
 
-    return pixbuf
+    return image
 
 def capture_via_xdg_portal(options):
     print("Attempting XDG Portal capture...")
-    pixbuf = None
+    image = None
     try:
-        bus = dbus.SessionBus(mainloop=DBusGMainLoop())
-        portal = bus.get_object('org.freedesktop.portal.Desktop', '/org/freedesktop/portal/desktop')
-        interface = dbus.Interface(portal, 'org.freedesktop.portal.Screenshot')
+        backend = get_dbus_backend()
+        bus = backend.get_bus()
+        token = f'clicky_{GLib.random_int()}'
         
         # Prepare options
         portal_opts = {
-            'handle_token': f'clicky_{GLib.random_int()}',
+            'handle_token': token,
             # Allow interactive selection for area mode
             'interactive': options.mode == CAPTURE_MODE_AREA
         }
         
-        # Call Screenshot method
-        request_path = interface.Screenshot("", portal_opts)
-        
         # Wait for Response signal
         loop = GLib.MainLoop()
         result_uri = [None]
+        cancelled = [False]
         
         def on_response(response, results):
             # 0 = Success, 1 = User Cancelled, 2 = Error
             if response == 0 and 'uri' in results:
                 result_uri[0] = results['uri']
+            cancelled[0] = response == 1
             loop.quit()
 
-        bus.add_signal_receiver(on_response,
-                                signal_name="Response",
-                                dbus_interface="org.freedesktop.portal.Request",
-                                path=request_path)
+        receiver = bus.add_signal_receiver(on_response,
+                                           signal_name="Response",
+                                           dbus_interface=PORTAL_REQUEST_IFACE,
+                                           path=backend.get_portal_request_path(token))
+
+        # Call Screenshot method
+        try:
+            backend.call(PORTAL_NAME, PORTAL_PATH, PORTAL_SCREENSHOT_IFACE, 'Screenshot', "", portal_opts)
+        except Exception:
+            receiver.remove()
+            raise
                                 
         loop.run()
+        receiver.remove()
+        if cancelled[0]:
+            raise CaptureCancelled()
         
         if result_uri[0]:
             # Convert URI (file://...) to local path
@@ -272,48 +456,92 @@ def capture_via_xdg_portal(options):
             path = unquote(path)
             
             if os.path.exists(path):
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+                with open(path, "rb") as f:
+                    image = f.read()
                 # Cleanup? The portal might save it to Pictures. 
                 # For this app, we might want to keep it or let the user decide.
                 # The generic logic tries to load a pixbuf.
                 
+    except CaptureCancelled:
+        raise
     except Exception as e:
         print(f"XDG Portal capture failed: {e}")
+        if is_unavailable_error(e):
+            raise BackendUnavailable(str(e))
         # print(traceback.format_exc())
 
-    return pixbuf
+    return image
 
 ############# X11 ############################
 
 
-def get_xwindow(xid):
-    # Scan all opened xwindows, return the one with the matching XID
-    xdisplay = Xlib.display.Display()
-    root_xwin = xdisplay.screen().root
-    xwindow_list = [root_xwin]
-    while len(xwindow_list) != 0:
-        xwin = xwindow_list.pop(0)
-        if xwin.id == xid:
-           return xwin
-        children = xwin.query_tree().children
-        if children != None:
-            xwindow_list += children
-    print ("Unable to find xwindow matching - %d\n" % xid)
-    return None
+# Keeps one Xlib connection for the whole session, remembers which frame
+# each client window belongs to and the frame extents of those frames.
+# Frames are watched for StructureNotify events, and the events queued since
+# the last lookup are processed before using the cache: ConfigureNotify
+# drops a frame's geometry, DestroyNotify/ReparentNotify drop the frame.
+class XWindowCache():
+
+    def __init__(self):
+        self.xdisplay = None
+        self.frames = {}
+        self.geometries = {}
+
+    def get_display(self):
+        if self.xdisplay is None:
+            self.xdisplay = Xlib.display.Display()
+        return self.xdisplay
+
+    def process_events(self):
+        xdisplay = self.get_display()
+        while xdisplay.pending_events() > 0:
+            event = xdisplay.next_event()
+            if event.type == Xlib.X.ConfigureNotify:
+                self.geometries.pop(event.window.id, None)
+            elif event.type in (Xlib.X.DestroyNotify, Xlib.X.ReparentNotify):
+                self.forget_frame(event.window.id)
+
+    def forget_frame(self, frame_xid):
+        self.geometries.pop(frame_xid, None)
+        for xid in [xid for (xid, frame) in self.frames.items() if frame.id == frame_xid]:
+            del self.frames[xid]
+
+    # Walk up from the client window until the parent is the root window
+    def get_frame(self, xid):
+        self.process_events()
+        frame = self.frames.get(xid)
+        if frame is None:
+            frame = self.get_display().create_resource_object('window', xid)
+            while True:
+                tree = frame.query_tree()
+                if tree.parent == tree.root or tree.parent.id == 0:
+                    break
+                frame = tree.parent
+            frame.change_attributes(event_mask=Xlib.X.StructureNotifyMask)
+            self.get_display().flush()
+            self.frames[xid] = frame
+        return frame
+
+    def get_frame_extents(self, frame, gdk_window):
+        self.process_events()
+        extents = self.geometries.get(frame.id)
+        if extents is None:
+            extents = gdk_window.get_frame_extents()
+            self.geometries[frame.id] = extents
+        return extents
+
+xwindow_cache = None
+
+def get_xwindow_cache():
+    global xwindow_cache
+    if xwindow_cache is None:
+        xwindow_cache = XWindowCache()
+    return xwindow_cache
 
 def find_xwindow(window):
     if window == Gdk.get_default_root_window():
         return None
-    xwindow = get_xwindow(window.get_xid())
-    if xwindow != None:
-        # Switch to xwindow's parent until its parent matches its root
-        while True:
-            root = xwindow.query_tree().root
-            parent = xwindow.query_tree().parent
-            if root == parent:
-                break
-            xwindow = parent
-    return xwindow
+    return get_xwindow_cache().get_frame(window.get_xid())
 
 def make_region_with_monitors(display):
     num_monitors = display.get_n_monitors()
@@ -324,25 +552,17 @@ def make_region_with_monitors(display):
         region.union(cairo_rect)
     return region
 
+# Opaque black, as 0xRRGGBBAA for GdkPixbuf.fill()
+BLANK_PIXEL = 0x000000ff
+
 def blank_rectangle_in_pixbuf(pixbuf, rect):
-    x2 = rect.x + rect.width
-    y2 = rect.y + rect.height
-    rowstride = pixbuf.get_rowstride()
-    has_alpha = pixbuf.get_has_alpha()
-    n_channels = pixbuf.get_n_channels()
-    pixels = pixbuf.get_pixels()
-    if not hasattr(pixels, "__setitem__"):
+    # A sub-pixbuf shares the pixel memory of its parent, so filling it blanks
+    # the rectangle in place, row by row in C, at about the cost of a memset.
+    # (get_pixels() only returns a read-only copy, so the pixels cannot be
+    # written from Python anyway.)
+    if rect.width <= 0 or rect.height <= 0:
         return
-
-    for y in range(rect.y, y2):
-        for x in range(rect.x, x2):
-            # insert pixel data at right location in bytes array
-            i = y * rowstride + x * n_channels
-            pixels[i + 0] = 0 # red
-            pixels[i + 1] = 0 # green
-            pixels[i + 2] = 0 # blue
-            if has_alpha:
-                pixels[i + 3] = 255 # opaque black
+    pixbuf.new_subpixbuf(rect.x, rect.y, rect.width, rect.height).fill(BLANK_PIXEL)
 
 def cairo_rect_to_gdk_rect(cairo_rect):
     rect = Gdk.Rectangle()
@@ -356,30 +576,24 @@ def gdk_rect_to_cairo_rect(gdk_rect):
     return cairo.RectangleInt(gdk_rect.x, gdk_rect.y, gdk_rect.width, gdk_rect.height)
 
 def blank_region_in_pixbuf(pixbuf, region):
-    n_rects = region.num_rectangles()
-    pixbuf_rect = Gdk.Rectangle()
-    pixbuf_rect.x = 0
-    pixbuf_rect.y = 0
-    pixbuf_rect.width = pixbuf.get_width()
-    pixbuf_rect.height = pixbuf.get_height()
-    for i in range(n_rects):
-        cairo_rect = region.get_rectangle(i)
-        gdk_rect = cairo_rect_to_gdk_rect(cairo_rect)
-        (does_interect, intersection_rect) = pixbuf_rect.intersect(gdk_rect)
-        if does_interect:
-            blank_rectangle_in_pixbuf(pixbuf, intersection_rect)
+    blank_region = region.copy()
+    blank_region.intersect(cairo.RectangleInt(0, 0, pixbuf.get_width(), pixbuf.get_height()))
+    for i in range(blank_region.num_rectangles()):
+        blank_rectangle_in_pixbuf(pixbuf, blank_region.get_rectangle(i))
 
 # When there are multiple monitors with different resolutions, the visible area
 # within the root window may not be rectangular(it may have an L-shape, for
 # example).  In that case, mask out the areas of the root window which would
 # not be visible in the monitors, so that screenshot do not end up with content
 # that the user won't ever see.
-def mask_monitors(pixbuf, root_window):
+# (x, y) is the position of the pixbuf within the root window.
+def mask_monitors(pixbuf, root_window, x=0, y=0):
     display = root_window.get_display()
     region_with_monitors = make_region_with_monitors(display)
     screen = Gdk.Screen.get_default()
     invisible_region = cairo.Region(cairo.RectangleInt(0, 0, screen.get_width(), screen.get_height()))
     invisible_region.subtract(region_with_monitors)
+    invisible_region.translate(-x, -y)
     blank_region_in_pixbuf(pixbuf, invisible_region)
 
 # Crop regions of the window which are outside of the screen
@@ -415,6 +629,68 @@ def screenshot_fallback_fire_flash(window, rectangle):
     flash = CheeseFlash()
     flash.fire(rectangle)
 
+# Copy a rectangle between two pixbufs of the same size, clipped to their
+# bounds. copy_area() copies whole rows in C and fills in the alpha channel
+# when the source has none.
+def copy_pixbuf_rectangle(src, dest, x, y, width, height):
+    x2 = min(x + width, src.get_width(), dest.get_width())
+    y2 = min(y + height, src.get_height(), dest.get_height())
+    x = max(x, 0)
+    y = max(y, 0)
+    if x2 <= x or y2 <= y:
+        return
+    src.copy_area(x, y, x2 - x, y2 - y, dest, x, y)
+
+# The pointer is drawn with the theme's default cursor. Loading it from the
+# theme is the slow part, so images are kept per cursor name and scale.
+POINTER_CURSOR_NAME = "default"
+
+class CursorImageCache():
+
+    def __init__(self):
+        self.images = {}
+
+    # Returns (pixbuf, x_hot, y_hot), or None. new_from_name() loads the
+    # cursor theme's size whatever the scale factor, so only the name matters.
+    def get_image(self, display, name):
+        if name not in self.images:
+            image = None
+            cursor = Gdk.Cursor.new_from_name(display, name)
+            if cursor is not None:
+                pixbuf = cursor.get_image()
+                if pixbuf is not None:
+                    x_hot = int(pixbuf.get_option("x_hot") or 0)
+                    y_hot = int(pixbuf.get_option("y_hot") or 0)
+                    image = (pixbuf, x_hot, y_hot)
+            self.images[name] = image
+        return self.images[name]
+
+cursor_image_cache = CursorImageCache()
+
+# Paint the pointer over the screenshot, if it is within the captured area.
+# coords is the captured area in root window coordinates.
+def composite_pointer(screenshot, display, device, coords, scale_factor):
+    image = cursor_image_cache.get_image(display, POINTER_CURSOR_NAME)
+    if image is None:
+        return
+    (cursor_pixbuf, x_hot, y_hot) = image
+
+    (screen, pointer_x, pointer_y) = device.get_position()
+    cursor_x = (pointer_x - coords.x) * scale_factor - x_hot
+    cursor_y = (pointer_y - coords.y) * scale_factor - y_hot
+
+    # Only the part of the cursor which falls inside the screenshot
+    x = max(cursor_x, 0)
+    y = max(cursor_y, 0)
+    x2 = min(cursor_x + cursor_pixbuf.get_width(), screenshot.get_width())
+    y2 = min(cursor_y + cursor_pixbuf.get_height(), screenshot.get_height())
+    if x2 <= x or y2 <= y:
+        return
+
+    cursor_pixbuf.composite(screenshot, x, y, x2 - x, y2 - y,
+                            cursor_x, cursor_y, 1.0, 1.0,
+                            GdkPixbuf.InterpType.NEAREST, 255)
+
 def find_current_window():
     current_window = Gdk.Screen.get_default().get_active_window()
     seat = Gdk.Display.get_default().get_default_seat()
@@ -453,7 +729,7 @@ def capture_via_x11(options):
     # find current window
     window = None
     if options.mode == CAPTURE_MODE_WINDOW:
-        if IS_X11_AVAILABLE:
+        if is_x11_available():
             window = find_current_window()
         else:
             # Fallback for Wayland if mode is window but we use X11 capture?
@@ -466,7 +742,7 @@ def capture_via_x11(options):
     screenshot_coords = crop_geometry(real_coords)
 
     wm = None
-    if IS_X11_AVAILABLE:
+    if is_x11_available():
         try:
             wm = find_xwindow(window)
         except Exception as e:
@@ -475,7 +751,7 @@ def capture_via_x11(options):
     if wm != None:
         try:
             wm_window = GdkX11.X11Window.foreign_new_for_display(GdkX11.X11Display.get_default(), wm.id)
-            wm_real_coords = crop_geometry(wm_window.get_frame_extents())
+            wm_real_coords = crop_geometry(get_xwindow_cache().get_frame_extents(wm, wm_window))
             frame_offset["left"] = real_coords.x - wm_real_coords.x
             frame_offset["top"] = real_coords.y - wm_real_coords.y
             frame_offset["right"] = wm_real_coords.width - real_coords.width - frame_offset["left"]
@@ -487,7 +763,7 @@ def capture_via_x11(options):
     if options.mode == CAPTURE_MODE_AREA:
         rect = select_area_interactive()
         if rect is None:
-            return None
+            raise CaptureCancelled()
         screenshot_coords.x = rect.x
         screenshot_coords.y = rect.y
         screenshot_coords.width = rect.width
@@ -498,15 +774,18 @@ def capture_via_x11(options):
                                            screenshot_coords.width, screenshot_coords.height)
 
     if options.mode != CAPTURE_MODE_SCREEN:
-        mask_monitors(screenshot, root_window)
+        mask_monitors(screenshot, root_window, screenshot_coords.x, screenshot_coords.y)
 
     if wm != None:
         # we must use XShape to avoid showing what's under the rounder corners
         # of the WM decoration.
-        rectangles = wm.shape_get_rectangles(Xlib.ext.shape.SK.Bounding).rectangles
+        try:
+            rectangles = wm.shape_get_rectangles(Xlib.ext.shape.SK.Bounding).rectangles
+        except Exception as e:
+            print("X11 XShape query failed:", e)
+            rectangles = None
         if rectangles != None and len(rectangles) > 0:
             scale_factor = wm_window.get_scale_factor()
-            has_alpha = screenshot.get_has_alpha()
             tmp = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, screenshot.get_width(), screenshot.get_height())
             tmp.fill(0)
 
@@ -541,60 +820,19 @@ def capture_via_x11(options):
                     rec_height = screen.get_height() - screenshot_coords.y - rec_y
 
                 # Undo the scale factor in order to copy the pixbuf data pixel-wise
-                if has_alpha:
-                    channels = 4
-                else:
-                    channels = 3
-                # for y in range(rec_y * scale_factor, (rec_y + rec_height) * scale_factor):
-                #     src_pixels = screenshot.get_pixels() \
-                #              + y * screenshot.get_rowstride() \
-                #              + rec_x * scale_factor * channels
-                #     dest_pixels = tmp.get_pixels() \
-                #               + y * tmp.get_rowstride() \
-                #               + rec_x * scale_factor * 4
-
-    #                 # for x in range(rec_width * scale_factor):
-    #                 #     *dest_pixels++ = *src_pixels++
-    #                 #     *dest_pixels++ = *src_pixels++
-    #                 #     *dest_pixels++ = *src_pixels++
-
-    #                 #     if(has_alpha)
-    #                 #         *dest_pixels++ = *src_pixels++
-    #                 #     else
-    #                 #         *dest_pixels++ = 255
-
-    #         # g_set_object(&screenshot, tmp)
+                copy_pixbuf_rectangle(screenshot, tmp,
+                                      int(rec_x * scale_factor), int(rec_y * scale_factor),
+                                      int(rec_width * scale_factor), int(rec_height * scale_factor))
+
+            # Whatever is outside of the window shape stays fully transparent
+            screenshot = tmp
 
     # if we have a selected area, there were by definition no cursor in the screenshot
-    # if options.include_pointer:
-    #     cursor = Gdk.Cursor.new_for_display(display, Gdk.LEFT_PTR)
-    #     cursor_pixbuf = cursor.get_image()
-
-    #     if cursor_pixbuf != None:
-    #         # if(wm_window != None):
-    #         #     (x, y) = wm_window.get_device_position(device)
-    #         # else:
-    #         #     (x, y) = wm_window.get_device_position(device)
-    #         # sscanf(cursor_pixbuf.get_option("x_hot"), "%d", &xhot)
-    #         # sscanf(cursor_pixbuf.get_option("y_hot"), "%d", &yhot)
-
-    #         # in rect we have the cursor window coordinates
-    #         rect.x = cx + real_coords.x
-    #         rect.y = cy + real_coords.y
-    #         rect.width = cursor_pixbuf.get_width()
-    #         rect.height = cursor_pixbuf.get_height()
-
-    #         # see if the pointer is inside the window
-    #         # if(gdk_rectangle_intersect(&real_coords, &rect, &rect)):
-    #         #     cursor_x = cx - xhot - frame_offset_left
-    #         #     cursor_y = cy - yhot - frame_offset_topre
-    #         #     gdk_pixbuf_composite(cursor_pixbuf, screenshot,
-    #         #                         cursor_x, cursor_y,
-    #         #                         rect.width, rect.height,
-    #         #                         cursor_x, cursor_y,
-    #         #                         1.0, 1.0,
-    #         #                         GDK_INTERP_BILINEAR,
-    #         #                         255)
+    if options.include_pointer and options.mode != CAPTURE_MODE_AREA:
+        try:
+            composite_pointer(screenshot, display, device, screenshot_coords, root_window.get_scale_factor())
+        except Exception as e:
+            print("X11 pointer compositing failed:", e)
 
     if options.enable_sound:
         play_sound_effect()
@@ -608,44 +846,215 @@ def capture_via_x11(options):
 
 @async_function
 def play_sound_effect():
+    gi.require_version('GSound', '1.0')
+    from gi.repository import GSound
     ctx = GSound.Context()
     ctx.init()
     ctx.play_simple({GSound.ATTR_EVENT_ID: "screen-capture"})
     GLib.usleep(2000000)
 
-def capture_pixbuf(options):
-    screenshot = None
+################### BACKENDS ##################
+
+BACKEND_GNOME_SHELL = 'gnome-shell'
+BACKEND_PORTAL = 'portal'
+BACKEND_X11 = 'x11'
+
+# Fastest first. The portal is last: it is slow and may show its own dialog,
+# so it is only used when nothing else can capture (e.g. on Wayland).
+BACKEND_ORDER = [BACKEND_GNOME_SHELL, BACKEND_X11, BACKEND_PORTAL]
+
+DBUS_BACKENDS = [BACKEND_GNOME_SHELL, BACKEND_PORTAL]
+
+ALL_MODES = [CAPTURE_MODE_SCREEN, CAPTURE_MODE_WINDOW, CAPTURE_MODE_AREA]
+
+# Figures out once per session which backends can capture which modes, and
+# remembers it in ~/.cache/clicky so the next launches in the same session
+# skip straight to a backend that works.
+class BackendProber():
+
+    def __init__(self, cache_path=None):
+        if cache_path is None:
+            cache_path = os.path.join(GLib.get_user_cache_dir(), "clicky", "backends.json")
+        self.cache_path = cache_path
+        self.capabilities = None
+
+    # Anything that changes which backends are reachable
+    def get_session_key(self):
+        keys = ["XDG_SESSION_ID", "XDG_CURRENT_DESKTOP", "XDG_SESSION_TYPE", "DISPLAY", "WAYLAND_DISPLAY"]
+        return "|".join(os.environ.get(key, "") for key in keys)
+
+    def probe_gnome_shell(self):
+        backend = get_dbus_backend()
+        if not backend.has_service(SHELL_SCREENSHOT_NAME):
+            return []
+        remote_object = backend.get_bus().get_object(SHELL_SCREENSHOT_NAME, SHELL_SCREENSHOT_PATH)
+        xml = remote_object.Introspect(dbus_interface='org.freedesktop.DBus.Introspectable')
+        methods = {
+            CAPTURE_MODE_SCREEN: 'name="Screenshot"',
+            CAPTURE_MODE_WINDOW: 'name="ScreenshotWindow"',
+            CAPTURE_MODE_AREA: 'name="ScreenshotArea"',
+        }
+        return [mode for mode in ALL_MODES if methods[mode] in xml]
+
+    def probe_portal(self):
+        if not get_dbus_backend().has_service(PORTAL_NAME):
+            return []
+        return [CAPTURE_MODE_SCREEN, CAPTURE_MODE_AREA]
+
+    def probe_x11(self):
+        if not is_x11_available():
+            return []
+        if not isinstance(Gdk.Display.get_default(), GdkX11.X11Display):
+            return []
+        return list(ALL_MODES)
+
+    def probe(self):
+        timer = StageTimer("Capture backend probe")
+        probes = {
+            BACKEND_GNOME_SHELL: self.probe_gnome_shell,
+            BACKEND_PORTAL: self.probe_portal,
+            BACKEND_X11: self.probe_x11,
+        }
+        capabilities = {}
+        for name in BACKEND_ORDER:
+            try:
+                capabilities[name] = probes[name]()
+            except Exception as e:
+                print("Probing %s failed: %s" % (name, e))
+                capabilities[name] = []
+            timer.mark(name)
+        timer.report()
+        return capabilities
+
+    def load(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("session") == self.get_session_key():
+                return data.get("backends")
+        except (OSError, ValueError):
+            pass
+        return None
 
-    if options.mode == CAPTURE_MODE_WINDOW:
-        if options.enable_dbus_method:
-            print("Capturing window via GNOME Dbus...")
-            screenshot = capture_via_gnome_dbus(options)
-        if screenshot == None:
-            print("Capturing window via X11...")
-            screenshot = capture_via_x11(options)
-        return screenshot
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path, "w", encoding="utf-8") as f:
+                json.dump({"session": self.get_session_key(), "backends": self.capabilities}, f)
+        except OSError as e:
+            print("Could not save capture backend cache:", e)
+
+    def get_capabilities(self):
+        if self.capabilities is None:
+            self.capabilities = self.load()
+            if self.capabilities is None:
+                self.capabilities = self.probe()
+                self.save()
+        return self.capabilities
+
+    def get_backends(self, mode, enable_dbus_method=True):
+        capabilities = self.get_capabilities()
+        backends = []
+        for name in BACKEND_ORDER:
+            if name in DBUS_BACKENDS and not enable_dbus_method:
+                continue
+            if mode in capabilities.get(name, []):
+                backends.append(name)
+        return backends
+
+    # Forget that a backend can capture a mode, after it turned out to be
+    # unavailable (see BackendUnavailable)
+    def invalidate(self, name, mode):
+        capabilities = self.get_capabilities()
+        if mode in capabilities.get(name, []):
+            capabilities[name].remove(mode)
+            self.save()
+
+backend_prober = None
+
+def get_backend_prober():
+    global backend_prober
+    if backend_prober is None:
+        backend_prober = BackendProber()
+    return backend_prober
+
+# Returns the captured image, encoded or not (see decode_image).
+# Safe to call from a worker thread: the backends that need GTK or a nested
+# main loop are run in the main loop.
+def capture_image(options):
+    capture_functions = {
+        BACKEND_GNOME_SHELL: capture_via_gnome_dbus,
+        BACKEND_PORTAL: capture_via_xdg_portal,
+        BACKEND_X11: capture_via_x11,
+    }
 
-    if options.mode == CAPTURE_MODE_AREA:
-        if options.enable_dbus_method:
-            print("Capturing area via GNOME Dbus...")
-            screenshot = capture_via_gnome_dbus(options)
-        if screenshot == None and options.enable_dbus_method and not IS_X11_AVAILABLE:
-            screenshot = capture_via_xdg_portal(options)
-        if screenshot == None:
-            print("Capturing area via X11...")
-            screenshot = capture_via_x11(options)
-        return screenshot
-
-    # CAPTURE_MODE_SCREEN
-    if options.enable_dbus_method:
-        print("Capturing screenshot via GNOME Dbus...")
-        screenshot = capture_via_gnome_dbus(options)
-    if screenshot == None and options.enable_dbus_method and not IS_X11_AVAILABLE:
-        screenshot = capture_via_xdg_portal(options)
-    if screenshot == None:
-        print("Capturing screenshot via X11...")
-        screenshot = capture_via_x11(options)
-    return screenshot
+    prober = get_backend_prober()
+    backends = prober.get_backends(options.mode, options.enable_dbus_method)
+    if len(backends) == 0:
+        # Nothing looked usable, X11 is still our best bet
+        backends = [BACKEND_X11]
+
+    for name in backends:
+        print("Capturing %s via %s..." % (options.mode, name))
+        try:
+            if name == BACKEND_GNOME_SHELL:
+                screenshot = capture_functions[name](options)
+            else:
+                screenshot = call_in_main_loop(capture_functions[name], options)
+        except CaptureCancelled:
+            return None
+        except BackendUnavailable as e:
+            print("%s can't capture %s (%s), not using it again" % (name, options.mode, e))
+            prober.invalidate(name, options.mode)
+            continue
+        # Failing once doesn't make the backend unusable, keep it for next time
+        if screenshot is not None:
+            return screenshot
+
+    return None
+
+def capture_pixbuf(options):
+    return decode_image(capture_image(options))
+
+# A full resolution capture. This is the only decoded copy of the image;
+# smaller versions are derived from it on demand and cached.
+class ScreenshotBuffer():
+
+    def __init__(self, pixbuf):
+        self.pixbuf = pixbuf
+        self.previews = {}
+
+    def get_width(self):
+        return self.pixbuf.get_width()
+
+    def get_height(self):
+        return self.pixbuf.get_height()
+
+    # Return a copy scaled to fit within max_width x max_height (-1 means
+    # unconstrained), keeping the aspect ratio. Never upscales.
+    def get_preview(self, max_width=-1, max_height=-1):
+        width = self.get_width()
+        height = self.get_height()
+        scale = 1.0
+        if max_width > 0:
+            scale = min(scale, max_width / width)
+        if max_height > 0:
+            scale = min(scale, max_height / height)
+        if scale >= 1.0:
+            return self.pixbuf
+
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        preview = self.previews.get(size)
+        if preview is None:
+            preview = self.pixbuf.scale_simple(size[0], size[1], GdkPixbuf.InterpType.BILINEAR)
+            self.previews[size] = preview
+        return preview
+
+def capture(options):
+    pixbuf = capture_pixbuf(options)
+    if pixbuf is None:
+        return None
+    return ScreenshotBuffer(pixbuf)
 
 def screenshot_show_dialog(parent, message_type, buttons_type, message, detail):
     dialog = Gtk.MessageDialog(parent, Gtk.DialogFlags.DESTROY_WITH_PARENT, message_type, buttons_type, message)
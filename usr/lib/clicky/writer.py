@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+"""
+writer.py – Encode and save images on a worker thread.
+
+Saves are queued and handled one at a time by a single worker, so a large
+PNG doesn't block the editor. Every file is written to a temporary file in
+the target directory first and then renamed over the target, so a file with
+the final name is always complete.
+"""
+
+import io
+import os
+import queue
+import threading
+import traceback
+
+from common import *
+
+# Only needed for palette PNGs
+Image = LazyModule("PIL.Image")
+
+# Trade-offs between encoding time and file size:
+# compression: zlib level of PNGs (GdkPixbuf's default is 6)
+# quality: JPEG and WebP quality
+# palette: save PNGs which have at most 256 colours, and no translucency,
+# as 8-bit palette images (lossless, and typical of UI screenshots)
+SAVE_PROFILES = {
+    "fastest": {"compression": 1, "quality": 90, "palette": False},
+    "balanced": {"compression": 6, "quality": 90, "palette": False},
+    "smallest": {"compression": 9, "quality": 80, "palette": True},
+}
+DEFAULT_SAVE_PROFILE = "balanced"
+PALETTE_SIZE = 256
+
+
+def get_save_profile(name):
+    return SAVE_PROFILES.get(name, SAVE_PROFILES[DEFAULT_SAVE_PROFILE])
+
+
+def get_save_options(fmt, profile=DEFAULT_SAVE_PROFILE):
+    """Return the (keys, values) GdkPixbuf save options for a format."""
+    profile = get_save_profile(profile)
+    if fmt == "png":
+        return (["compression"], [str(profile["compression"])])
+    if fmt in ["jpeg", "webp"]:
+        return (["quality"], [str(profile["quality"])])
+    return ([], [])
+
+
+def pixbuf_to_image(pixbuf):
+    mode = "RGBA" if pixbuf.get_has_alpha() else "RGB"
+    data = pixbuf.read_pixel_bytes().get_data()
+    return Image.frombuffer(mode, (pixbuf.get_width(), pixbuf.get_height()), data,
+                            "raw", mode, pixbuf.get_rowstride(), 1)
+
+
+def encode_palette_png(pixbuf, compression):
+    """Encode pixbuf as a palette PNG, or return None if that would lose
+    colours or transparency."""
+    image = pixbuf_to_image(pixbuf)
+    if image.mode == "RGBA":
+        if image.getextrema()[3][0] < 255:
+            return None
+        image = image.convert("RGB")
+    # None if there are more colours than that
+    colors = image.getcolors(PALETTE_SIZE)
+    if colors is None:
+        return None
+    palette = Image.new("P", (1, 1))
+    palette.putpalette([channel for (count, color) in colors for channel in color])
+    # Every pixel has an exact match in the palette, so this maps without loss
+    # Image.NONE, as Image.Dither only exists since Pillow 9.1
+    indexed = image.quantize(palette=palette, dither=Image.NONE)
+    output = io.BytesIO()
+    indexed.save(output, "PNG", compress_level=compression)
+    return output.getvalue()
+
+
+def encode(pixbuf, fmt, profile=DEFAULT_SAVE_PROFILE):
+    if fmt == "png" and get_save_profile(profile)["palette"]:
+        # Only an optimisation, never a reason for the save to fail
+        try:
+            data = encode_palette_png(pixbuf, get_save_profile(profile)["compression"])
+        except Exception:
+            print(traceback.format_exc())
+            data = None
+        if data is not None:
+            return data
+    (keys, values) = get_save_options(fmt, profile)
+    (success, data) = pixbuf.save_to_bufferv(fmt, keys, values)
+    return data
+
+
+def encode_with_fallback(pixbuf, path, fmt, profile=DEFAULT_SAVE_PROFILE):
+    """Encode pixbuf for saving to path. Returns (path, data): the path
+    changes to .png if the image had to be saved as PNG instead."""
+    try:
+        return (path, encode(pixbuf, fmt, profile))
+    except Exception as e:
+        if fmt != "webp":
+            raise
+        # The WebP pixbuf loader is optional, fall back to PNG
+        print("WebP encoding failed (%s), saving as PNG" % e)
+        return (os.path.splitext(path)[0] + ".png", encode(pixbuf, "png", profile))
+
+
+def get_temp_path(path):
+    # Hidden, in the same directory (and file system) so the rename is atomic
+    (directory, filename) = os.path.split(path)
+    return os.path.join(directory, ".%s.%d.part" % (filename, os.getpid()))
+
+
+def write_atomically(path, data):
+    temp_path = get_temp_path(path)
+    try:
+        # os.open() honours the umask, unlike tempfile.mkstemp()'s 0600
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class SaveJob():
+
+    def __init__(self, pixbuf, path, fmt, on_done=None, on_error=None, profile=DEFAULT_SAVE_PROFILE):
+        self.pixbuf = pixbuf
+        self.path = path
+        self.fmt = fmt
+        self.profile = profile
+        # Called in the main loop with the saved path, or the exception
+        self.on_done = on_done
+        self.on_error = on_error
+
+
+class Writer():
+    """Queue of save jobs, processed in order by a worker thread which is
+    started on the first save."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def save(self, pixbuf, path, fmt, on_done=None, on_error=None, profile=DEFAULT_SAVE_PROFILE):
+        """Queue pixbuf to be saved to path in the given GdkPixbuf format,
+        with one of the SAVE_PROFILES. The pixbuf must not be modified
+        afterwards."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="writer")
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(SaveJob(pixbuf, path, fmt, on_done, on_error, profile))
+
+    def wait(self):
+        """Block until every queued save is done, e.g. before exiting."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                path = self.write(job)
+            except Exception as e:
+                print(traceback.format_exc())
+                if job.on_error is not None:
+                    self.finish(job.on_error, e)
+            else:
+                if job.on_done is not None:
+                    self.finish(job.on_done, path)
+            finally:
+                self.queue.task_done()
+
+    def write(self, job):
+        timer = StageTimer("Save %s (%s)" % (os.path.basename(job.path), job.profile))
+        (path, data) = encode_with_fallback(job.pixbuf, job.path, job.fmt, job.profile)
+        timer.mark("encode")
+        write_atomically(path, data)
+        timer.mark("write")
+        timer.report()
+        return path
+
+    @idle_function
+    def finish(self, callback, result):
+        callback(result)
+
+writer = None
+
+def get_writer():
+    global writer
+    if writer is None:
+        writer = Writer()
+    return writer